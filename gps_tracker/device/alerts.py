@@ -0,0 +1,93 @@
+"""
+Alert episodes: one alert per episode instead of one per reading.
+
+Each rule in process_device_data_batch (moving, stationary, speeding, harsh
+acceleration and braking, maintenance) reports, for every reading, whether
+its condition holds (True), has cleared (False) or cannot be judged from the
+reading (None). An AlertState per device and rule follows the episodes:
+
+- open: the condition started to hold. The alert is written, unless the
+  rule's last alert is younger than its cooldown, which counts as suppressed.
+- ongoing: later readings still match. Nothing is written, except that rules
+  with a repeat interval write again once that much time has passed.
+- resolved: the condition cleared. The next time it holds is a new episode.
+
+Times are reading timestamps. Cooldowns and repeat intervals are in seconds
+and can be overridden per rule with GPS_ALERT_COOLDOWNS and GPS_ALERT_REPEATS.
+States are read with one query per batch and written with at most two, and
+only when an episode changes state.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+
+from device.models import AlertState
+
+COOLDOWNS = {
+    'moving': 1800,
+    'stationary': 600,
+    'speeding': 600,
+    'harsh_acceleration': 300,
+    'harsh_braking': 300,
+    'maintenance': 0,
+}
+REPEATS = {'maintenance': 30 * 86400}
+
+
+def cooldown(rule):
+    return timedelta(seconds={**COOLDOWNS, **getattr(settings, 'GPS_ALERT_COOLDOWNS', {})}.get(rule, 0))
+
+
+def repeat_interval(rule):
+    seconds = {**REPEATS, **getattr(settings, 'GPS_ALERT_REPEATS', {})}.get(rule)
+    return timedelta(seconds=seconds) if seconds else None
+
+
+class AlertTracker:
+    """AlertStates of a batch's devices; update() advances them, save() writes the ones that changed."""
+
+    def __init__(self, device_ids):
+        self.states = {(state.device_id, state.rule): state
+                       for state in AlertState.objects.filter(device_id__in=device_ids)}
+        self.changed = set()
+
+    def update(self, device_pk, rule, active, timestamp):
+        """Feed one reading's verdict for a rule; returns whether to write the alert."""
+        if active is None:
+            return False
+        key = (device_pk, rule)
+        state = self.states.get(key)
+        if not active:
+            if state and state.status != 'resolved':
+                state.status, state.resolved_at = 'resolved', timestamp
+                self.changed.add(key)
+            return False
+        if state is None:
+            self.states[key] = AlertState(device_id=device_pk, rule=rule, status='open', opened_at=timestamp,
+                                          fired_at=timestamp)
+            self.changed.add(key)
+            return True
+        if state.status == 'resolved':
+            state.status, state.opened_at, state.resolved_at = 'open', timestamp, None
+            self.changed.add(key)
+            if state.fired_at and timestamp - state.fired_at < cooldown(rule):
+                state.suppressed += 1
+                return False
+            state.fired_at = timestamp
+            return True
+        repeat = repeat_interval(rule)
+        if repeat and (state.fired_at is None or timestamp - state.fired_at >= repeat):
+            state.fired_at = timestamp
+            self.changed.add(key)
+            return True
+        if state.status == 'open':
+            state.status = 'ongoing'
+            self.changed.add(key)
+        return False
+
+    def save(self):
+        changed = [self.states[key] for key in self.changed]
+        AlertState.objects.bulk_create([state for state in changed if state.pk is None], ignore_conflicts=True)
+        AlertState.objects.bulk_update([state for state in changed if state.pk is not None],
+                                       ['status', 'opened_at', 'fired_at', 'resolved_at', 'suppressed'])
+        self.changed = set()
@@ -0,0 +1,235 @@
+"""
+Cold-tier archive of old DeviceData.
+
+``manage.py archive_devicedata`` moves each device's closed UTC days older
+than GPS_ARCHIVE_AFTER_DAYS out of the database into one compressed NumPy
+file per device and day under GPS_ARCHIVE_DIR (<device pk>/<YYYY-MM-DD>-<id>.npz).
+The file is columnar: timestamps (microseconds), coordinates (1e-7 degree
+fixed point, about 1 cm) and odometer (millimetres) are delta-encoded
+integers, and the remaining columns are stored narrow. Each file has an
+ArchivedDay manifest row with its time and odometer range, so readers only
+open the files that overlap what they ask for.
+
+``history``, ``track`` and ``odometer_bounds`` merge archived days with the
+live rows, so callers do not need to know where a point is stored. Ingest
+rejects readings at or before a device's newest archived point (see
+``horizons``): they are either already archived or would shift odometers that
+are sealed in files. Live rows of an archived day, from before that rule, are
+merged into the file when the day is archived again.
+"""
+import heapq
+import os
+import uuid
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from device.models import ArchivedDay, DeviceData
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+COORDINATE_SCALE = 10 ** 7
+POWER_SOURCES = ('battery', 'direct')
+FIELDS = ('latitude', 'longitude', 'altitude', 'speed', 'heading', 'charge', 'timestamp', 'power_source', 'odometer',
+          'dwell')
+
+
+class ArchivedPoint:
+    """A DeviceData row read back from the archive; it has the same attributes but is not a model instance."""
+    __slots__ = ('device_id', 'status') + FIELDS
+
+    def __init__(self, device_id, **values):
+        self.device_id = device_id
+        self.status = None
+        for field in FIELDS:
+            setattr(self, field, values[field])
+
+
+def archive_dir():
+    return str(getattr(settings, 'GPS_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive')))
+
+
+def _delta(values):
+    return np.diff(values, prepend=0)
+
+
+def encode(points):
+    """Column arrays for points sorted by timestamp."""
+    epoch_us = np.array([(point.timestamp - EPOCH) // timedelta(microseconds=1) for point in points], dtype=np.int64)
+    latitude = np.rint(np.array([point.latitude for point in points]) * COORDINATE_SCALE).astype(np.int64)
+    longitude = np.rint(np.array([point.longitude for point in points]) * COORDINATE_SCALE).astype(np.int64)
+    odometer = np.rint(np.array([point.odometer for point in points]) * 1000).astype(np.int64)
+    return {
+        'timestamp': _delta(epoch_us),
+        'latitude': _delta(latitude),
+        'longitude': _delta(longitude),
+        'odometer': _delta(odometer),
+        'altitude': np.array([point.altitude for point in points], dtype=np.float32),
+        'speed': np.array([point.speed for point in points], dtype=np.float32),
+        'heading': np.array([point.heading for point in points], dtype=np.float32),
+        'dwell': np.array([point.dwell for point in points], dtype=np.float32),
+        'charge': np.array([point.charge for point in points], dtype=np.int16),
+        'power_source': np.array([POWER_SOURCES.index(point.power_source) if point.power_source in POWER_SOURCES else 0
+                                  for point in points], dtype=np.int8),
+    }
+
+
+def decode(device_id, columns):
+    """ArchivedPoints, oldest first, from encode()'s column arrays."""
+    epoch_us = np.cumsum(columns['timestamp'])
+    latitude = np.cumsum(columns['latitude']) / COORDINATE_SCALE
+    longitude = np.cumsum(columns['longitude']) / COORDINATE_SCALE
+    odometer = np.cumsum(columns['odometer']) / 1000
+    return [
+        ArchivedPoint(
+            device_id, latitude=float(latitude[i]), longitude=float(longitude[i]),
+            altitude=float(columns['altitude'][i]), speed=float(columns['speed'][i]),
+            heading=float(columns['heading'][i]), charge=int(columns['charge'][i]),
+            timestamp=EPOCH + timedelta(microseconds=int(epoch_us[i])),
+            power_source=POWER_SOURCES[columns['power_source'][i]], odometer=float(odometer[i]),
+            dwell=float(columns['dwell'][i]),
+        )
+        for i in range(len(epoch_us))
+    ]
+
+
+def read_day(entry):
+    with np.load(os.path.join(archive_dir(), entry.path)) as columns:
+        return decode(entry.device_id, {name: columns[name] for name in columns.files})
+
+
+def day_bounds(day):
+    start = datetime.combine(day, dt_time.min, tzinfo=dt_timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def archive_day(device, day):
+    """
+    Move a device's live rows for one UTC day (plus anything already archived
+    for it) into a new file. The manifest switches to the file and the rows
+    are deleted in one transaction; the replaced file is removed once that
+    commits, and a rolled-back run only leaves an unreferenced file behind.
+    Returns how many live rows were moved.
+    """
+    start, end = day_bounds(day)
+    with transaction.atomic():
+        rows = DeviceData.objects.select_for_update().filter(device=device, timestamp__gte=start, timestamp__lt=end)
+        live = list(rows.order_by('timestamp'))
+        if not live:
+            return 0
+        entry = ArchivedDay.objects.filter(device=device, day=day).first()
+        points = live
+        if entry:
+            stored = {point.timestamp for point in live}
+            points = sorted([point for point in read_day(entry) if point.timestamp not in stored] + live,
+                            key=lambda point: point.timestamp)
+        path = os.path.join(str(device.pk), f"{day.isoformat()}-{uuid.uuid4().hex[:8]}.npz")
+        full_path = os.path.join(archive_dir(), path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        partial = full_path + '.partial'
+        with open(partial, 'wb') as handle:
+            np.savez_compressed(handle, **encode(points))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(partial, full_path)
+        if entry:
+            replaced = os.path.join(archive_dir(), entry.path)
+            transaction.on_commit(lambda: os.remove(replaced) if os.path.exists(replaced) else None)
+        ArchivedDay.objects.update_or_create(device=device, day=day, defaults={
+            'path': path,
+            'point_count': len(points),
+            'first_timestamp': points[0].timestamp,
+            'last_timestamp': points[-1].timestamp,
+            'first_odometer': points[0].odometer,
+            'last_odometer': points[-1].odometer,
+            'size': os.path.getsize(full_path),
+        })
+        rows.delete()
+    return len(live)
+
+
+def closed_days(device, cutoff):
+    """UTC days with live rows that end at or before cutoff."""
+    days = DeviceData.objects.filter(device=device, timestamp__lt=cutoff).datetimes(
+        'timestamp', 'day', tzinfo=dt_timezone.utc)
+    return [moment.date() for moment in days if day_bounds(moment.date())[1] <= cutoff]
+
+
+def archived_days(device, since=None, until=None):
+    days = ArchivedDay.objects.filter(device=device)
+    if since:
+        days = days.filter(last_timestamp__gte=since)
+    if until:
+        days = days.filter(first_timestamp__lte=until)
+    return days
+
+
+def horizons(device_ids):
+    """{device pk: timestamp of its newest archived point} for the devices that have archived days, in one query."""
+    return dict(ArchivedDay.objects.filter(device_id__in=device_ids).values_list('device_id')
+                .annotate(Max('last_timestamp')))
+
+
+def last_point(device):
+    """The device's newest archived point, or None."""
+    entry = ArchivedDay.objects.filter(device=device).order_by('-day').first()
+    return read_day(entry)[-1] if entry else None
+
+
+def _in_window(point, since, until):
+    return (not since or point.timestamp >= since) and (not until or point.timestamp <= until)
+
+
+def history(device, since=None, limit=None):
+    """Newest-first points from since on, live and archived, at most limit of them."""
+    live = DeviceData.objects.filter(device=device).order_by('-timestamp')
+    if since:
+        live = live.filter(timestamp__gte=since)
+    points = list(live[:limit] if limit else live)
+    if limit and len(points) >= limit:
+        return points
+    for entry in archived_days(device, since).order_by('-day'):
+        points += [point for point in reversed(read_day(entry)) if _in_window(point, since, None)]
+        # Live late points can be older than this day, so only points from it on count towards the limit
+        if limit and sum(1 for point in points if point.timestamp >= entry.first_timestamp) >= limit:
+            break
+    points.sort(key=lambda point: point.timestamp, reverse=True)
+    return points[:limit] if limit else points
+
+
+def track(device, since=None, until=None, chunk_size=2000):
+    """Oldest-first iterator over all points in [since, until], archived days first merged with live rows."""
+    live = DeviceData.objects.filter(device=device).order_by('timestamp')
+    if since:
+        live = live.filter(timestamp__gte=since)
+    if until:
+        live = live.filter(timestamp__lte=until)
+    archived = (point for entry in archived_days(device, since, until).order_by('day')
+                for point in read_day(entry) if _in_window(point, since, until))
+    return heapq.merge(archived, live.iterator(chunk_size=chunk_size), key=lambda point: point.timestamp)
+
+
+def odometer_bounds(device, since=None, until=None):
+    """
+    ((timestamp, odometer) of the first archived point in [since, until],
+    same for the last), or None when no archived day overlaps. Only the two
+    edge files are read, and only if the window cuts into them.
+    """
+    days = archived_days(device, since, until)
+    first_day, last_day = days.order_by('day').first(), days.order_by('-day').first()
+    if first_day is None:
+        return None
+    if since and since > first_day.first_timestamp:
+        first = next(point for point in read_day(first_day) if point.timestamp >= since)
+        first = (first.timestamp, first.odometer)
+    else:
+        first = (first_day.first_timestamp, first_day.first_odometer)
+    if until and until < last_day.last_timestamp:
+        last = [point for point in read_day(last_day) if point.timestamp <= until][-1]
+        last = (last.timestamp, last.odometer)
+    else:
+        last = (last_day.last_timestamp, last_day.last_odometer)
+    return first, last
+
@@ -0,0 +1,146 @@
+"""
+Chunked, resumable backfills for rewriting large tables.
+
+A Backfill walks a queryset in primary-key order, ``chunk_size`` rows at a
+time. Pagination is keyset-based: each chunk starts after the last pk of the
+previous one, so there is no OFFSET scan and no long-lived cursor. Each chunk
+is rewritten with set-based statements, and those commit together with the
+backfill's BackfillCheckpoint row, so a run that is interrupted resumes
+after the last committed chunk. A run stops at the highest pk that existed
+when it started, because rows written after that come from code that already
+writes them correctly.
+
+A subclass either sets ``updates`` to {field: expression} for rewrites that
+SQL can do on its own (one UPDATE per chunk), or sets ``fields`` and
+overrides ``apply`` to compute the new values in Python and write them with
+bulk_update.
+
+Throttling: after each chunk the run sleeps for ``throttle`` times as long as
+the chunk took, and for at least ``pause`` seconds. The default of 0.5 keeps
+the database busy at most two thirds of the time. Progress, rate and ETA are
+reported every ``report_every`` seconds. The ETA assumes pks are spread
+evenly over the range.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from device.models import BackfillCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+class Backfill:
+    name = None  # checkpoint key; one row in BackfillCheckpoint per name
+    model = None
+    fields = ()  # columns read for apply(), after the pk
+    updates = None  # {field: expression} for SQL-only backfills
+
+    def __init__(self, chunk_size=5000, throttle=0.5, pause=0, report_every=10, stdout=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.pause = pause
+        self.report_every = report_every
+        self.stdout = stdout
+        self.clock = clock
+        self.sleep = sleep
+
+    def queryset(self):
+        """The rows to visit; filters here also limit the set-based UPDATEs."""
+        return self.model.objects.all()
+
+    def apply(self, rows):
+        """Rewrite one chunk of (pk, *fields) tuples; returns how many rows changed."""
+        raise NotImplementedError
+
+    def apply_range(self, first_pk, last_pk):
+        return self.queryset().filter(pk__gte=first_pk, pk__lte=last_pk).update(**self.updates)
+
+    def report(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+        else:
+            logger.info(f"{self.name}: {message}")
+
+    def _progress(self, checkpoint, first_pk, run_rows, elapsed):
+        span = max(checkpoint.max_pk - first_pk, 1)
+        done = max(checkpoint.last_pk - first_pk, 0)
+        message = (f"{checkpoint.rows_processed} rows processed, {checkpoint.rows_changed} changed, "
+                   f"pk {checkpoint.last_pk}/{checkpoint.max_pk} ({done / span:.1%})")
+        if elapsed > 0 and done:
+            eta = (span - done) / (done / elapsed)
+            message += f", {run_rows / elapsed:.0f} rows/s, ETA {timedelta(seconds=round(eta))}"
+        return message
+
+    def run(self, restart=False, max_rows=None):
+        """Process chunks until the range is done (or max_rows have been read this run); returns the checkpoint."""
+        checkpoint, _ = BackfillCheckpoint.objects.get_or_create(name=self.name)
+        if restart:
+            checkpoint.last_pk = checkpoint.max_pk = checkpoint.finished_at = None
+            checkpoint.rows_processed = checkpoint.rows_changed = 0
+            checkpoint.started_at = timezone.now()
+        if checkpoint.finished_at:
+            self.report(f"Already finished at {checkpoint.finished_at:%Y-%m-%d %H:%M}; pass --restart to run again")
+            return checkpoint
+        if checkpoint.max_pk is None:
+            checkpoint.max_pk = self.queryset().aggregate(max_pk=Max('pk'))['max_pk'] or 0
+        checkpoint.save()
+        remaining = self.queryset().order_by('pk').filter(pk__lte=checkpoint.max_pk)
+        if checkpoint.last_pk is not None:
+            self.report(f"Resuming after pk {checkpoint.last_pk}")
+            remaining = remaining.filter(pk__gt=checkpoint.last_pk)
+        first_pk = remaining.aggregate(min_pk=Min('pk'))['min_pk']
+        first_pk = checkpoint.max_pk if first_pk is None else first_pk
+        started = last_report = self.clock()
+        run_rows = 0
+        while max_rows is None or run_rows < max_rows:
+            size = self.chunk_size if max_rows is None else min(self.chunk_size, max_rows - run_rows)
+            chunk_started = self.clock()
+            chunk = remaining if checkpoint.last_pk is None else remaining.filter(pk__gt=checkpoint.last_pk)
+            if self.updates is not None:
+                rows = list(chunk.values_list('pk', flat=True)[:size])
+                last_pk = rows[-1] if rows else None
+            else:
+                rows = list(chunk.values_list('pk', *self.fields)[:size])
+                last_pk = rows[-1][0] if rows else None
+            if not rows:
+                checkpoint.finished_at = timezone.now()
+                checkpoint.save(update_fields=['finished_at', 'updated_at'])
+                break
+            with transaction.atomic():
+                changed = self.apply_range(rows[0], last_pk) if self.updates is not None else self.apply(rows)
+                checkpoint.last_pk = last_pk
+                checkpoint.rows_processed += len(rows)
+                checkpoint.rows_changed += changed
+                checkpoint.save(update_fields=['last_pk', 'rows_processed', 'rows_changed', 'updated_at'])
+            run_rows += len(rows)
+            now = self.clock()
+            if now - last_report >= self.report_every:
+                last_report = now
+                self.report(self._progress(checkpoint, first_pk, run_rows, now - started))
+            delay = max((now - chunk_started) * self.throttle, self.pause)
+            if delay > 0:
+                self.sleep(delay)
+        self.report(self._progress(checkpoint, first_pk, run_rows, self.clock() - started))
+        return checkpoint
+
+
+def add_arguments(parser):
+    """The options every backfill command takes; pass them on with from_options."""
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Rows per chunk (one transaction each)')
+    parser.add_argument('--throttle', type=float, default=0.5,
+                        help='Sleep this many times as long as each chunk took (0 runs flat out)')
+    parser.add_argument('--pause', type=float, default=0, help='Sleep at least this many seconds between chunks')
+    parser.add_argument('--report-every', type=float, default=10, help='Seconds between progress lines')
+    parser.add_argument('--max-rows', type=int, help='Stop after this many rows; the next run resumes from there')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the beginning')
+
+
+def from_options(backfill_class, options, stdout=None, **kwargs):
+    return backfill_class(chunk_size=options['chunk_size'], throttle=options['throttle'], pause=options['pause'],
+                          report_every=options['report_every'], stdout=stdout, **kwargs)
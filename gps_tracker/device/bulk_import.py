@@ -0,0 +1,259 @@
+"""
+Streaming bulk import of track dumps and fleet device lists.
+
+Input is CSV with a header row or NDJSON (one object per line), optionally
+gzipped, and is read one record at a time. Records are loaded in batches of
+``batch_size`` into a temporary staging table and merged into the real table
+with one INSERT ... SELECT per batch. The merge resolves device_id (or
+username) to a primary key with a join and skips rows that already exist with
+ON CONFLICT DO NOTHING, so re-running an import is harmless. On PostgreSQL
+the staging table is filled with COPY FROM STDIN, which streams the batch
+without holding it in memory. Other databases use executemany. Either way
+memory use depends on the batch size, not on the size of the file.
+
+Track columns: device_id, latitude, longitude and timestamp (ISO 8601, naive
+means UTC, or epoch seconds) are required. altitude, speed, heading, charge
+and power_source are optional. Device list columns are device_id,
+device_password and optionally username, the owner. Other columns are
+ignored, so devices_export.csv can be imported as it is.
+
+Points at or before a device's newest archived point are skipped, as at
+ingest. Imported points get no per-point odometer or rollups, and they are not
+checked against geofences or alerts one by one. import_tracks recomputes
+odometers, rollups and the latest-reading columns of the devices it touched
+afterwards, and runs their newest points through the geofences.
+"""
+import csv
+import gzip
+import io
+import itertools
+import json
+import sys
+from datetime import datetime, timezone as dt_timezone
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+
+from device.models import ArchivedDay, Device, DeviceData
+
+STAGING_TABLE = 'device_import_staging'
+TRACK_FIELDS = ('latitude', 'longitude', 'altitude', 'speed', 'heading', 'charge', 'timestamp', 'power_source')
+POWER_SOURCES = {choice for choice, _ in DeviceData._meta.get_field('power_source').choices}
+
+
+def open_records(path, format=None):
+    """Dicts from a CSV or NDJSON file ('-' for stdin), guessing the format from the extension."""
+    name = path[:-3] if path.endswith('.gz') else path
+    format = format or ('ndjson' if name.endswith(('.ndjson', '.jsonl', '.json')) else 'csv')
+    if path == '-':
+        handle = sys.stdin
+    elif path.endswith('.gz'):
+        handle = gzip.open(path, 'rt', newline='')
+    else:
+        handle = open(path, newline='')
+    with handle:
+        if format == 'csv':
+            yield from csv.DictReader(handle)
+        else:
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_time(value):
+    if isinstance(value, (int, float)) or str(value).replace('.', '', 1).isdigit():
+        return datetime.fromtimestamp(float(value), dt_timezone.utc)
+    moment = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    return moment if moment.tzinfo else moment.replace(tzinfo=dt_timezone.utc)
+
+
+class Stats:
+    """Counts for one import; ``invalid`` holds records that could not be parsed."""
+
+    def __init__(self):
+        self.read = self.invalid = self.inserted = self.unknown = 0
+        self.batches = 0
+        self.device_pks = set()
+
+    @property
+    def duplicates(self):
+        return self.read - self.invalid - self.inserted - self.unknown
+
+
+def track_rows(records, stats):
+    """Staging rows (device_id, *TRACK_FIELDS) for track records; bad records are counted and skipped."""
+    # The backend's own conversion, bound once: the field's get_db_prep_save costs more than parsing the row
+    prep_timestamp = connection.ops.adapt_datetimefield_value
+    for record in records:
+        stats.read += 1
+        try:
+            latitude, longitude = float(record['latitude']), float(record['longitude'])
+            power_source = record.get('power_source') or 'battery'
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or power_source not in POWER_SOURCES:
+                raise ValueError
+            yield (
+                str(record['device_id']).strip(), latitude, longitude,
+                float(record.get('altitude') or 0), float(record.get('speed') or 0),
+                float(record.get('heading') or 0), int(float(record.get('charge') or 0)),
+                prep_timestamp(parse_time(record['timestamp'])), power_source,
+            )
+        except (KeyError, TypeError, ValueError, OverflowError):
+            stats.invalid += 1
+
+
+def device_rows(records, stats, username=None):
+    """Staging rows (device_id, device_password, username) for device list records."""
+    for record in records:
+        stats.read += 1
+        device_id = str(record.get('device_id') or '').strip()
+        owner = str(record.get('username') or username or '').strip()
+        if not device_id or not owner or not record.get('device_password'):
+            stats.invalid += 1
+            continue
+        yield device_id, str(record['device_password']).strip(), owner
+
+
+class CopyStream:
+    """Read-only file over rows as CSV, for psycopg2's copy_expert."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            rows = list(itertools.islice(self.rows, 1000))
+            if not rows:
+                break
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.writer.writerows(rows)
+            self.pending += self.buffer.getvalue()
+        if size < 0:
+            data, self.pending = self.pending, ''
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def _counted(rows, counter):
+    for row in rows:
+        counter[0] += 1
+        yield row
+
+
+def stage(cursor, columns, rows):
+    """
+    (Re)create the staging table with the types of the given (name, model
+    field) columns and load rows into it; returns how many were loaded.
+    """
+    quote = connection.ops.quote_name
+    cursor.execute(f"DROP TABLE IF EXISTS {quote(STAGING_TABLE)}")
+    definitions = ', '.join(f"{quote(name)} {field.db_type(connection)}" for name, field in columns)
+    cursor.execute(f"CREATE TEMPORARY TABLE {quote(STAGING_TABLE)} ({definitions})")
+    names = ', '.join(quote(name) for name, _ in columns)
+    loaded = [0]
+    rows = _counted(rows, loaded)
+    if connection.vendor == 'postgresql':
+        cursor.copy_expert(f"COPY {quote(STAGING_TABLE)} ({names}) FROM STDIN WITH (FORMAT csv)", CopyStream(rows))
+    else:
+        placeholders = ', '.join(['%s'] * len(columns))
+        cursor.executemany(f"INSERT INTO {quote(STAGING_TABLE)} ({names}) VALUES ({placeholders})", rows)
+    return loaded[0]
+
+
+def default_columns(model, supplied):
+    """(column names, values) for the model's other columns, filled the way Model.save() would fill them."""
+    names, values, now = [], [], timezone.now()
+    for field in model._meta.concrete_fields:
+        if field.primary_key or field.name in supplied:
+            continue
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+            value = now
+        else:
+            value = field.get_default()
+        names.append(connection.ops.quote_name(field.column))
+        values.append(field.get_db_prep_save(value, connection))
+    return names, values
+
+
+def _run(rows, columns, merge, stats, batch_size):
+    """Stage and merge rows batch by batch, one transaction per batch."""
+    rows = iter(rows)
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            staged = stage(cursor, columns, itertools.islice(rows, batch_size))
+            if staged:
+                merge(cursor)
+            cursor.execute(f"DROP TABLE IF EXISTS {connection.ops.quote_name(STAGING_TABLE)}")
+        if not staged:
+            return stats
+        stats.batches += 1
+
+
+def import_tracks(records, batch_size=100000, stats=None):
+    """Insert DeviceData from track records, skipping unknown devices and points already stored or archived."""
+    stats = stats or Stats()
+    quote = connection.ops.quote_name
+    device_table, data_table, staging = (quote(Device._meta.db_table), quote(DeviceData._meta.db_table),
+                                         quote(STAGING_TABLE))
+    archive_table = quote(ArchivedDay._meta.db_table)
+    columns = [('device_key', Device._meta.get_field('device_id'))] + [
+        (name, DeviceData._meta.get_field(name)) for name in TRACK_FIELDS]
+    fields = ', '.join(quote(DeviceData._meta.get_field(name).column) for name in TRACK_FIELDS)
+    selected = ', '.join(f"s.{quote(name)}" for name in TRACK_FIELDS)
+    extra_names, extra_values = default_columns(DeviceData, {'device', *TRACK_FIELDS})
+    extra_names = ''.join(f", {name}" for name in extra_names)
+    extra_params = ''.join(', %s' for _ in extra_values)
+
+    def merge(cursor):
+        cursor.execute(f"SELECT count(*) FROM {staging} s WHERE NOT EXISTS "
+                       f"(SELECT 1 FROM {device_table} d WHERE d.device_id = s.device_key)")
+        stats.unknown += cursor.fetchone()[0]
+        cursor.execute(f"SELECT DISTINCT d.id FROM {staging} s JOIN {device_table} d ON d.device_id = s.device_key")
+        stats.device_pks.update(pk for pk, in cursor.fetchall())
+        # Points in a device's archived days are skipped like duplicates (see device.archive); the WHERE
+        # clause also keeps SQLite from reading ON CONFLICT as a join constraint
+        cursor.execute(
+            f"INSERT INTO {data_table} ({quote('device_id')}, {fields}{extra_names}) "
+            f"SELECT d.id, {selected}{extra_params} FROM {staging} s JOIN {device_table} d ON d.device_id = s.device_key "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {archive_table} a WHERE a.{quote('device_id')} = d.id "
+            f"AND a.{quote('last_timestamp')} >= s.{quote('timestamp')}) "
+            f"ON CONFLICT ({quote('device_id')}, {quote('timestamp')}) DO NOTHING", extra_values)
+        stats.inserted += cursor.rowcount
+
+    return _run(track_rows(records, stats), columns, merge, stats, batch_size)
+
+
+def import_devices(records, username=None, batch_size=100000, stats=None):
+    """
+    Create Devices from device list records, owned by the record's username or
+    by ``username``. Devices that already exist are left alone; records whose
+    owner does not exist count as unknown.
+    """
+    stats = stats or Stats()
+    quote = connection.ops.quote_name
+    device_table, user_table, staging = (quote(Device._meta.db_table), quote(User._meta.db_table),
+                                         quote(STAGING_TABLE))
+    columns = [('device_key', Device._meta.get_field('device_id')),
+               ('device_password', Device._meta.get_field('device_password')),
+               ('username', User._meta.get_field('username'))]
+    extra_names, extra_values = default_columns(Device, {'user', 'device_id', 'device_password'})
+    extra_names = ''.join(f", {name}" for name in extra_names)
+    extra_params = ''.join(', %s' for _ in extra_values)
+
+    def merge(cursor):
+        cursor.execute(f"SELECT count(*) FROM {staging} s WHERE NOT EXISTS "
+                       f"(SELECT 1 FROM {user_table} u WHERE u.username = s.username)")
+        stats.unknown += cursor.fetchone()[0]
+        cursor.execute(
+            f"INSERT INTO {device_table} ({quote('user_id')}, {quote('device_id')}, {quote('device_password')}"
+            f"{extra_names}) SELECT u.id, s.device_key, s.device_password{extra_params} "
+            f"FROM {staging} s JOIN {user_table} u ON u.username = s.username "
+            f"WHERE true ON CONFLICT ({quote('device_id')}) DO NOTHING", extra_values)
+        stats.inserted += cursor.rowcount
+
+    return _run(device_rows(records, stats, username), columns, merge, stats, batch_size)
@@ -0,0 +1,101 @@
+"""
+Compact, column-oriented encoding of track histories.
+
+``device_history_data?format=compact`` returns one string per column instead
+of one object per point. Each column is quantised to integers. The integers
+are delta-encoded, zig-zagged and written as variable-length base64-ish
+characters, which is the Google encoded-polyline scheme. ``path`` is a
+standard polyline at precision 6 (lat/lon interleaved), and ``time`` holds
+millisecond offsets from ``time_start``. ``dwell`` is in whole seconds (see
+device.compression). The JavaScript decoder lives in
+templates/device/track_codec.html.
+
+Responses are compressed with brotli when the client accepts it and the
+optional ``brotli`` package is installed, otherwise with gzip.
+"""
+import gzip
+
+import numpy as np
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+PRECISION = 6
+SCALES = {'speed': 10, 'heading': 1, 'altitude': 1, 'charge': 1, 'dwell': 1}
+POWER_SOURCES = ['battery', 'direct']
+MIN_COMPRESS_SIZE = 200
+
+
+def encode_ints(integers):
+    """Polyline-encode a sequence of signed integers."""
+    integers = np.asarray(integers, dtype=np.int64)
+    if not integers.size:
+        return ''
+    zigzag = ((integers << 1) ^ (integers >> 63)).astype(np.uint64)
+    # Up to 13 five-bit groups per value, least significant first; all but the last get the 0x20 continuation bit
+    groups = np.stack([(zigzag >> np.uint64(5 * k)) & np.uint64(31) for k in range(13)], axis=1).astype(np.uint8)
+    lengths = np.maximum(1, (np.floor(np.log2(np.maximum(zigzag, 1).astype(np.float64))).astype(np.int64) + 5) // 5)
+    lengths[zigzag == 0] = 1
+    index = np.arange(13)
+    groups[index < (lengths[:, None] - 1)] |= 0x20
+    return (groups[index < lengths[:, None]] + 63).tobytes().decode('ascii')
+
+
+def encode_deltas(values):
+    """Polyline-encode integer values as the differences between consecutive ones."""
+    return encode_ints(np.diff(np.asarray(values, dtype=np.int64), prepend=0))
+
+
+def decode_deltas(text):
+    """Inverse of encode_deltas, for tests and tooling."""
+    values, value, shift, result = [], 0, 0, 0
+    for char in text.encode('ascii'):
+        chunk = char - 63
+        result |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            value += ~(result >> 1) if result & 1 else result >> 1
+            values.append(value)
+            shift = result = 0
+    return values
+
+
+def compact_history(points):
+    """The compact columns for points (any objects with DeviceData's attributes), keeping their order."""
+    rows = [(point.timestamp.timestamp(), point.latitude, point.longitude, point.speed, point.heading, point.altitude,
+             point.charge, getattr(point, 'dwell', 0), point.power_source == 'direct') for point in points]
+    columns = np.array(rows, dtype=np.float64).reshape(-1, 9).T
+    epoch_ms = np.rint(columns[0] * 1000).astype(np.int64)
+    start = int(epoch_ms[0]) if epoch_ms.size else 0
+    coordinates = np.rint(columns[1:3].T * 10 ** PRECISION).astype(np.int64)
+    return {
+        'format': 'compact',
+        'precision': PRECISION,
+        'scales': SCALES,
+        'power_sources': POWER_SOURCES,
+        'time_start': start,
+        'time': encode_deltas(epoch_ms - start),
+        'path': encode_ints(np.diff(coordinates, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()),
+        **{name: encode_deltas(np.rint(column * SCALES[name])) for name, column in zip(SCALES, columns[3:8])},
+        'power_source': encode_deltas(columns[8]),
+    }
+
+
+def compress_response(request, response):
+    """Brotli or gzip the response body according to Accept-Encoding."""
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if response.streaming or response.has_header('Content-Encoding') or len(response.content) < MIN_COMPRESS_SIZE:
+        return response
+    accepted = {part.split(';')[0].strip() for part in request.META.get('HTTP_ACCEPT_ENCODING', '').lower().split(',')}
+    if brotli and 'br' in accepted:
+        response.content, encoding = brotli.compress(response.content, quality=5), 'br'
+    elif 'gzip' in accepted:
+        response.content, encoding = gzip.compress(response.content, compresslevel=6, mtime=0), 'gzip'
+    else:
+        return response
+    response['Content-Encoding'] = encoding
+    response['Content-Length'] = str(len(response.content))
+    return response
@@ -0,0 +1,58 @@
+"""
+Ingest-time trajectory compression with a bounded error.
+
+A device with ``compression_tolerance`` > 0 only stores a reading when it is
+more than that many metres from where the last stored point (the anchor)
+predicts it to be. A slow anchor (below GPS_COMPRESSION_STATIONARY_SPEED km/h)
+predicts that the device stays put, and a moving anchor dead-reckons along
+its speed and heading. ``position_at`` applies the same rule when a track is
+reconstructed, so every dropped reading lies within the tolerance of its
+reconstructed position. A reading is always stored when the anchor is older
+than GPS_COMPRESSION_MAX_GAP seconds, so stored history never goes silent for
+longer than that.
+
+A stationary run collapses into its first point, whose ``dwell`` is the number
+of seconds the device stayed within the tolerance of it.
+
+Readers only ever see stored points. device_history_data returns each one
+with its ``dwell`` (in both formats), and a position between two stored
+points is ``position_at(earlier point, timestamp)``, within the tolerance of
+what the device reported.
+
+Dropped readings still update the last-known state and still go through the
+speed, notification and maintenance rules. The odometer is carried through
+them, so distances between stored points stay exact. Rollups count stored
+points only, the same set ``rebuild_rollups`` reads back.
+"""
+from django.conf import settings
+
+from device import geodesy
+
+
+def anchor_of(latest):
+    """The last stored point behind a device's latest state (the state itself if it was stored)."""
+    return getattr(latest, 'anchor', None) or latest
+
+
+def is_stationary(anchor, stationary_speed=None):
+    if stationary_speed is None:
+        stationary_speed = getattr(settings, 'GPS_COMPRESSION_STATIONARY_SPEED', 5)
+    return anchor.speed < stationary_speed
+
+
+def position_at(anchor, timestamp, stationary_speed=None):
+    """(latitude, longitude) predicted for timestamp from a stored point."""
+    if is_stationary(anchor, stationary_speed):
+        return anchor.latitude, anchor.longitude
+    distance = anchor.speed / 3.6 * (timestamp - anchor.timestamp).total_seconds()
+    return geodesy.destination(anchor.latitude, anchor.longitude, anchor.heading, distance)
+
+
+def keep(anchor, point, tolerance, max_gap=None):
+    """Whether point must be stored, given the anchor it would otherwise be reconstructed from."""
+    if max_gap is None:
+        max_gap = getattr(settings, 'GPS_COMPRESSION_MAX_GAP', 300)
+    if max_gap and (point.timestamp - anchor.timestamp).total_seconds() > max_gap:
+        return True
+    latitude, longitude = position_at(anchor, point.timestamp)
+    return geodesy.haversine(latitude, longitude, point.latitude, point.longitude) > tolerance
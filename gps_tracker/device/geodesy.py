@@ -0,0 +1,94 @@
+"""
+Great-circle helpers shared by ingest and the analytics views.
+
+Distances are in metres, bearings in degrees clockwise from north and
+speeds in km/h. The scalar functions use ``math`` for per-reading ingest.
+The ``*_array`` functions and the track helpers take NumPy arrays and cover a
+whole track in one vectorised pass, for the analytics views and
+backfill_odometer; they agree with the scalar functions point by point.
+"""
+from math import radians, sin, cos, sqrt, atan2, asin, degrees
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
+    return EARTH_RADIUS_M * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    dlon = lon2 - lon1
+    y = sin(dlon) * cos(lat2)
+    x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon)
+    return (degrees(atan2(y, x)) + 360) % 360
+
+
+def destination(lat, lon, bearing_deg, distance):
+    """Point reached by travelling distance metres from (lat, lon) on the given initial bearing."""
+    lat, lon, theta = radians(lat), radians(lon), radians(bearing_deg)
+    delta = distance / EARTH_RADIUS_M
+    lat2 = asin(sin(lat) * cos(delta) + cos(lat) * sin(delta) * cos(theta))
+    lon2 = lon + atan2(sin(theta) * sin(delta) * cos(lat), cos(delta) - sin(lat) * sin(lat2))
+    return degrees(lat2), (degrees(lon2) + 540) % 360 - 180
+
+
+def haversine_array(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_M * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def bearing_array(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, lon1, lat2, lon2))
+    dlon = lon2 - lon1
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(y, x)) + 360) % 360
+
+
+def segment_distances(lat, lon):
+    """Metres between consecutive points; one element shorter than the track."""
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    if lat.size < 2:
+        return np.zeros(0)
+    return haversine_array(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def segment_bearings(lat, lon):
+    """Initial bearing of each segment, as calculate_heading gives it."""
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    if lat.size < 2:
+        return np.zeros(0)
+    return bearing_array(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def segment_speeds(lat, lon, seconds):
+    """km/h over each segment, 0 where the time step is not positive, as calculate_speed gives it."""
+    distances = segment_distances(lat, lon)
+    elapsed = np.diff(np.asarray(seconds, dtype=float))
+    speeds = np.zeros_like(distances)
+    moving = elapsed > 0
+    speeds[moving] = distances[moving] / elapsed[moving] * 3.6
+    return speeds
+
+
+def cumulative_distance(lat, lon):
+    """Odometer in metres at every point, starting from 0 at the first."""
+    distances = segment_distances(lat, lon)
+    return np.concatenate(([0.0], np.cumsum(distances))) if np.asarray(lat).size else np.zeros(0)
+
+
+def track_arrays(data_points):
+    """(lat, lon, epoch seconds) arrays for a DeviceData queryset, without building model instances."""
+    rows = list(data_points.values_list('latitude', 'longitude', 'timestamp'))
+    lat = np.fromiter((row[0] for row in rows), dtype=float, count=len(rows))
+    lon = np.fromiter((row[1] for row in rows), dtype=float, count=len(rows))
+    seconds = np.fromiter((row[2].timestamp() for row in rows), dtype=float, count=len(rows))
+    return lat, lon, seconds
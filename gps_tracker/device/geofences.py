@@ -0,0 +1,231 @@
+"""
+User-defined geofences evaluated at ingest.
+
+A Geofence is a circle (centre and radius in metres) or a polygon (a list of
+[latitude, longitude] vertices that must not straddle the antimeridian). It
+watches the devices its owner owns or has been shared, or only the ones
+listed in ``devices``. A device entering or leaving a fence, or staying in it
+for ``dwell_seconds``, raises a Notification for the fence's owner.
+GeofenceState rows record which devices are inside which fences.
+
+Fence bounding boxes are indexed on the geohash grid (device.spatial). Each
+fence is registered at the finest precision, up to GPS_GEOFENCE_PRECISION,
+at which its bbox touches at most MAX_CELLS cells. A point is looked up with
+one dict access per precision in use, so the cost of a reading depends on
+how many fences overlap it, not on how many fences exist. The index is
+rebuilt when a fence is added, edited or deleted, which is checked at most
+every GPS_GEOFENCE_REFRESH_INTERVAL seconds.
+"""
+import math
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from device import geodesy, spatial
+from device.models import DeviceShare, Geofence, GeofenceState, Notification
+
+MAX_CELLS = 4
+MAX_DWELL_SECONDS = 365 * 24 * 3600
+
+
+class Fence:
+    """The parts of a Geofence that evaluation needs."""
+    __slots__ = ('id', 'user_id', 'name', 'kind', 'latitude', 'longitude', 'radius', 'vertices', 'dwell_seconds',
+                 'device_ids', 'bbox')
+
+    def __init__(self, geofence, device_ids=None):
+        self.id = geofence.pk
+        self.user_id = geofence.user_id
+        self.name = geofence.name
+        self.kind = geofence.kind
+        self.latitude = geofence.latitude
+        self.longitude = geofence.longitude
+        self.radius = geofence.radius
+        self.vertices = [(float(latitude), float(longitude)) for latitude, longitude in geofence.vertices or []]
+        self.dwell_seconds = geofence.dwell_seconds
+        self.device_ids = device_ids or None
+        if self.kind == 'circle':
+            self.bbox = spatial.radius_bbox(self.latitude, self.longitude, self.radius)
+        else:
+            latitudes = [latitude for latitude, _ in self.vertices]
+            longitudes = [longitude for _, longitude in self.vertices]
+            self.bbox = (min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+
+    def contains(self, latitude, longitude):
+        if not spatial.inside_bbox(latitude, longitude, *self.bbox):
+            return False
+        if self.kind == 'circle':
+            return geodesy.haversine(self.latitude, self.longitude, latitude, longitude) <= self.radius
+        # Ray casting on the latitude/longitude plane
+        inside = False
+        previous_latitude, previous_longitude = self.vertices[-1]
+        for vertex_latitude, vertex_longitude in self.vertices:
+            if (vertex_latitude > latitude) != (previous_latitude > latitude):
+                crossing = vertex_longitude + (latitude - vertex_latitude) * (previous_longitude - vertex_longitude) / (
+                    previous_latitude - vertex_latitude)
+                if longitude < crossing:
+                    inside = not inside
+            previous_latitude, previous_longitude = vertex_latitude, vertex_longitude
+        return inside
+
+    def watches(self, device_pk, viewers):
+        """Whether the fence applies to a device, given the users who can see the device."""
+        if self.device_ids is not None:
+            return device_pk in self.device_ids and self.user_id in viewers
+        return self.user_id in viewers
+
+
+def crosses_antimeridian(vertices):
+    """Whether a polygon edge spans more than 180 degrees of longitude, i.e. is meant to cross the antimeridian."""
+    return any(abs(vertices[i][1] - vertices[i - 1][1]) > 180 for i in range(len(vertices)))
+
+
+def is_valid(geofence):
+    if geofence.kind == 'circle':
+        return (geofence.latitude is not None and geofence.longitude is not None and 0 < geofence.radius < math.inf
+                and -90 <= geofence.latitude <= 90 and -180 <= geofence.longitude <= 180)
+    vertices = geofence.vertices or []
+    return (len(vertices) >= 3 and all(-90 <= latitude <= 90 and -180 <= longitude <= 180 for latitude, longitude in vertices)
+            and not crosses_antimeridian(vertices))
+
+
+class FenceIndex:
+    """Active fences by geohash cell of their bounding boxes; ``levels`` maps precision -> {cell: [Fence]}."""
+
+    def __init__(self, precision=None, clock=time.time):
+        self.precision = precision or getattr(settings, 'GPS_GEOFENCE_PRECISION', 6)
+        self.clock = clock
+        self.fences = {}
+        self.levels = {}
+        self.version = None
+        self.next_check = 0
+
+    def __len__(self):
+        return len(self.fences)
+
+    def add(self, fence):
+        self.fences[fence.id] = fence
+        precision = self.precision
+        ranges = spatial.cell_ranges(*fence.bbox, precision)
+        while precision > 1 and spatial.range_size(ranges) > MAX_CELLS:
+            precision -= 1
+            ranges = spatial.cell_ranges(*fence.bbox, precision)
+        cells = self.levels.setdefault(precision, {})
+        for first_row, last_row, first_col, last_col in ranges:
+            for row in range(first_row, last_row + 1):
+                for col in range(first_col, last_col + 1):
+                    cells.setdefault((row, col), []).append(fence)
+
+    def containing(self, latitude, longitude):
+        """Fences that contain the point."""
+        found = []
+        for precision, cells in self.levels.items():
+            for fence in cells.get(spatial.cell_of(latitude, longitude, precision), ()):
+                if fence.contains(latitude, longitude):
+                    found.append(fence)
+        return found
+
+    @staticmethod
+    def current_version():
+        return tuple(Geofence.objects.aggregate(count=Count('pk'), updated=Max('updated_at')).values())
+
+    def load(self):
+        """Rebuild from the active Geofence rows."""
+        version = self.current_version()
+        watched = defaultdict(set)
+        for fence_id, device_id in Geofence.devices.through.objects.filter(geofence__active=True).values_list(
+                'geofence_id', 'device_id'):
+            watched[fence_id].add(device_id)
+        index = FenceIndex(self.precision, self.clock)
+        for geofence in Geofence.objects.filter(active=True):
+            if is_valid(geofence):
+                index.add(Fence(geofence, watched.get(geofence.pk)))
+        # Swap in whole so concurrent lookups never see a half-built index
+        self.fences, self.levels, self.version = index.fences, index.levels, version
+        self.next_check = self.clock() + getattr(settings, 'GPS_GEOFENCE_REFRESH_INTERVAL', 10)
+        return len(self.fences)
+
+    def refresh(self, now=None):
+        """Reload if fences changed since the last load; checked at most once per refresh interval."""
+        now = self.clock() if now is None else now
+        if now < self.next_check:
+            return
+        self.next_check = now + getattr(settings, 'GPS_GEOFENCE_REFRESH_INTERVAL', 10)
+        if self.current_version() != self.version:
+            self.load()
+
+
+_index = None
+
+
+def get_fence_index():
+    """Process-wide index, loaded on first use."""
+    global _index
+    if _index is None:
+        index = FenceIndex()
+        index.load()
+        _index = index
+    else:
+        _index.refresh()
+    return _index
+
+
+def evaluate(readings, index=None):
+    """
+    Enter, exit and dwell Notifications (unsaved) for (device, point) pairs
+    given in time order, for any mix of devices. GeofenceState is updated
+    with one query per kind of change; call it inside the transaction that
+    stores the points.
+    """
+    readings = list(readings)
+    index = get_fence_index() if index is None else index
+    if not readings or not index:
+        return []
+    device_pks = {device.pk for device, _ in readings}
+    viewers = {device.pk: {device.user_id} for device, _ in readings}
+    for device_id, user_id in DeviceShare.objects.filter(device_id__in=device_pks).values_list('device_id', 'shared_with_id'):
+        viewers[device_id].add(user_id)
+    states = {(state.device_id, state.geofence_id): state
+              for state in GeofenceState.objects.filter(device_id__in=device_pks)}
+    inside = defaultdict(set)
+    for device_pk, fence_id in states:
+        inside[device_pk].add(fence_id)
+    departed, dwelled, notifications = [], set(), []
+    for device, point in readings:
+        latitude, longitude, timestamp = point.latitude, point.longitude, point.timestamp
+        current = {fence.id for fence in index.containing(latitude, longitude)
+                   if fence.watches(device.pk, viewers[device.pk])}
+        for fence_id in current - inside[device.pk]:
+            fence = index.fences[fence_id]
+            states[device.pk, fence_id] = GeofenceState(device=device, geofence_id=fence_id, entered_at=timestamp)
+            notifications.append(Notification(device=device, user_id=fence.user_id, timestamp=timezone.now(),
+                                              message=f"Entered geofence {fence.name}"))
+        for fence_id in inside[device.pk] - current:
+            state = states.pop((device.pk, fence_id))
+            if state.pk:
+                departed.append(state.pk)
+            fence = index.fences.get(fence_id)
+            if fence is not None:
+                # Fences that were deactivated or became invalid are left silently
+                minutes = max((timestamp - state.entered_at).total_seconds(), 0) / 60
+                notifications.append(Notification(device=device, user_id=fence.user_id, timestamp=timezone.now(),
+                                                  message=f"Left geofence {fence.name} after {minutes:.1f} minutes"))
+        for fence_id in current & inside[device.pk]:
+            fence, state = index.fences[fence_id], states[device.pk, fence_id]
+            seconds = (timestamp - state.entered_at).total_seconds()
+            if fence.dwell_seconds and not state.dwell_notified and seconds >= fence.dwell_seconds:
+                state.dwell_notified = True
+                dwelled.add((device.pk, fence_id))
+                notifications.append(Notification(device=device, user_id=fence.user_id, timestamp=timezone.now(),
+                                                  message=f"In geofence {fence.name} for {seconds / 60:.1f} minutes"))
+        inside[device.pk] = current
+    if departed:
+        GeofenceState.objects.filter(pk__in=departed).delete()
+    GeofenceState.objects.bulk_create([state for state in states.values() if state.pk is None], ignore_conflicts=True)
+    dwelled = [states[key].pk for key in dwelled if key in states and states[key].pk]
+    if dwelled:
+        GeofenceState.objects.filter(pk__in=dwelled).update(dwell_notified=True)
+    return notifications
@@ -0,0 +1,122 @@
+import logging
+import random
+import time
+from collections import deque
+
+from django.conf import settings
+
+from device.geodesy import haversine
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class DeviceHealth:
+    __slots__ = ('failures', 'state', 'hold_until', 'recent')
+
+    def __init__(self, history):
+        self.failures = 0
+        self.state = CLOSED
+        self.hold_until = 0
+        self.recent = deque(maxlen=history)
+
+
+class PollHealth:
+    """
+    Per-device poll health for the fetch commands.
+
+    Each failed poll backs the device off exponentially from ``base_backoff``
+    up to ``max_backoff`` seconds (with a little jitter so dead devices do not
+    retry in lockstep). After ``failure_threshold`` consecutive failures the
+    circuit opens and the device is left alone for ``open_interval`` seconds;
+    the next poll is a half-open trial that closes the circuit on success and
+    reopens it on failure. A device whose last ``history`` points lie within
+    ``stationary_radius`` metres is polled at most every
+    ``stationary_interval`` seconds until it moves again.
+    """
+
+    def __init__(self, failure_threshold=5, base_backoff=4, max_backoff=300, open_interval=600,
+                 stationary_interval=30, stationary_radius=25, history=3, jitter=0.1, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.open_interval = open_interval
+        self.stationary_interval = stationary_interval
+        self.stationary_radius = stationary_radius
+        self.history = history
+        self.jitter = jitter
+        self.clock = clock
+        self.devices = {}
+
+    def get(self, device_pk):
+        health = self.devices.get(device_pk)
+        if health is None:
+            health = self.devices[device_pk] = DeviceHealth(self.history)
+        return health
+
+    def forget(self, device_pk):
+        self.devices.pop(device_pk, None)
+
+    def allow(self, device_pk, now=None):
+        """Whether the device may be polled now; an open circuit past its hold turns half-open."""
+        now = self.clock() if now is None else now
+        health = self.devices.get(device_pk)
+        if health is None or now >= health.hold_until:
+            if health is not None and health.state == OPEN:
+                health.state = HALF_OPEN
+            return True
+        return False
+
+    def record(self, device, reading=None, now=None):
+        """
+        Note the outcome of a poll (reading is None if it failed) and return
+        the earliest time the device should be polled again.
+        """
+        now = self.clock() if now is None else now
+        health = self.get(device.pk)
+        if reading is None:
+            health.failures += 1
+            if health.state == HALF_OPEN or health.failures >= self.failure_threshold:
+                if health.state != OPEN:
+                    logger.warning(f"Circuit open for {device.device_id} after {health.failures} failed polls")
+                health.state = OPEN
+                delay = self.open_interval
+            else:
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (health.failures - 1))
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        else:
+            if health.state != CLOSED:
+                logger.info(f"Circuit closed for {device.device_id}")
+            health.failures = 0
+            health.state = CLOSED
+            health.recent.append((reading['latitude'], reading['longitude']))
+            delay = self.stationary_interval if self.is_stationary(health) else 0
+        health.hold_until = now + delay
+        return health.hold_until
+
+    def is_stationary(self, health):
+        if len(health.recent) < self.history:
+            return False
+        latitude, longitude = health.recent[-1]
+        return all(haversine(latitude, longitude, lat, lon) <= self.stationary_radius for lat, lon in health.recent)
+
+    def summary(self):
+        states = [health.state for health in self.devices.values()]
+        stationary = sum(1 for health in self.devices.values() if health.state == CLOSED and self.is_stationary(health))
+        return {
+            'open': states.count(OPEN),
+            'half_open': states.count(HALF_OPEN),
+            'backing_off': sum(1 for health in self.devices.values() if health.state == CLOSED and health.failures),
+            'stationary': stationary,
+        }
+
+
+def health_from_settings():
+    return PollHealth(
+        failure_threshold=getattr(settings, 'GPS_CIRCUIT_FAILURE_THRESHOLD', 5),
+        max_backoff=getattr(settings, 'GPS_MAX_BACKOFF', 300),
+        open_interval=getattr(settings, 'GPS_CIRCUIT_OPEN_INTERVAL', 600),
+        stationary_interval=getattr(settings, 'GPS_STATIONARY_POLL_INTERVAL', 30),
+        stationary_radius=getattr(settings, 'GPS_STATIONARY_RADIUS', 25),
+    )
@@ -0,0 +1,168 @@
+import json
+import logging
+import math
+from datetime import datetime, timezone as dt_timezone
+
+import msgpack
+from django.db import DatabaseError, connection
+
+from device import archive
+from device.models import Device, DeviceData, DeviceShare
+from device.utils import parse_timestamp, store_readings
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+POWER_SOURCES = {choice for choice, _ in DeviceData._meta.get_field('power_source').choices}
+
+logger = logging.getLogger(__name__)
+
+
+class TooManyItems(Exception):
+    """The upload has more readings than one request may carry."""
+
+
+def parse_reading(item, device):
+    """
+    Turn one uploaded reading (the save_device_data body) into
+    process_device_data kwargs. Raises ValueError with a client-facing message.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Reading must be an object")
+    location = item.get('location')
+    if not isinstance(location, dict) or not all(key in item for key in ('charge', 'timestamp', 'power_source')) \
+            or not all(key in location for key in ('latitude', 'longitude')):
+        raise ValueError("Missing required fields")
+    try:
+        reading = {
+            'device': device,
+            'latitude': float(location['latitude']),
+            'longitude': float(location['longitude']),
+            'altitude': float(location.get('altitude', 0)),
+            'speed': float(item.get('speed', 0)),
+            'heading': float(item.get('heading', 0)),
+            'charge': int(item['charge']),
+            'power_source': str(item['power_source']),
+        }
+    except (ValueError, TypeError, OverflowError) as e:
+        raise ValueError(f"Invalid data types: {str(e)}")
+    if not all(math.isfinite(reading[key]) for key in ('altitude', 'speed', 'heading')):
+        raise ValueError("altitude, speed and heading must be finite")
+    if not 0 <= reading['charge'] <= 100:
+        raise ValueError("Charge out of range")
+    if reading['power_source'] not in POWER_SOURCES:
+        raise ValueError(f"power_source must be one of {', '.join(sorted(POWER_SOURCES))}")
+    raw_timestamp = item['timestamp']
+    if isinstance(raw_timestamp, datetime):
+        timestamp = raw_timestamp
+    elif isinstance(raw_timestamp, (int, float)):
+        try:
+            timestamp = datetime.fromtimestamp(raw_timestamp, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError("Timestamp out of range")
+    else:
+        timestamp = parse_timestamp(raw_timestamp)
+    if not timestamp or timestamp.tzinfo is None:
+        raise ValueError("Invalid timestamp format")
+    if not (-90 <= reading['latitude'] <= 90 and -180 <= reading['longitude'] <= 180):
+        raise ValueError("Coordinates out of range")
+    reading['timestamp'] = timestamp
+    return reading
+
+
+def decode_items(request):
+    """
+    Yield uploaded readings from a JSON array (or {"readings": [...]}), an
+    NDJSON stream read line by line, or a msgpack body of the same shape.
+    Raises ValueError for an undecodable body.
+    """
+    content_type = request.content_type
+    if content_type in NDJSON_TYPES:
+        for line in request:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+        return
+    body = request.read()
+    if content_type in MSGPACK_TYPES:
+        payload = msgpack.unpackb(body, raw=False, timestamp=3)
+    else:
+        payload = json.loads(body)
+    if isinstance(payload, dict):
+        payload = payload.get('readings')
+    if not isinstance(payload, list):
+        raise ValueError("Body must be a list of readings or {\"readings\": [...]}")
+    yield from payload
+
+
+def ingest_items(items, user, max_items=None):
+    """
+    Validate and store uploaded readings for any devices the user owns or has
+    shared with them. Returns one {"status": ...} result per item, in order,
+    and raises TooManyItems if there are more than max_items. Devices,
+    permissions, duplicates and archived days are checked with one query each
+    and accepted readings are written through store_readings, one at a time if
+    the database refuses the batch. A repeated upload reports the duplicates
+    as errors but writes nothing twice.
+    """
+    items = list(items)
+    if max_items and len(items) > max_items:
+        raise TooManyItems(f"At most {max_items} readings per request")
+    device_ids = {item.get('device_id') for item in items
+                  if isinstance(item, dict) and isinstance(item.get('device_id'), str)}
+    devices = {device.device_id: device for device in Device.objects.filter(device_id__in=device_ids)}
+    shared = set(DeviceShare.objects.filter(shared_with=user, device__device_id__in=device_ids)
+                 .values_list('device_id', flat=True))
+
+    results = [None] * len(items)
+    accepted = []
+    for index, item in enumerate(items):
+        if isinstance(item, dict) and not isinstance(item.get('device_id'), str):
+            results[index] = {"status": "error", "message": "device_id must be a string"}
+            continue
+        device = devices.get(item['device_id']) if isinstance(item, dict) else None
+        if device is None:
+            results[index] = {"status": "error", "message": "Device not found"}
+            continue
+        if device.user_id != user.pk and device.pk not in shared:
+            results[index] = {"status": "error", "message": "Unauthorized"}
+            continue
+        try:
+            accepted.append((index, parse_reading(item, device)))
+        except ValueError as e:
+            results[index] = {"status": "error", "message": str(e)}
+
+    if accepted:
+        timestamps = [reading['timestamp'] for _, reading in accepted]
+        seen = set(DeviceData.objects.filter(
+            device_id__in={reading['device'].pk for _, reading in accepted},
+            timestamp__gte=min(timestamps), timestamp__lte=max(timestamps),
+        ).values_list('device_id', 'timestamp'))
+        horizons = archive.horizons({reading['device'].pk for _, reading in accepted})
+        readings = {}
+        for index, reading in accepted:
+            key = (reading['device'].pk, reading['timestamp'])
+            if key in seen:
+                results[index] = {"status": "error", "message": "Duplicate timestamp for this device"}
+                continue
+            if horizons.get(key[0]) and key[1] <= horizons[key[0]]:
+                results[index] = {"status": "error", "message": "Timestamp is in the device's archived history"}
+                continue
+            seen.add(key)
+            readings[index] = reading
+            results[index] = {"status": "ok"}
+        # Backlogs are often uploaded newest-first; store_readings derives speed and
+        # heading in time order and slots points older than the latest into place.
+        try:
+            store_readings(list(readings.values()))
+        except (DatabaseError, OverflowError) as e:
+            # A reading the database refuses must not cost the rest of the upload; an
+            # unreachable database still fails the request
+            logger.error(f"Batch ingest of {len(readings)} readings failed, retrying one by one: {str(e)}")
+            connection.ensure_connection()
+            for index, reading in readings.items():
+                try:
+                    store_readings([reading])
+                except (DatabaseError, OverflowError) as e:
+                    logger.error(f"Could not store reading for {reading['device'].device_id}: {str(e)}")
+                    results[index] = {"status": "error", "message": "Reading could not be stored"}
+    return results
@@ -0,0 +1,316 @@
+"""
+Push listener for trackers that report over raw TCP or UDP instead of HTTP.
+
+Wire protocol (ASCII, comma separated):
+
+    reading = timestamp,latitude,longitude,altitude,charge,power_source[,speed,heading]
+
+``timestamp`` is epoch seconds or an ISO 8601 string with an offset.
+
+TCP: the first frame of a connection is ``device_id,device_password``. The
+server answers ``OK`` or ``ERR auth`` (and hangs up), after which every frame
+is a reading. Frames are newline terminated, or, when the first byte of the
+connection is 0x00, prefixed with a 2-byte big-endian length.
+
+UDP: each datagram holds one or more newline separated
+``device_id,device_password,reading`` lines.
+"""
+import asyncio
+import hmac
+import logging
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import close_old_connections
+
+from device.models import Device
+from device.reorder import ReorderBuffer
+from device.utils import parse_timestamp, save_readings
+
+logger = logging.getLogger(__name__)
+
+MAX_LINE = 1024
+
+
+def parse_reading(device, fields):
+    """process_device_data kwargs for the reading fields of one frame; raises ValueError."""
+    if len(fields) not in (6, 8):
+        raise ValueError(f"expected 6 or 8 reading fields, got {len(fields)}")
+    raw_timestamp = fields[0].strip()
+    try:
+        timestamp = datetime.fromtimestamp(float(raw_timestamp), tz=dt_timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        timestamp = parse_timestamp(raw_timestamp)
+    if not timestamp or timestamp.tzinfo is None:
+        raise ValueError(f"invalid timestamp {raw_timestamp!r}")
+    latitude, longitude = float(fields[1]), float(fields[2])
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("coordinates out of range")
+    reading = {
+        'device': device,
+        'latitude': latitude,
+        'longitude': longitude,
+        'altitude': float(fields[3] or 0),
+        'charge': int(fields[4]),
+        'power_source': fields[5].strip(),
+        'timestamp': timestamp,
+    }
+    if len(fields) == 8:
+        reading['speed'] = float(fields[6] or 0)
+        reading['heading'] = float(fields[7] or 0)
+    return reading
+
+
+class DeviceDirectory:
+    """
+    In-memory device_id -> Device table used to authenticate frames without a
+    query per connection. It is reloaded in one query every ``refresh_interval``
+    seconds, so new devices and password changes show up after at most that long.
+    """
+
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self.devices = {}
+
+    def refresh(self):
+        close_old_connections()
+        self.devices = {device.device_id: device for device in Device.objects.all()}
+        return len(self.devices)
+
+    def authenticate(self, device_id, password):
+        device = self.devices.get(device_id)
+        if device is None or not hmac.compare_digest(device.device_password.encode(), password.encode()):
+            return None
+        return device
+
+
+def write_readings(readings):
+    """Save a batch of readings; returns False if the database is unavailable and the batch should be retried."""
+    close_old_connections()
+    try:
+        saved = save_readings(readings)
+    except Exception as e:
+        logger.error(f"Could not save {len(readings)} pushed readings, database unavailable: {str(e)}")
+        return False
+    logger.info(f"Saved {saved} of {len(readings)} pushed readings")
+    return True
+
+
+class ReadingBatcher:
+    """
+    Collects readings from every connection and writes them with write_readings
+    once ``batch_size`` are pending or the oldest is ``max_age`` seconds old.
+    Writes run one at a time on a dedicated thread so the event loop never
+    blocks on the database. TCP transports are paused while more than
+    ``max_pending`` readings are waiting and UDP readings are dropped. With a
+    ``reorder_window`` readings pass through a ReorderBuffer before writing.
+
+    While the database is unavailable, readings that could not be written are
+    kept and retried every ``retry_delay`` seconds, ahead of newer ones. They
+    count as waiting, so the connections are held back instead of losing them.
+    """
+
+    def __init__(self, batch_size=500, max_age=1.0, max_pending=50000, reorder_window=0, retry_delay=5.0):
+        self.reorder = ReorderBuffer(reorder_window) if reorder_window else None
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.pending = []
+        self.failed = []  # released readings whose write failed, oldest first
+        self.retry_at = 0
+        self.oldest = None
+        self.paused = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gps-writer')
+        self.wakeup = asyncio.Event()
+
+    @property
+    def full(self):
+        return len(self.pending) + len(self.failed) >= self.max_pending
+
+    def add(self, reading):
+        if not self.pending:
+            self.oldest = time.monotonic()
+        self.pending.append(reading)
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def pause(self, transport):
+        transport.pause_reading()
+        self.paused.add(transport)
+
+    async def flush(self, final=False):
+        readings, self.pending, self.oldest = self.pending, [], None
+        if self.reorder is not None:
+            self.reorder.extend(readings)
+            readings = self.reorder.drain() if final else self.reorder.release()
+        readings, self.failed = self.failed + readings, []
+        for start in range(0, len(readings), self.batch_size):
+            batch = readings[start:start + self.batch_size]
+            if not await asyncio.get_running_loop().run_in_executor(self.executor, write_readings, batch):
+                self.failed = readings[start:]
+                break
+        if self.failed:
+            if final:
+                logger.error(f"Lost {len(self.failed)} pushed readings, database unavailable")
+                self.failed = []
+                return
+            self.retry_at = time.monotonic() + self.retry_delay
+            if self.full:
+                return
+        for transport in self.paused:
+            if not transport.is_closing():
+                transport.resume_reading()
+        self.paused.clear()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.max_age)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if time.monotonic() < self.retry_at:
+                continue
+            if self.failed or self.pending and (len(self.pending) >= self.batch_size or
+                                                time.monotonic() - self.oldest >= self.max_age):
+                await self.flush()
+            elif self.reorder:
+                await self.flush()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class TrackerTCPProtocol(asyncio.Protocol):
+    def __init__(self, directory, batcher):
+        self.directory = directory
+        self.batcher = batcher
+        self.buffer = b''
+        self.length_prefixed = None
+        self.device = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        if self.length_prefixed is None:
+            self.length_prefixed = self.buffer[:1] == b'\x00'
+        for frame in self.frames():
+            self.frame_received(frame)
+            if self.transport.is_closing():
+                return
+        if len(self.buffer) > MAX_LINE + 2:
+            logger.warning(f"Dropping connection with oversized frame from {self.peer}")
+            self.transport.close()
+        elif self.batcher.full:
+            self.batcher.pause(self.transport)
+
+    def frames(self):
+        while True:
+            if self.length_prefixed:
+                if len(self.buffer) < 2:
+                    return
+                (size,) = struct.unpack('>H', self.buffer[:2])
+                if len(self.buffer) < 2 + size:
+                    return
+                frame, self.buffer = self.buffer[2:2 + size], self.buffer[2 + size:]
+            else:
+                frame, separator, rest = self.buffer.partition(b'\n')
+                if not separator:
+                    return
+                self.buffer = rest
+            yield frame.decode('ascii', 'replace').strip()
+
+    @property
+    def peer(self):
+        return self.transport.get_extra_info('peername')
+
+    def reply(self, message):
+        payload = message.encode()
+        if self.length_prefixed:
+            payload = struct.pack('>H', len(payload)) + payload
+        else:
+            payload += b'\n'
+        self.transport.write(payload)
+
+    def frame_received(self, frame):
+        if not frame:
+            return
+        fields = frame.split(',')
+        if self.device is None:
+            self.device = self.directory.authenticate(fields[0], fields[1]) if len(fields) == 2 else None
+            if self.device is None:
+                logger.warning(f"Rejected TCP login from {self.peer}")
+                self.reply('ERR auth')
+                self.transport.close()
+            else:
+                self.reply('OK')
+            return
+        try:
+            self.batcher.add(parse_reading(self.device, fields))
+        except ValueError as e:
+            logger.warning(f"Bad frame from {self.device.device_id}: {str(e)}")
+            self.reply(f"ERR {str(e)}")
+
+
+class TrackerUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, directory, batcher):
+        self.directory = directory
+        self.batcher = batcher
+
+    def datagram_received(self, data, addr):
+        for line in data.decode('ascii', 'replace').splitlines():
+            fields = line.strip().split(',')
+            if len(fields) < 3:
+                continue
+            device = self.directory.authenticate(fields[0], fields[1])
+            if device is None:
+                logger.warning(f"Rejected UDP reading for {fields[0]} from {addr}")
+                continue
+            if self.batcher.full:
+                logger.warning(f"Write queue full, dropping UDP reading for {device.device_id}")
+                continue
+            try:
+                self.batcher.add(parse_reading(device, fields[2:]))
+            except ValueError as e:
+                logger.warning(f"Bad datagram from {device.device_id}: {str(e)}")
+
+
+async def _refresh_forever(directory):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(directory.refresh_interval)
+        try:
+            await loop.run_in_executor(None, directory.refresh)
+        except Exception as e:
+            logger.error(f"Failed to refresh device table: {str(e)}")
+
+
+async def serve(host, tcp_port, udp_port, directory, batcher, ready=None):
+    """Run the TCP and/or UDP listeners until cancelled, flushing pending readings on the way out."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, directory.refresh)
+    servers, transports = [], []
+    if tcp_port:
+        servers.append(await loop.create_server(lambda: TrackerTCPProtocol(directory, batcher), host, tcp_port))
+    if udp_port:
+        transport, _ = await loop.create_datagram_endpoint(lambda: TrackerUDPProtocol(directory, batcher),
+                                                           local_addr=(host, udp_port))
+        transports.append(transport)
+    tasks = [asyncio.create_task(batcher.run()), asyncio.create_task(_refresh_forever(directory))]
+    if ready:
+        ready(servers, transports)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for server in servers:
+            server.close()
+        for transport in transports:
+            transport.close()
+        await batcher.flush(final=True)
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from device.models import Device
+from device import archive
+
+
+class Command(BaseCommand):
+    help = ('Move closed days of DeviceData older than the cutoff into compressed per-device, per-day files '
+            'under GPS_ARCHIVE_DIR (see device/archive.py)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=getattr(settings, 'GPS_ARCHIVE_AFTER_DAYS', 30),
+                            help='Archive whole UTC days that ended at least this many days ago (default: GPS_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--device', action='append', dest='devices', metavar='DEVICE_ID',
+                            help='Only archive this device (repeatable); default is every device')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the days that would be archived')
+
+    def handle(self, *args, **options):
+        if options['older_than_days'] < 1:
+            raise CommandError('--older-than-days must be at least 1')
+        now = datetime.now(dt_timezone.utc)
+        cutoff = datetime(now.year, now.month, now.day, tzinfo=dt_timezone.utc) - timedelta(days=options['older_than_days'])
+        devices = Device.objects.order_by('pk')
+        if options['devices']:
+            devices = devices.filter(device_id__in=options['devices'])
+        days = moved = 0
+        for device in devices:
+            for day in archive.closed_days(device, cutoff):
+                days += 1
+                if options['dry_run']:
+                    self.stdout.write(f"{device.device_id} {day}")
+                    continue
+                count = archive.archive_day(device, day)
+                moved += count
+                self.stdout.write(f"{device.device_id} {day}: {count} rows")
+        if options['dry_run']:
+            self.stdout.write(f"Would archive {days} device-days before {cutoff:%Y-%m-%d}")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Archived {moved} rows in {days} device-days before {cutoff:%Y-%m-%d}"))
@@ -1,72 +1,59 @@
-import csv
+import itertools
 from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
-from device.models import Device, DeviceData
+from django.db import transaction
+from django.utils import timezone
+from device import bulk_import, geofences
+from device.models import Device, DeviceData, Notification
+from device.utils import save_latest_points
 
-from datetime import datetime
 
 class Command(BaseCommand):
     help = 'Import 1000 devices from CSV, create 1000 users, and assign each device to a user'
 
     def handle(self, *args, **kwargs):
         csv_file = 'devices_export.csv'
-        with open(csv_file, newline='') as file:
-            reader = list(csv.DictReader(file))
+        # Only the first 1000 rows are read; the rest of the file is never loaded
+        rows = list(itertools.islice(bulk_import.open_records(csv_file, 'csv'), 1000))
 
-        if len(reader) < 1000:
+        if len(rows) < 1000:
             self.stdout.write(self.style.ERROR('CSV file must contain at least 1000 devices'))
             return
 
         # Step 1: Create 1000 users (if not already present)
+        usernames = [f'user{i}' for i in range(1, 1001)]
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
         password_hash = make_password('testpass123')
-        users_to_create = []
-        for i in range(1, 1001):
-            username = f'user{i}'
-            if not User.objects.filter(username=username).exists():
-                users_to_create.append(User(username=username, email=f'{username}@example.com', password=password_hash))
-
+        users_to_create = [User(username=username, email=f'{username}@example.com', password=password_hash)
+                           for username in usernames if username not in existing]
         User.objects.bulk_create(users_to_create)
         self.stdout.write(self.style.SUCCESS(f'Created {len(users_to_create)} users (skipped existing).'))
 
-        # Fetch all users again (existing + new) in order
-        users = list(User.objects.filter(username__regex=r'^user\d+$').order_by('username')[:1000])
-
-        # Step 2: Import devices and assign to users
-        created_devices = []
-        for i in range(1000):
-            row = reader[i]
-            device_id = row['device_id'].strip()
-            device_password = row['device_password'].strip()
-            latitude = float(row['latitude'])
-            longitude = float(row['longitude'])
-            charge = int(row['charge'])
-
-            if Device.objects.filter(device_id=device_id).exists():
-                continue  # Skip if already exists
-
-            created_devices.append(Device(
-                user=users[i],
-                device_id=device_id,
-                device_password=device_password
-            ))
+        users = User.objects.in_bulk(usernames, field_name='username')
 
-        Device.objects.bulk_create(created_devices)
+        # Step 2: Import devices and assign row i to user i+1
+        device_ids = [row['device_id'].strip() for row in rows]
+        existing = set(Device.objects.filter(device_id__in=device_ids).values_list('device_id', flat=True))
+        created_devices = [
+            Device(user=users[username], device_id=device_id, device_password=row['device_password'].strip())
+            for username, device_id, row in zip(usernames, device_ids, rows) if device_id not in existing
+        ]
+        Device.objects.bulk_create(created_devices, ignore_conflicts=True)
         self.stdout.write(self.style.SUCCESS(f'Imported {len(created_devices)} devices and assigned users.'))
 
-        # Step 3: Create one DeviceData entry per device
-        all_devices = list(Device.objects.filter(device_id__in=[r['device_id'].strip() for r in reader[:1000]]))
-        device_data = []
-        for i, device in enumerate(all_devices):
-            row = reader[i]
-            device_data.append(DeviceData(
-                device=device,
-                latitude=float(row['latitude']),
-                longitude=float(row['longitude']),
-                charge=int(row['charge']),
-                timestamp=datetime.now()
-            ))
-        DeviceData.objects.bulk_create(device_data)
+        # Step 3: Create one DeviceData entry per device, from its own row
+        devices = Device.objects.in_bulk(device_ids, field_name='device_id')
+        now = timezone.now()
+        device_data = [
+            DeviceData(device=devices[device_id], latitude=float(row['latitude']), longitude=float(row['longitude']),
+                       charge=int(row['charge']), timestamp=now)
+            for device_id, row in zip(device_ids, rows)
+        ]
+        with transaction.atomic():
+            DeviceData.objects.bulk_create(device_data, ignore_conflicts=True)
+            save_latest_points({data.device_id: data for data in device_data})
+            Notification.objects.bulk_create(geofences.evaluate((data.device, data) for data in device_data))
         self.stdout.write(self.style.SUCCESS(f'Inserted {len(device_data)} device data entries.'))
 
         self.stdout.write(self.style.SUCCESS('\n✅ Done: 1000 users + devices + data imported.'))
@@ -0,0 +1,51 @@
+import itertools
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from device import archive, geodesy
+from device.models import Device, DeviceData
+from device.utils import save_device_odometers
+
+
+class Command(BaseCommand):
+    help = ('Recompute per-point and per-device odometers of the live DeviceData after the archived days '
+            '(restart pollers afterwards)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', action='append', dest='device_ids', help='Only backfill this device_id (repeatable)')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows per bulk UPDATE')
+
+    def handle(self, *args, **options):
+        devices = Device.objects.all().order_by('pk')
+        if options['device_ids']:
+            devices = devices.filter(device_id__in=options['device_ids'])
+        chunk_size = options['chunk_size']
+        total_rows = 0
+        for device in devices.iterator():
+            # Archived odometers are sealed in their files: carry on from the last archived point
+            archived = archive.last_point(device)
+            odometer, last = (archived.odometer, (archived.latitude, archived.longitude)) if archived else (0, None)
+            points = DeviceData.objects.filter(device=device).order_by('timestamp')
+            if archived:
+                points = points.filter(timestamp__gt=archived.timestamp)
+            rows = points.values_list('pk', 'latitude', 'longitude').iterator(chunk_size=chunk_size)
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                pks, lat, lon = zip(*chunk)
+                # The chunk's odometers carry on from the last point of the previous chunk
+                if last:
+                    lat, lon = (last[0], *lat), (last[1], *lon)
+                odometers = odometer + geodesy.cumulative_distance(np.array(lat), np.array(lon))
+                if last:
+                    odometers = odometers[1:]
+                odometer, last = float(odometers[-1]), (lat[-1], lon[-1])
+                with transaction.atomic():
+                    DeviceData.objects.bulk_update(
+                        [DeviceData(pk=pk, odometer=float(value)) for pk, value in zip(pks, odometers)], ['odometer'])
+                total_rows += len(chunk)
+            save_device_odometers({device.pk: odometer})
+            self.stdout.write(f"{device.device_id}: {odometer / 1000:.2f} km")
+        self.stdout.write(self.style.SUCCESS(f"Backfilled odometer on {total_rows} DeviceData rows"))
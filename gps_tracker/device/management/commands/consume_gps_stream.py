@@ -0,0 +1,58 @@
+import time
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from device.metrics import start_exporter
+from django.db import InterfaceError, OperationalError, close_old_connections
+from device.redis_client import get_redis_client
+from device.streams import StreamConsumer
+from device.utils import save_readings
+
+class Command(BaseCommand):
+    help = 'Write readings queued on the gps:readings Redis Stream (fetch_gps --stream) to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--redis-url', help='Redis URL, overriding REDIS_URL/REDIS_HOST settings; must be the Redis the producers use')
+        parser.add_argument('--consumer', help='Stable consumer name within the group (default: host:pid)')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'GPS_STREAM_BATCH_SIZE', 500),
+                            help='Entries read, written and acknowledged together')
+        parser.add_argument('--claim-idle', type=float, default=getattr(settings, 'GPS_STREAM_CLAIM_IDLE', 60),
+                            help='Seconds an entry may stay unacknowledged before another consumer takes it over')
+        parser.add_argument('--once', action='store_true', help='Exit once the stream has no more entries')
+
+    def handle(self, *args, **options):
+        consumer = StreamConsumer(
+            get_redis_client(options['redis_url']),
+            consumer=options['consumer'],
+            batch_size=options['batch_size'],
+            block=0.1 if options['once'] else 5,
+            claim_idle=options['claim_idle'],
+        )
+        consumer.ensure_group()
+        start_exporter()
+        self.stdout.write(f"Consuming {consumer.stream} as {consumer.consumer} in group {consumer.group}")
+        entries = []
+        while True:
+            if not entries:
+                entries = consumer.read()
+            if not entries:
+                if options['once']:
+                    return
+                continue
+            close_old_connections()
+            try:
+                saved = consumer.process(entries, save_readings)
+            except (OperationalError, InterfaceError) as e:
+                # Database unavailable: keep the batch and retry it, reading and claiming nothing
+                # meanwhile, so an outage is not counted as deliveries that failed.
+                self.stdout.write(self.style.ERROR(f"Database unavailable, holding {len(entries)} stream entries: {str(e)}"))
+                consumer.hold([entry_id for entry_id, _ in entries])
+                time.sleep(1)
+                continue
+            except Exception as e:
+                # Left unacknowledged; claimed again after --claim-idle.
+                self.stdout.write(self.style.ERROR(f"Error saving {len(entries)} stream entries: {str(e)}"))
+                entries = []
+                time.sleep(1)
+                continue
+            self.stdout.write(self.style.SUCCESS(f"Saved {saved} of {len(entries)} stream entries"))
+            entries = []
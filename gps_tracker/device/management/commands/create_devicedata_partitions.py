@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from device import partitions
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming DeviceData partitions (run daily from cron once partition_devicedata has been run)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=getattr(settings, 'GPS_PARTITIONS_AHEAD', 3),
+                            help='Future periods to make sure exist')
+        parser.add_argument('--dry-run', action='store_true', help='Print the SQL without running it')
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            self.stdout.write('DeviceData is not partitioned; nothing to do')
+            return
+        statements = partitions.ensure_partitions(options['ahead'], dry_run=options['dry_run'])
+        for statement in statements:
+            self.stdout.write(statement + ';')
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"{len(partitions.existing_partitions())} partitions attached"))
@@ -0,0 +1,20 @@
+import secrets
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from device.models import IngestToken
+
+
+class Command(BaseCommand):
+    help = 'Create an API token for the bulk ingest endpoint (sent as "Authorization: Token <key>")'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--name', default='', help='Label for the token, e.g. the gateway it is issued to')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['username']}' does not exist")
+        token = IngestToken.objects.create(user=user, key=secrets.token_hex(20), name=options['name'])
+        self.stdout.write(self.style.SUCCESS(f"Created ingest token for {user.username}: {token.key}"))
@@ -1,87 +1,106 @@
 import requests
 from django.core.management.base import BaseCommand
-from django.utils import timezone
 from django.conf import settings
-from device.models import Device, DeviceData
-from device.utils import parse_timestamp, process_device_data
+from device.metrics import start_exporter
+from device.utils import process_device_data, process_device_data_batch, save_readings
+from device.poller import fetch_device, parse_api_data, poll_devices
+from device.scheduler import PollScheduler
+from device.health import health_from_settings
+from device.redis_client import get_redis_client
+from device.streams import StreamProducer
 import time
 import logging
-import math
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
     help = 'Fetch GPS data for all devices and store in database'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='Fetch all due devices concurrently over a shared keep-alive connection pool')
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'GPS_POLL_CONCURRENCY', 50),
+                            help='Maximum number of in-flight API requests in --async mode')
+        parser.add_argument('--timeout', type=float, default=5, help='Per-request timeout in seconds')
+        parser.add_argument('--idempotent', action='store_true',
+                            help='Skip readings already stored instead of shifting their timestamp, and slot late points into place')
+        parser.add_argument('--stream', action='store_true',
+                            help='Queue readings on the gps:readings Redis Stream for consume_gps_stream instead of saving them')
+        parser.add_argument('--redis-url', help='Redis URL for --stream, overriding REDIS_URL/REDIS_HOST settings')
+
+    def handle(self, *args, **options):
         api_url = getattr(settings, 'GPS_API_URL', 'http://127.0.0.1:8000/api/gps/')
+        scheduler = PollScheduler(
+            direct_interval=getattr(settings, 'GPS_DIRECT_POLL_INTERVAL', 4),
+            sync_interval=getattr(settings, 'GPS_DEVICE_SYNC_INTERVAL', 30),
+            health=health_from_settings(),
+        )
+        scheduler.load()
+        start_exporter()
+        self.idempotent = options['idempotent']
+        producer = StreamProducer(get_redis_client(options['redis_url'])) if options['stream'] else None
+        self.stdout.write(f"Found {len(scheduler)} devices")
+        session = requests.Session()
         while True:
-            devices = Device.objects.all()
-            self.stdout.write(f"Found {devices.count()} devices")
-            for device in devices:
-                try:
-                    latest_data = DeviceData.objects.filter(device=device).order_by('-timestamp').first()
-                    polling_interval = 4
-                    if latest_data and latest_data.power_source == 'battery':
-                        polling_interval = device.update_interval * 60
-                        if latest_data.timestamp:
-                            time_since_last_update = (timezone.now() - latest_data.timestamp).total_seconds()
-                            if time_since_last_update < polling_interval:
-                                self.stdout.write(f"Skipping {device.device_id}: Next update in {polling_interval - time_since_last_update:.0f} seconds")
-                                continue
+            scheduler.sync()
+            due_devices = scheduler.pop_due()
+            if due_devices:
+                if options['use_async']:
+                    started = time.monotonic()
+                    results = poll_devices(due_devices, api_url, options['concurrency'], options['timeout'])
+                    self.stdout.write(f"Fetched {len(results)} devices in {time.monotonic() - started:.2f} seconds")
+                else:
+                    results = ((device, fetch_device(session, api_url, device, options['timeout'])) for device in due_devices)
+
+                readings = []
+                for device, api_data in results:
+                    reading = parse_api_data(device, api_data) if api_data is not None else None
+                    if reading is not None:
+                        readings.append(reading)
+                    scheduler.reschedule(device, reading)
+                if producer:
+                    self.publish_readings(producer, readings)
+                else:
+                    self.save_readings(readings)
+            scheduler.wait()
 
-                    params = {"device_id": device.device_id, "device_password": device.device_password}
-                    response = requests.get(api_url, params=params, timeout=5)
-                    self.stdout.write(f"Fetching data for device {device.device_id}: Status {response.status_code}")
-                    if response.status_code != 200:
-                        logger.error(f"GPS API error for {device.device_id}: Status {response.status_code}, Response: {response.text}")
-                        continue
+    def publish_readings(self, producer, readings):
+        if not readings:
+            return
+        try:
+            producer.publish(readings)
+            self.stdout.write(self.style.SUCCESS(f"Queued {len(readings)} readings"))
+        except Exception as e:
+            logger.error(f"Failed to queue {len(readings)} readings, saving them directly: {str(e)}")
+            self.save_readings(readings)
 
-                    api_data = response.json()
-                    required_fields = ["device_id", "event_time", "latitude", "longitude", "Charge", "power_source"]
-                    missing_fields = [field for field in required_fields if field not in api_data or api_data[field] is None]
-                    if missing_fields:
-                        logger.error(f"Invalid API response for {device.device_id}: missing fields: {', '.join(missing_fields)}")
-                    try:
-                        latitude = float(api_data["latitude"])
-                        longitude = float(api_data["longitude"])
-                        charge = int(api_data["Charge"])
-                        power_source = api_data["power_source"]
-                        parsed_timestamp = parse_timestamp(api_data["event_time"])
-                        if not parsed_timestamp or parsed_timestamp.tzinfo is None:
-                            logger.error(f"Invalid or naive timestamp for {device.device_id}: raw event_time='{api_data['event_time']}', parsed={parsed_timestamp}")
-                            continue
+    def save_readings(self, readings):
+        if not readings:
+            return
+        if self.idempotent:
+            self.stdout.write(self.style.SUCCESS(f"Saved {save_readings(readings)} new readings"))
+            return
+        try:
+            process_device_data_batch(readings)
+            self.stdout.write(self.style.SUCCESS(f"Saved {len(readings)} readings"))
+            return
+        except Exception as e:
+            logger.error(f"Batch save of {len(readings)} readings failed, retrying one by one: {str(e)}")
+        # One bad row fails the whole batch, so fall back to saving readings individually.
+        for reading in readings:
+            device = reading['device']
+            try:
+                process_device_data(**reading)
+                self.stdout.write(self.style.SUCCESS(
+                    f"Saved data for {device.device_id}: {reading['timestamp'].isoformat()}"
+                ))
+            except Exception as e:
+                logger.error(f"Unexpected error saving data for {device.device_id}: {str(e)}")
 
-                        process_device_data(
-                            device=device,
-                            latitude=latitude,
-                            longitude=longitude,
-                            altitude=float(api_data.get("altitude", 0)),
-                            charge=charge,
-                            timestamp=parsed_timestamp,
-                            power_source=power_source
-                        )
-                        self.stdout.write(self.style.SUCCESS(
-                            f"Saved data for {device.device_id}: {parsed_timestamp.isoformat()}"
-                        ))
-                    except (ValueError, TypeError) as e:
-                        logger.error(f"Data type conversion error for {device.device_id}: {str(e)}")
-                        continue
-                    except Exception as e:
-                        logger.error(f"Unexpected error saving data for {device.device_id}: {str(e)}")
-                        continue
-                except requests.RequestException as e:
-                    logger.error(f"Failed to connect to GPS API for {device.device_id}: {str(e)}")
-                    continue
 
-            min_interval = min((device.update_interval * 60 for device in Device.objects.all()), default=4)
-            self.stdout.write(f"Sleeping for {min_interval} seconds")
-            time.sleep(min_interval)
-            
-            
 """
 Install dependencies from requirement.txt
 When setting up the project on a new system, install all dependencies using:
 
 pip install -r requirements.txt
-"""
\ No newline at end of file
+"""
@@ -1,62 +1,153 @@
 
+import logging
 import requests
-import redis
-import json
+import re
 import time
 from django.core.management.base import BaseCommand
-from django.utils import timezone
+from django.db import transaction
 from django.conf import settings
-from datetime import datetime, timedelta, timezone as dt_timezone
-from device.models import Device, DeviceData
-from math import radians, sin, cos, sqrt, atan2
-
-# Redis connection
-redis_client = redis.Redis(
-    host=getattr(settings, 'REDIS_HOST', 'localhost'),
-    port=getattr(settings, 'REDIS_PORT', 6379),
-    db=getattr(settings, 'REDIS_DB', 0),
-    decode_responses=True
-)
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371000
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    distance = R * c
-    return distance
+from datetime import datetime, timezone as dt_timezone
+from device.models import Device, DeviceData, Notification
+from device.buffer import WriteBehindBuffer
+from device.redis_client import get_redis_client
+from device.sharding import ShardCoordinator
+from device.streams import StreamProducer
+from device import geofences, rollups
+from device.health import health_from_settings
+from device.state import DeviceState, LastKnownStateStore
+from device.utils import parse_timestamp, save_latest_points
+from device.geodesy import haversine as haversine_distance  # in metres
+from device.metrics import VENDOR_FETCH_SECONDS, VENDOR_FETCH_ERRORS, observe_batch, start_exporter
+
+logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
     help = 'Fetch GPS data for all devices, process with Redis, and store in database'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--redis-url', help='Redis URL, overriding REDIS_URL/REDIS_HOST settings (fakeredis:// for an in-process stand-in)')
+        parser.add_argument('--shard', action='store_true',
+                            help='Split devices with the other --shard pollers on the same Redis via consistent hashing and leases')
+        parser.add_argument('--worker-id', help='Stable name for this poller in --shard mode (default: host:pid)')
+        parser.add_argument('--lease-ttl', type=float, default=getattr(settings, 'GPS_SHARD_LEASE_TTL', 15),
+                            help='Seconds without a heartbeat before a worker and its device leases expire')
+        parser.add_argument('--stream', action='store_true',
+                            help='Queue readings on the gps:readings Redis Stream for consume_gps_stream instead of '
+                                 'writing them; they are journaled and written here only if the stream is unavailable')
+        parser.add_argument('--journal', help='Write-ahead journal for buffered readings; every poller needs its own '
+                                              '(default: GPS_JOURNAL_DIR/fetch_gps_redis[-worker].journal)')
+
+    def handle(self, *args, **options):
         api_url = getattr(settings, 'GPS_API_URL', 'http://127.0.0.1:8000/api/gps/')
         batch_size = getattr(settings, 'GPS_BATCH_SIZE', 100)  # Number of records to batch before DB write
-        batch_data = []
+        batch_max_age = getattr(settings, 'GPS_BATCH_MAX_AGE', 5)  # Seconds a record may wait before DB write
         rash_threshold = 80
+        redis_client = get_redis_client(options['redis_url'])
+
+        coordinator = None
+        if options['shard']:
+            coordinator = ShardCoordinator(redis_client, worker_id=options['worker_id'], lease_ttl=options['lease_ttl'])
+
+        journal = options['journal']
+        if not journal:
+            suffix = '-' + re.sub(r'[^\w.-]', '_', coordinator.worker_id) if coordinator else ''
+            journal = f"{getattr(settings, 'GPS_JOURNAL_DIR', settings.BASE_DIR)}/fetch_gps_redis{suffix}.journal"
+        buffer = WriteBehindBuffer(journal, self.write_batch, max_size=batch_size, max_age=batch_max_age,
+                                   fsync=getattr(settings, 'GPS_JOURNAL_FSYNC', True))
+        replayed = buffer.replay()
+        if replayed:
+            self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} journaled records from {journal}"))
+
+        # Latest point per device, kept in Redis without a TTL so quiet devices keep their previous point.
+        state_store = LastKnownStateStore(redis_client)
+        state_store.warm_start()
 
+        start_exporter()
+        if coordinator:
+            coordinator.start()
+            self.stdout.write(f"Joined shard ring as {coordinator.worker_id}")
+        producer = StreamProducer(redis_client) if options['stream'] else None
+        try:
+            self.poll_forever(api_url, buffer, rash_threshold, state_store, coordinator, producer)
+        finally:
+            buffer.flush()
+            buffer.close()
+            if coordinator:
+                coordinator.stop()
+
+    def write_batch(self, records):
+        # Readings of devices deleted since they were journaled would fail the batch on every retry
+        devices = Device.objects.in_bulk({record["device"] for record in records})
+        dropped = [record for record in records if record["device"] not in devices]
+        if dropped:
+            logger.warning(f"Dropping {len(dropped)} buffered readings of deleted devices "
+                           f"{sorted({record['device'] for record in dropped})}")
+            records = [record for record in records if record["device"] in devices]
+        # ignore_conflicts makes replaying an already-committed batch a no-op
+        rows = [DeviceData(
+            device_id=record["device"],
+            latitude=record["latitude"],
+            longitude=record["longitude"],
+            altitude=record["altitude"],
+            speed=record["speed"],
+            heading=record["heading"],
+            charge=record["charge"],
+            timestamp=parse_timestamp(record["timestamp"]),
+            odometer=record["odometer"]
+        ) for record in records]
+        started = time.perf_counter()
+        with transaction.atomic():
+            # Rows a replay already committed must not be counted into the rollups twice
+            stored = set(DeviceData.objects.filter(
+                device_id__in={row.device_id for row in rows}, timestamp__in={row.timestamp for row in rows}
+            ).values_list('device_id', 'timestamp'))
+            DeviceData.objects.bulk_create(rows, ignore_conflicts=True)
+            ordered = sorted(rows, key=lambda row: row.timestamp)
+            save_latest_points({row.device_id: row for row in ordered})
+            Notification.objects.bulk_create(geofences.evaluate(
+                (devices[row.device_id], row) for row in ordered if (row.device_id, row.timestamp) not in stored))
+            rollups.record([
+                (row.device_id, row.timestamp, row.speed, row.charge, *record["rollup"])
+                for row, record in zip(rows, records)
+                if record.get("rollup") and (row.device_id, row.timestamp) not in stored
+            ])
+        observe_batch('fetch_gps_redis', [row.timestamp for row in rows], time.perf_counter() - started)
+        self.stdout.write(self.style.SUCCESS(f"Saved {len(rows)} records to database"))
+
+    def poll_forever(self, api_url, buffer, rash_threshold, state_store, coordinator, producer=None):
+        health = health_from_settings()
         while True:
-            devices = Device.objects.all()
-            self.stdout.write(f"Found {devices.count()} devices")
-            pipeline = redis_client.pipeline()  # Use Redis pipeline for batch operations
+            devices = list(Device.objects.all())
+            if coordinator:
+                leased = set(coordinator.acquire([device.device_id for device in devices]))
+                devices = [device for device in devices if device.device_id in leased]
+            self.stdout.write(f"Found {len(devices)} devices")
+            previous = state_store.get_many([device.pk for device in devices])
+            states = {}
+            queued = []
 
             for device in devices:
+                self.flush_buffer(buffer)
+                # Skip devices that are backing off, have an open circuit or are parked
+                if not health.allow(device.pk):
+                    continue
+                reading = None
                 try:
                     # Fetch GPS data from API
                     params = {"device_id": device.device_id, "device_password": device.device_password}
-                    response = requests.get(api_url, params=params, timeout=5)
-                    self.stdout.write(f"Fetching data for device {device.device_id}: Status {response.status_code}")
+                    with VENDOR_FETCH_SECONDS.time():
+                        response = requests.get(api_url, params=params, timeout=5)
+                    logger.debug(f"Fetching data for device {device.device_id}: Status {response.status_code}")
 
                     if response.status_code != 200:
+                        VENDOR_FETCH_ERRORS.inc(reason='status')
                         self.stdout.write(self.style.ERROR(
                             f"GPS API error for {device.device_id}: Status_EXP_{response.status_code}, Response: {response.text}"
                         ))
                         continue
 
                     api_data = response.json()
-                    self.stdout.write(f"GPS API Response: {api_data}")
+                    logger.debug(f"GPS API Response: {api_data}")
 
                     # Validate required fields
                     required_fields = ["device_id", "event_time", "latitude", "longitude", "Charge"]
@@ -84,24 +175,18 @@ class Command(BaseCommand):
                             ))
                             continue
 
-                        # Redis key for storing latest device data
-                        redis_key = f"device:{device.device_id}:latest"
-
-                        # Get previous data from Redis
-                        prev_data = redis_client.get(redis_key)
+                        # Previous point from the last-known-state store
+                        prev_data = previous.get(device.pk)
                         speed = 0
+                        odometer = 0
 
                         if prev_data:
-                            prev_data = json.loads(prev_data)
-                            prev_timestamp = datetime.fromisoformat(prev_data["timestamp"])
-                            prev_latitude = float(prev_data["latitude"])
-                            prev_longitude = float(prev_data["longitude"])
-
                             # Calculate speed
-                            distance = haversine_distance(prev_latitude, prev_longitude, latitude, longitude)
-                            time_diff = (parsed_timestamp - prev_timestamp).total_seconds()
+                            distance = haversine_distance(prev_data.latitude, prev_data.longitude, latitude, longitude)
+                            time_diff = (parsed_timestamp - prev_data.timestamp).total_seconds()
                             speed = (distance / time_diff) * 3.6 if time_diff > 0 else 0
-                            self.stdout.write(f"Calculated speed for {device.device_id}: {speed} km/h")
+                            odometer = prev_data.odometer + distance
+                            logger.debug(f"Calculated speed for {device.device_id}: {speed} km/h")
 
                             # Check for rash driving
                             if speed > rash_threshold:
@@ -109,28 +194,37 @@ class Command(BaseCommand):
                                     f"Rash driving detected for {device.device_id}: Speed {speed} km/h at {parsed_timestamp}"
                                 ))
 
-                        # Store current data in Redis
-                        current_data = {
-                            "latitude": latitude,
-                            "longitude": longitude,
-                            "timestamp": parsed_timestamp.isoformat(),
-                            "charge": charge
-                        }
-                        pipeline.set(redis_key, json.dumps(current_data), ex=3600)  # Expire after 1 hour
+                        # Remember current point as the device's latest state
+                        current = DeviceState(
+                            latitude, longitude, parsed_timestamp, speed=speed, charge=charge, odometer=odometer
+                        )
+                        rollup = None
+                        if not prev_data or parsed_timestamp > prev_data.timestamp:
+                            rollup = rollups.point_entry(device.pk, current, prev_data)[4:]
+                        previous[device.pk] = states[device.pk] = current
 
-                        # Prepare data for batch database write
-                        device_data = {
-                            "device": device,
+                        # Journal the reading, then queue it for the next batch write
+                        record = {
+                            "device": device.pk,
                             "latitude": latitude,
                             "longitude": longitude,
                             "altitude": 0,
                             "speed": speed,
                             "heading": 0,
                             "charge": charge,
-                            "timestamp": parsed_timestamp
+                            "timestamp": parsed_timestamp.isoformat(),
+                            "odometer": odometer,
+                            "rollup": rollup
                         }
-                        batch_data.append(device_data)
-                        self.stdout.write(f"Prepared data for {device.device_id}: {parsed_timestamp.isoformat()}")
+                        if producer:
+                            # Consumers derive speed, odometer and rollups again under the device lock
+                            queued.append(({'device': device, 'latitude': latitude, 'longitude': longitude,
+                                            'altitude': 0, 'charge': charge, 'timestamp': parsed_timestamp,
+                                            'power_source': 'battery'}, record))
+                        else:
+                            buffer.append(record)
+                        logger.debug(f"Prepared data for {device.device_id}: {parsed_timestamp.isoformat()}")
+                        reading = {"latitude": latitude, "longitude": longitude}
 
                     except (ValueError, TypeError) as e:
                         self.stdout.write(self.style.ERROR(
@@ -144,31 +238,35 @@ class Command(BaseCommand):
                         continue
 
                 except requests.RequestException as e:
+                    VENDOR_FETCH_ERRORS.inc(reason='connect')
                     self.stdout.write(self.style.ERROR(
                         f"Failed to connect to GPS API for {device.device_id}: {str(e)}"
                     ))
                     continue
+                finally:
+                    health.record(device, reading)
 
-            # Execute Redis pipeline
-            pipeline.execute()
-            self.stdout.write("Redis pipeline executed")
-
-            # Save batch to database
-            if len(batch_data) >= batch_size:
-                try:
-                    DeviceData.objects.bulk_create([DeviceData(**data) for data in batch_data])
-                    self.stdout.write(self.style.SUCCESS(f"Saved {len(batch_data)} records to database"))
-                    batch_data = []  # Clear batch
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(f"Error saving batch to database: {str(e)}"))
+            # Write this sweep's latest points to Redis in one round trip
+            state_store.put_many(states)
+            logger.debug("Device state updated")
+            if queued:
+                self.publish_readings(producer, queued, buffer)
 
+            self.flush_buffer(buffer)
             time.sleep(4)  # Poll every 4 seconds
 
-            # Save any remaining batch data
-            if batch_data:
-                try:
-                    DeviceData.objects.bulk_create([DeviceData(**data) for data in batch_data])
-                    self.stdout.write(self.style.SUCCESS(f"Saved remaining {len(batch_data)} records to database"))
-                    batch_data = []
-                except Exception as e:
-                    self.stdout.write(self.style.ERROR(f"Error saving remaining batch to database: {str(e)}"))
\ No newline at end of file
+    def publish_readings(self, producer, queued, buffer):
+        try:
+            producer.publish([reading for reading, _ in queued])
+            self.stdout.write(self.style.SUCCESS(f"Queued {len(queued)} readings"))
+        except Exception as e:
+            logger.error(f"Failed to queue {len(queued)} readings, writing them directly: {str(e)}")
+            for _, record in queued:
+                buffer.append(record)
+
+    def flush_buffer(self, buffer):
+        try:
+            buffer.flush_if_due()
+        except Exception as e:
+            # Records stay pending and journaled; the next flush retries them.
+            self.stdout.write(self.style.ERROR(f"Error saving batch to database: {str(e)}"))
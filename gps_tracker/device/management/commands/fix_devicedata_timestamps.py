@@ -1,21 +1,33 @@
+from datetime import timezone as dt_timezone
+
 from django.core.management.base import BaseCommand
-from django.utils import timezone
+from device import backfill
 from device.models import DeviceData
 
+
+class NaiveTimestamps(backfill.Backfill):
+    name = 'fix_devicedata_timestamps'
+    model = DeviceData
+    fields = ('timestamp',)
+
+    def apply(self, rows):
+        # Assume naive timestamps are in UTC and make them aware
+        fixed = [DeviceData(pk=pk, timestamp=timestamp.replace(tzinfo=dt_timezone.utc))
+                 for pk, timestamp in rows if timestamp.tzinfo is None]
+        DeviceData.objects.bulk_update(fixed, ['timestamp'])
+        return len(fixed)
+
+
 class Command(BaseCommand):
-    help = 'Convert offset-naive timestamps in DeviceData to offset-aware (UTC)'
-
-    def handle(self, *args, **kwargs):
-        updated = 0
-        for data in DeviceData.objects.all():
-            if data.timestamp.tzinfo is None:
-                # Assume naive timestamps are in UTC and make them aware
-                data.timestamp = data.timestamp.replace(tzinfo=timezone.utc)
-                data.save()
-                updated += 1
-                self.stdout.write(self.style.SUCCESS(
-                    f"Updated timestamp for DeviceData ID {data.id}: {data.timestamp}"
-                ))
+    help = ('Convert offset-naive timestamps in DeviceData to offset-aware (UTC), in resumable chunks '
+            '(an interrupted run continues where it stopped)')
+
+    def add_arguments(self, parser):
+        backfill.add_arguments(parser)
+
+    def handle(self, *args, **options):
+        checkpoint = backfill.from_options(NaiveTimestamps, options, self.stdout).run(
+            restart=options['restart'], max_rows=options['max_rows'])
         self.stdout.write(self.style.SUCCESS(
-            f"Updated {updated} DeviceData records to offset-aware timestamps"
-        ))
\ No newline at end of file
+            f"Updated {checkpoint.rows_changed} DeviceData records to offset-aware timestamps"
+        ))
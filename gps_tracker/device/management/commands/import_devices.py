@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from device import bulk_import
+
+
+class Command(BaseCommand):
+    help = ('Stream a fleet device list (device_id, device_password and optionally username columns; CSV or '
+            'NDJSON) into Device, skipping devices that already exist')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--user', help='Owner of rows without a username column')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help='Default: from the file extension')
+        parser.add_argument('--batch-size', type=int, default=100000, help='Rows staged and merged per transaction')
+
+    def handle(self, *args, **options):
+        if options['user'] and not User.objects.filter(username=options['user']).exists():
+            raise CommandError(f"Unknown user {options['user']}")
+        started = time.monotonic()
+        stats = bulk_import.import_devices(bulk_import.open_records(options['path'], options['format']),
+                                           options['user'], options['batch_size'])
+        self.stdout.write(
+            f"Read {stats.read} rows in {time.monotonic() - started:.1f}s: {stats.inserted} created, "
+            f"{stats.duplicates} already present, {stats.unknown} with unknown owners, {stats.invalid} invalid"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Imported {stats.inserted} devices"))
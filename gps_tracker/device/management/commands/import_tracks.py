@@ -0,0 +1,56 @@
+import io
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from device import bulk_import, geofences
+from device.models import Device, Notification
+from device.state import get_state_store
+from device.utils import latest_data_for_devices, save_latest_points
+
+
+class Command(BaseCommand):
+    help = ('Stream historical track points from a CSV or NDJSON dump (optionally gzipped, - for stdin) into '
+            'DeviceData, skipping unknown devices and points already stored. Restart pollers afterwards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help='Default: from the file extension')
+        parser.add_argument('--batch-size', type=int, default=100000, help='Rows staged and merged per transaction')
+        parser.add_argument('--skip-recompute', action='store_true',
+                            help='Do not recompute odometers, rollups and latest readings of the imported devices')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        stats = bulk_import.import_tracks(bulk_import.open_records(options['path'], options['format']),
+                                          options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"Read {stats.read} rows in {elapsed:.1f}s ({stats.read / max(elapsed, 1e-9):.0f} rows/s): "
+            f"{stats.inserted} inserted, {stats.duplicates} already stored, {stats.unknown} for unknown devices, "
+            f"{stats.invalid} invalid"
+        )
+        device_ids = list(Device.objects.filter(pk__in=stats.device_pks).order_by('pk').values_list('device_id', flat=True))
+        if stats.inserted and options['skip_recompute']:
+            self.stdout.write(self.style.WARNING(
+                f"Odometers and rollups of {len(device_ids)} devices are stale; run backfill_odometer and "
+                f"rebuild_rollups for them"
+            ))
+        elif stats.inserted:
+            output = self.stdout if options['verbosity'] > 1 else io.StringIO()
+            call_command('backfill_odometer', device_ids=device_ids, stdout=output)
+            call_command('rebuild_rollups', devices=device_ids, stdout=output)
+            pks = sorted(stats.device_pks)
+            for start in range(0, len(pks), 1000):
+                with transaction.atomic():
+                    latest = latest_data_for_devices(pks[start:start + 1000])
+                    save_latest_points(latest)
+                    # Fences see each device's newest point, not every historical one
+                    devices = Device.objects.in_bulk(list(latest))
+                    Notification.objects.bulk_create(geofences.evaluate(
+                        (devices[pk], point) for pk, point in sorted(latest.items(), key=lambda item: item[1].timestamp)))
+                # A shared (Redis) or cached state store still holds the old odometers
+                get_state_store().warm_start(pks[start:start + 1000])
+            self.stdout.write(f"Recomputed odometers, rollups, latest readings and geofences of {len(device_ids)} devices")
+        self.stdout.write(self.style.SUCCESS(f"Imported {stats.inserted} points"))
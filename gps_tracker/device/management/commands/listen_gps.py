@@ -0,0 +1,47 @@
+import asyncio
+import logging
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from device.metrics import start_exporter
+from device.listener import DeviceDirectory, ReadingBatcher, serve
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Accept GPS readings pushed by trackers over TCP/UDP (see device/listener.py for the protocol)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=getattr(settings, 'GPS_LISTENER_HOST', '0.0.0.0'))
+        parser.add_argument('--tcp-port', type=int, default=getattr(settings, 'GPS_LISTENER_TCP_PORT', 5055),
+                            help='TCP port, 0 to disable')
+        parser.add_argument('--udp-port', type=int, default=getattr(settings, 'GPS_LISTENER_UDP_PORT', 5055),
+                            help='UDP port, 0 to disable')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'GPS_LISTENER_BATCH_SIZE', 500),
+                            help='Readings per bulk insert')
+        parser.add_argument('--max-age', type=float, default=getattr(settings, 'GPS_LISTENER_BATCH_MAX_AGE', 1.0),
+                            help='Seconds a reading may wait before its batch is written')
+        parser.add_argument('--reorder-window', type=float, default=getattr(settings, 'GPS_REORDER_WINDOW', 5),
+                            help='Seconds to hold readings so out-of-order points are written in timestamp order, 0 to disable')
+        parser.add_argument('--retry-delay', type=float, default=getattr(settings, 'GPS_LISTENER_RETRY_DELAY', 5.0),
+                            help='Seconds between attempts to write readings while the database is unavailable')
+        parser.add_argument('--refresh-interval', type=float, default=60,
+                            help='Seconds between reloads of the device credential table')
+
+    def handle(self, *args, **options):
+        start_exporter()
+        directory = DeviceDirectory(options['refresh_interval'])
+        batcher = ReadingBatcher(options['batch_size'], options['max_age'], reorder_window=options['reorder_window'],
+                                 retry_delay=options['retry_delay'])
+
+        def ready(servers, transports):
+            self.stdout.write(self.style.SUCCESS(
+                f"Listening on {options['host']} (tcp {options['tcp_port'] or 'off'}, udp {options['udp_port'] or 'off'}) "
+                f"for {len(directory.devices)} devices"
+            ))
+
+        try:
+            asyncio.run(serve(options['host'], options['tcp_port'], options['udp_port'], directory, batcher, ready))
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping listener")
+        finally:
+            batcher.close()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from device import partitions
+
+
+class Command(BaseCommand):
+    help = ('One-off: convert DeviceData into a PostgreSQL table range-partitioned by timestamp. '
+            'Copies every row under an exclusive lock, so stop the pollers and run it in a maintenance window.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', choices=['month', 'week'],
+                            default=getattr(settings, 'GPS_PARTITION_INTERVAL', 'month'))
+        parser.add_argument('--ahead', type=int, default=getattr(settings, 'GPS_PARTITIONS_AHEAD', 3),
+                            help='Future partitions to create')
+        parser.add_argument('--keep-old', action='store_true',
+                            help='Keep the original table as device_devicedata_unpartitioned instead of dropping it')
+        parser.add_argument('--dry-run', action='store_true', help='Print the SQL without running it')
+
+    def handle(self, *args, **options):
+        if not partitions.is_supported():
+            raise CommandError('Partitioning needs PostgreSQL; use prune_devicedata for retention on this database')
+        if partitions.is_partitioned():
+            self.stdout.write('DeviceData is already partitioned')
+            return
+        statements = partitions.convert(options['interval'], options['ahead'], options['keep_old'], options['dry_run'])
+        if options['dry_run']:
+            for statement in statements:
+                self.stdout.write(statement + ';')
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Partitioned DeviceData by {options['interval']} ({len(partitions.existing_partitions())} partitions)"
+        ))
@@ -0,0 +1,39 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.utils import timezone
+from device import partitions
+
+
+class Command(BaseCommand):
+    help = ('Apply the DeviceData retention policy: drop whole expired partitions on partitioned PostgreSQL, '
+            'otherwise delete expired rows in chunks')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=getattr(settings, 'GPS_RETENTION_DAYS', None),
+                            help='Keep this many days of history (default: GPS_RETENTION_DAYS)')
+        parser.add_argument('--detach-only', action='store_true',
+                            help='Detach expired partitions but keep them as standalone tables for archiving')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows per DELETE on unpartitioned tables')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed')
+
+    def handle(self, *args, **options):
+        if not options['retention_days']:
+            raise CommandError('No retention policy: pass --retention-days or set GPS_RETENTION_DAYS')
+        cutoff = timezone.now() - timedelta(days=options['retention_days'])
+        if partitions.is_partitioned():
+            # Only partitions that end before the cutoff go; the rest of the window is kept until its partition expires.
+            expired = partitions.expired_partitions(cutoff)
+            statements = partitions.drop_partitions(expired, options['detach_only'], options['dry_run'])
+            for statement in statements:
+                self.stdout.write(statement + ';')
+            self.stdout.write(self.style.SUCCESS(
+                f"{'Would remove' if options['dry_run'] else 'Removed'} {len(expired)} partitions older than {cutoff:%Y-%m-%d}"
+            ))
+            return
+        if options['dry_run']:
+            count = partitions.DeviceData.objects.filter(timestamp__lt=cutoff).count()
+            self.stdout.write(f"Would delete {count} rows older than {cutoff:%Y-%m-%d}")
+            return
+        deleted = partitions.delete_before(cutoff, options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} rows older than {cutoff:%Y-%m-%d}"))
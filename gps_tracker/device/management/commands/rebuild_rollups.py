@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from device.models import Device
+from device import rollups
+
+
+class Command(BaseCommand):
+    help = ('Recompute the minute/hour/day DeviceRollup rows from DeviceData. Rollups of periods already '
+            'removed by prune_devicedata are lost, so limit it to the devices that need it')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', action='append', dest='devices', metavar='DEVICE_ID',
+                            help='Only rebuild this device (repeatable); default is every device')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Points read per query')
+
+    def handle(self, *args, **options):
+        devices = Device.objects.order_by('pk')
+        if options['devices']:
+            devices = devices.filter(device_id__in=options['devices'])
+            missing = set(options['devices']) - set(devices.values_list('device_id', flat=True))
+            if missing:
+                raise CommandError(f"Unknown devices: {', '.join(sorted(missing))}")
+        for device in devices:
+            with transaction.atomic():
+                Device.objects.select_for_update().filter(pk=device.pk).first()
+                points = rollups.rebuild(device, options['chunk_size'])
+            self.stdout.write(f"{device.device_id}: {points} points")
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rollups for {devices.count()} devices"))
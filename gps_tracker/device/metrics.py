@@ -0,0 +1,221 @@
+"""
+In-process metrics: counters and histograms rendered in the Prometheus text
+format by the /metrics view, or by a small HTTP exporter thread in the
+long-running management commands (GPS_METRICS_PORT). GPS_METRICS_SUMMARY_INTERVAL
+logs a one-line summary every that many seconds instead of per-reading output.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _label_text(labelnames, values, extra=''):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_label_text(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count_and_sum(self):
+        with self.lock:
+            counts = list(self.values.values())
+        return sum(sum(row[:-1]) for row in counts), sum(row[-1] for row in counts)
+
+    def render(self):
+        with self.lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.items())
+        lines = []
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        self.metrics.setdefault(metric.name, metric)
+        return self.metrics[metric.name]
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """One line with the count and mean of every metric that has data."""
+        parts = []
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                count, total = metric.count_and_sum()
+                if count:
+                    parts.append(f"{metric.name}={count}/{total / count:.4g}")
+            elif metric.values:
+                parts.append(f"{metric.name}={metric.total():g}")
+        return ' '.join(parts)
+
+
+REGISTRY = Registry()
+
+VENDOR_FETCH_SECONDS = REGISTRY.histogram('gps_vendor_fetch_seconds', 'Vendor API request latency')
+VENDOR_FETCH_ERRORS = REGISTRY.counter('gps_vendor_fetch_errors_total', 'Failed vendor API requests', ['reason'])
+READING_PROCESS_SECONDS = REGISTRY.histogram('gps_reading_process_seconds',
+                                             'Rule evaluation time per reading, averaged over its batch',
+                                             buckets=(.00001, .00005, .0001, .00025, .0005, .001, .005, .01))
+BATCH_SIZE = REGISTRY.histogram('gps_batch_size', 'Readings per database batch', ['writer'],
+                                buckets=(1, 5, 10, 50, 100, 250, 500, 1000, 5000))
+DB_WRITE_SECONDS = REGISTRY.histogram('gps_db_write_seconds', 'Time spent in batch write transactions', ['writer'])
+INGEST_LAG_SECONDS = REGISTRY.histogram('gps_ingest_lag_seconds', 'Time from event_time to the reading being stored',
+                                        buckets=(.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600, 86400))
+READINGS_SAVED = REGISTRY.counter('gps_readings_saved_total', 'DeviceData rows written', ['writer'])
+REQUEST_SECONDS = REGISTRY.histogram('gps_http_request_seconds', 'Django view response time', ['view', 'method'])
+REQUEST_QUERIES = REGISTRY.histogram('gps_http_request_queries', 'SQL queries per Django request', ['view'],
+                                     buckets=(1, 2, 5, 10, 20, 50, 100, 500))
+
+
+def observe_batch(writer, timestamps, write_seconds, now=None):
+    """Record size, write latency and per-reading lag of a stored batch."""
+    now = time.time() if now is None else now
+    BATCH_SIZE.observe(len(timestamps), writer=writer)
+    DB_WRITE_SECONDS.observe(write_seconds, writer=writer)
+    READINGS_SAVED.inc(len(timestamps), writer=writer)
+    for timestamp in timestamps:
+        INGEST_LAG_SECONDS.observe(max(now - timestamp.timestamp(), 0))
+
+
+class MetricsMiddleware:
+    """Times every request and counts its SQL queries, labelled by URL name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, view=view, method=request.method)
+        REQUEST_QUERIES.observe(queries[0], view=view)
+        return response
+
+
+class _ExporterHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _log_summary(interval):
+    while True:
+        time.sleep(interval)
+        logger.info(f"metrics {REGISTRY.summary()}")
+
+
+def start_exporter(port=None, summary_interval=None):
+    """
+    For management commands: serve /metrics on ``port`` (GPS_METRICS_PORT) and
+    log a summary line every ``summary_interval`` seconds
+    (GPS_METRICS_SUMMARY_INTERVAL). Either is skipped when unset or 0.
+    """
+    port = getattr(settings, 'GPS_METRICS_PORT', None) if port is None else port
+    summary_interval = getattr(settings, 'GPS_METRICS_SUMMARY_INTERVAL', 0) if summary_interval is None else summary_interval
+    if port:
+        server = ThreadingHTTPServer(('', port), _ExporterHandler)
+        threading.Thread(target=server.serve_forever, daemon=True, name='metrics-exporter').start()
+        logger.info(f"Serving metrics on port {port}")
+    if summary_interval:
+        threading.Thread(target=_log_summary, args=(summary_interval,), daemon=True, name='metrics-summary').start()
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-17 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0006_device_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='odometer',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='devicedata',
+            name='odometer',
+            field=models.FloatField(default=0),
+        ),
+    ]
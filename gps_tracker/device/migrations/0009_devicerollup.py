@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-17 09:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0008_ingesttoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')], max_length=10)),
+                ('bucket', models.DateTimeField()),
+                ('point_count', models.IntegerField(default=0)),
+                ('distance', models.FloatField(default=0)),
+                ('speed_sum', models.FloatField(default=0)),
+                ('min_speed', models.FloatField(default=0)),
+                ('max_speed', models.FloatField(default=0)),
+                ('moving_seconds', models.FloatField(default=0)),
+                ('min_charge', models.IntegerField(default=0)),
+                ('max_charge', models.IntegerField(default=0)),
+                ('status_changes', models.IntegerField(default=0)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='device.device')),
+            ],
+            options={
+                'unique_together': {('device', 'granularity', 'bucket')},
+            },
+        ),
+    ]
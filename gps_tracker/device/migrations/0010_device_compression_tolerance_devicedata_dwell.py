@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-17 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0009_devicerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='compression_tolerance',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='devicedata',
+            name='dwell',
+            field=models.FloatField(default=0),
+        ),
+    ]
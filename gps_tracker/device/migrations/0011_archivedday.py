@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-17 12:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0010_device_compression_tolerance_devicedata_dwell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('path', models.CharField(max_length=255)),
+                ('point_count', models.IntegerField(default=0)),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('first_odometer', models.FloatField(default=0)),
+                ('last_odometer', models.FloatField(default=0)),
+                ('size', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='device.device')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['device', 'last_timestamp'], name='device_arch_device__75bc90_idx')],
+                'unique_together': {('device', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.2 on 2026-10-17 13:10
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def copy_latest_points(apps, schema_editor):
+    from device import archive
+    Device = apps.get_model('device', 'Device')
+    DeviceData = apps.get_model('device', 'DeviceData')
+    newest = DeviceData.objects.filter(device=OuterRef('pk')).order_by('-timestamp')
+    defaults = {'timestamp': None, 'latitude': None, 'longitude': None, 'altitude': 0, 'speed': 0, 'heading': 0,
+                'charge': 0, 'power_source': ''}
+    Device.objects.update(**{
+        f'last_{column}': Subquery(newest.values(column)[:1]) if default is None
+        else Coalesce(Subquery(newest.values(column)[:1]), Value(default))
+        for column, default in defaults.items()
+    })
+    # Devices whose whole history is archived: their newest point is the last one of their newest archived day
+    ArchivedDay = apps.get_model('device', 'ArchivedDay')
+    archived = Device.objects.filter(last_timestamp__isnull=True, pk__in=ArchivedDay.objects.values('device_id'))
+    for device in archived:
+        entry = ArchivedDay.objects.filter(device=device).order_by('-day').first()
+        try:
+            point = archive.read_day(entry)[-1]
+        except OSError:
+            continue
+        Device.objects.filter(pk=device.pk).update(**{f'last_{column}': getattr(point, column) for column in defaults})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0011_archivedday'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='last_altitude',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_charge',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_heading',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_power_source',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_speed',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['user', 'last_timestamp'], name='device_devi_user_id_e46da9_idx'),
+        ),
+        migrations.RunPython(copy_latest_points, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-17 14:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_geohashes(apps, schema_editor):
+    from device.spatial import encode
+    Device = apps.get_model('device', 'Device')
+    devices = list(Device.objects.filter(last_timestamp__isnull=False).only('pk', 'last_latitude', 'last_longitude'))
+    for device in devices:
+        device.last_geohash = encode(device.last_latitude, device.last_longitude)
+    Device.objects.bulk_update(devices, ['last_geohash'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0012_device_last_altitude_device_last_charge_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='last_geohash',
+            field=models.CharField(blank=True, db_index=True, max_length=12),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['last_timestamp'], name='device_devi_last_ti_481598_idx'),
+        ),
+        migrations.RunPython(fill_geohashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-17 17:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0015_backfillcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rule', models.CharField(max_length=30)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('ongoing', 'Ongoing'), ('resolved', 'Resolved')], default='open', max_length=10)),
+                ('opened_at', models.DateTimeField()),
+                ('fired_at', models.DateTimeField(blank=True, null=True)),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+                ('suppressed', models.IntegerField(default=0)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='device.device')),
+            ],
+            options={
+                'unique_together': {('device', 'rule')},
+            },
+        ),
+    ]
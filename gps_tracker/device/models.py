@@ -9,7 +9,26 @@ class Device(models.Model):
     device_id = models.CharField(max_length=100, unique=True)
     device_password = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     update_interval = models.IntegerField(default=60)
+    odometer = models.FloatField(default=0)  # metres travelled, kept current at ingest
+    compression_tolerance = models.FloatField(default=0)  # metres; 0 stores every reading (see device.compression)
+    # Latest reading, kept current by every ingest path (utils.save_latest_points)
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    last_latitude = models.FloatField(null=True, blank=True)
+    last_longitude = models.FloatField(null=True, blank=True)
+    last_altitude = models.FloatField(default=0)
+    last_speed = models.FloatField(default=0)
+    last_heading = models.FloatField(default=0)
+    last_charge = models.IntegerField(default=0)
+    last_power_source = models.CharField(max_length=20, blank=True)
+    last_geohash = models.CharField(max_length=12, blank=True, db_index=True)  # see device.spatial
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'last_timestamp']),
+            models.Index(fields=['last_timestamp']),
+        ]
 
     def __str__(self):
         return self.alias or self.device_id
@@ -25,6 +44,8 @@ class DeviceData(models.Model):
     charge = models.IntegerField(default=0)
     timestamp = models.DateTimeField(default=timezone.now)
     power_source = models.CharField(max_length=20, choices=[('battery', 'Battery'), ('direct', 'Direct')], default='battery')
+    odometer = models.FloatField(default=0)  # device odometer in metres at this point
+    dwell = models.FloatField(default=0)  # seconds the device stayed here; readings in between were not stored
 
     class Meta:
         unique_together = ('device', 'timestamp')
@@ -76,4 +97,134 @@ class MaintenanceRecord(models.Model):
     timestamp = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
-        return f"{self.device.device_id}: {self.status} at {self.timestamp}"
\ No newline at end of file
+        return f"{self.device.device_id}: {self.status} at {self.timestamp}"
+
+
+class IngestToken(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name or 'token'} for {self.user.username}"
+
+
+class DeviceRollup(models.Model):
+    """Per-device aggregates of DeviceData over one minute, hour or day bucket (UTC)."""
+    GRANULARITY_CHOICES = [('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')]
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    granularity = models.CharField(max_length=10, choices=GRANULARITY_CHOICES)
+    bucket = models.DateTimeField()  # bucket start
+    point_count = models.IntegerField(default=0)
+    distance = models.FloatField(default=0)  # metres
+    speed_sum = models.FloatField(default=0)
+    min_speed = models.FloatField(default=0)
+    max_speed = models.FloatField(default=0)
+    moving_seconds = models.FloatField(default=0)
+    min_charge = models.IntegerField(default=0)
+    max_charge = models.IntegerField(default=0)
+    status_changes = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('device', 'granularity', 'bucket')
+
+    @property
+    def average_speed(self):
+        return self.speed_sum / self.point_count if self.point_count else 0
+
+    def __str__(self):
+        return f"{self.device.device_id} {self.granularity} {self.bucket}"
+
+
+class ArchivedDay(models.Model):
+    """Manifest entry for one UTC day of a device's DeviceData moved to a file by device.archive."""
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    day = models.DateField()
+    path = models.CharField(max_length=255)  # relative to GPS_ARCHIVE_DIR
+    point_count = models.IntegerField(default=0)
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    first_odometer = models.FloatField(default=0)
+    last_odometer = models.FloatField(default=0)
+    size = models.IntegerField(default=0)  # bytes on disk
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('device', 'day')
+        indexes = [
+            models.Index(fields=['device', 'last_timestamp']),
+        ]
+
+    def __str__(self):
+        return f"{self.device.device_id} on {self.day}"
+
+
+class Geofence(models.Model):
+    """A user's circle or polygon; devices entering, leaving or dwelling in it raise Notifications (see device.geofences)."""
+    KIND_CHOICES = [('circle', 'Circle'), ('polygon', 'Polygon')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=100)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='circle')
+    latitude = models.FloatField(null=True, blank=True)  # circle centre
+    longitude = models.FloatField(null=True, blank=True)
+    radius = models.FloatField(default=0)  # metres, circles only
+    vertices = models.JSONField(default=list, blank=True)  # [[latitude, longitude], ...], polygons only
+    dwell_seconds = models.IntegerField(default=0)  # 0 disables dwell notifications
+    devices = models.ManyToManyField(Device, blank=True)  # empty: every device the user owns or has been shared
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.kind}) for {self.user.username}"
+
+
+class GeofenceState(models.Model):
+    """A device that is inside a geofence; the row is removed when the device leaves."""
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    geofence = models.ForeignKey(Geofence, on_delete=models.CASCADE)
+    entered_at = models.DateTimeField()
+    dwell_notified = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('device', 'geofence')
+
+    def __str__(self):
+        return f"{self.device.device_id} in {self.geofence.name} since {self.entered_at}"
+
+
+class AlertState(models.Model):
+    """Where a device is in one alert rule's open/ongoing/resolved cycle (see device.alerts)."""
+    STATUS_CHOICES = [('open', 'Open'), ('ongoing', 'Ongoing'), ('resolved', 'Resolved')]
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    rule = models.CharField(max_length=30)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='open')
+    opened_at = models.DateTimeField()  # reading that opened the current or last episode
+    fired_at = models.DateTimeField(null=True, blank=True)  # reading that last wrote an alert
+    resolved_at = models.DateTimeField(null=True, blank=True)
+    suppressed = models.IntegerField(default=0)  # episodes that opened inside the cooldown and wrote nothing
+
+    class Meta:
+        unique_together = ('device', 'rule')
+
+    def __str__(self):
+        return f"{self.device.device_id} {self.rule} {self.status}"
+
+
+class BackfillCheckpoint(models.Model):
+    """Progress of a resumable backfill (see device.backfill), one row per backfill."""
+    name = models.CharField(max_length=100, unique=True)
+    last_pk = models.BigIntegerField(null=True, blank=True)  # last row of the last committed chunk
+    max_pk = models.BigIntegerField(null=True, blank=True)  # highest pk when the run started; newer rows are skipped
+    rows_processed = models.BigIntegerField(default=0)
+    rows_changed = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} at pk {self.last_pk}"
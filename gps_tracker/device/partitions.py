@@ -0,0 +1,218 @@
+"""
+Time-range partitioning of DeviceData on PostgreSQL.
+
+After ``manage.py partition_devicedata`` the device_devicedata table is
+declaratively partitioned by RANGE (timestamp). There is one partition per
+month (device_devicedata_p2026_10) or ISO week (device_devicedata_p2026w42),
+plus device_devicedata_default for points with implausible clocks. Queries
+with a timestamp bound only touch the matching partitions. Retention detaches
+and drops whole partitions, and that costs the same however many rows they hold.
+
+Other backends (SQLite in development) keep a single table, and retention
+falls back to deleting old rows in chunks.
+"""
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+
+from device.models import DeviceData
+
+TABLE = DeviceData._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+MONTH_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})_(\d{{2}})$')
+WEEK_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})w(\d{{2}})$')
+
+
+def period_start(moment, interval):
+    """Start (UTC midnight) of the month or ISO week containing moment."""
+    moment = moment.astimezone(dt_timezone.utc)
+    day = datetime(moment.year, moment.month, moment.day, tzinfo=dt_timezone.utc)
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def next_period(start, interval):
+    if interval == 'week':
+        return start + timedelta(days=7)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start, interval):
+    if interval == 'week':
+        year, week, _ = start.isocalendar()
+        return f"{TABLE}_p{year}w{week:02d}"
+    return f"{TABLE}_p{start.year}_{start.month:02d}"
+
+
+def partition_range(name):
+    """(start, end, interval) for a partition name, or None for the default/unknown tables."""
+    match = MONTH_NAME.match(name)
+    if match:
+        start = datetime(int(match[1]), int(match[2]), 1, tzinfo=dt_timezone.utc)
+        return start, next_period(start, 'month'), 'month'
+    match = WEEK_NAME.match(name)
+    if match:
+        start = datetime.fromisocalendar(int(match[1]), int(match[2]), 1).replace(tzinfo=dt_timezone.utc)
+        return start, next_period(start, 'week'), 'week'
+    return None
+
+
+def is_supported():
+    return connection.vendor == 'postgresql'
+
+
+def is_partitioned():
+    if not is_supported():
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def existing_partitions():
+    """Names of the partitions currently attached to DeviceData."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass ORDER BY c.relname", [TABLE]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def partition_interval():
+    """The interval the existing partitions use, or None if there are none yet."""
+    for name in existing_partitions():
+        bounds = partition_range(name)
+        if bounds:
+            return bounds[2]
+    return None
+
+
+def create_partition_sql(start, interval):
+    end = next_period(start, interval)
+    name = partition_name(start, interval)
+    return (f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{TABLE}" '
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')")
+
+
+def planned_partitions(since, until, interval):
+    """Starts of every period overlapping [since, until]."""
+    start = period_start(since, interval)
+    starts = []
+    while start <= until:
+        starts.append(start)
+        start = next_period(start, interval)
+    return starts
+
+
+def ensure_partitions(ahead=3, interval=None, now=None, dry_run=False):
+    """Create partitions from the current period to ``ahead`` periods out; returns the SQL it ran."""
+    interval = interval or partition_interval() or 'month'
+    now = now or datetime.now(dt_timezone.utc)
+    until = now
+    for _ in range(ahead):
+        until = next_period(period_start(until, interval), interval)
+    statements = [create_partition_sql(start, interval) for start in planned_partitions(now, until, interval)]
+    if not dry_run:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+    return statements
+
+
+def conversion_sql(interval, since, until, keep_old=False):
+    """
+    Statements that turn device_devicedata into a partitioned table holding
+    the same rows. The primary key becomes (id, timestamp), because PostgreSQL
+    requires the partition key in every unique constraint. Django still
+    addresses rows by id alone.
+    """
+    old = f"{TABLE}_unpartitioned"
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, TABLE)
+    statements = [
+        f'ALTER TABLE "{TABLE}" RENAME TO "{old}"',
+        f'CREATE TABLE "{TABLE}" (LIKE "{old}" INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS) PARTITION BY RANGE ("timestamp")',
+        f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT',
+    ]
+    statements += [create_partition_sql(start, interval) for start in planned_partitions(since, until, interval)]
+    statements += [
+        f'INSERT INTO "{TABLE}" SELECT * FROM "{old}"',
+        f"""SELECT setval(pg_get_serial_sequence('"{TABLE}"', 'id'), COALESCE((SELECT MAX(id) FROM "{TABLE}"), 1))""",
+    ]
+    if keep_old:
+        # Index names are schema-wide, so free them for the new table
+        for name, info in constraints.items():
+            if info['index'] or info['primary_key'] or info['unique']:
+                statements.append(f'ALTER INDEX "{name}" RENAME TO "{name[:50]}_unpart"')
+    else:
+        statements.append(f'DROP TABLE "{old}"')
+    for name, info in constraints.items():
+        columns = ', '.join(f'"{column}"' for column in info['columns'])
+        if info['primary_key']:
+            statements.append(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" PRIMARY KEY ("id", "timestamp")')
+        elif info['foreign_key']:
+            table, column = info['foreign_key']
+            statements.append(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" FOREIGN KEY ({columns}) '
+                              f'REFERENCES "{table}" ("{column}") DEFERRABLE INITIALLY DEFERRED')
+        elif info['unique']:
+            if 'timestamp' not in info['columns']:
+                raise ValueError(f"Unique constraint {name} does not include timestamp and cannot be partitioned")
+            statements.append(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" UNIQUE ({columns})')
+        elif info['index'] and not info['check']:
+            statements.append(f'CREATE INDEX "{name}" ON "{TABLE}" ({columns})')
+    return statements
+
+
+def convert(interval='month', ahead=3, keep_old=False, dry_run=False):
+    """Partition the existing table in one transaction; returns the statements."""
+    now = datetime.now(dt_timezone.utc)
+    oldest = DeviceData.objects.order_by('timestamp').values_list('timestamp', flat=True).first() or now
+    until = now
+    for _ in range(ahead):
+        until = next_period(period_start(until, interval), interval)
+    # Only back-fill partitions for plausible history; anything older lands in the default partition.
+    since = max(oldest, now - timedelta(days=3660))
+    statements = conversion_sql(interval, since, until, keep_old)
+    if not dry_run:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE "{TABLE}" IN ACCESS EXCLUSIVE MODE')
+            for statement in statements:
+                cursor.execute(statement)
+    return statements
+
+
+def expired_partitions(cutoff):
+    """Attached partitions whose whole range ends at or before cutoff."""
+    expired = []
+    for name in existing_partitions():
+        bounds = partition_range(name)
+        if bounds and bounds[1] <= cutoff:
+            expired.append(name)
+    return expired
+
+
+def drop_partitions(names, detach_only=False, dry_run=False):
+    statements = []
+    for name in names:
+        statements.append(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+        if not detach_only:
+            statements.append(f'DROP TABLE "{name}"')
+    if not dry_run:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+    return statements
+
+
+def delete_before(cutoff, chunk_size=5000):
+    """Fallback retention for unpartitioned tables: delete old rows chunk by chunk; returns how many."""
+    deleted = 0
+    while True:
+        ids = list(DeviceData.objects.filter(timestamp__lt=cutoff).order_by('timestamp')
+                   .values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        deleted += DeviceData.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from device.metrics import VENDOR_FETCH_SECONDS, VENDOR_FETCH_ERRORS
+from device.utils import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ["device_id", "event_time", "latitude", "longitude", "Charge", "power_source"]
+
+
+def make_session(pool_size):
+    # One keep-alive pool shared by every request of a sweep, sized so each
+    # concurrent worker can hold its own connection to the vendor API.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_device(session, api_url, device, timeout=5):
+    """Fetch the raw API payload for one device, or None on any failure."""
+    params = {"device_id": device.device_id, "device_password": device.device_password}
+    try:
+        with VENDOR_FETCH_SECONDS.time():
+            response = session.get(api_url, params=params, timeout=timeout)
+    except requests.RequestException as e:
+        VENDOR_FETCH_ERRORS.inc(reason='connect')
+        logger.error(f"Failed to connect to GPS API for {device.device_id}: {str(e)}")
+        return None
+    logger.debug(f"Fetching data for device {device.device_id}: Status {response.status_code}")
+    if response.status_code != 200:
+        VENDOR_FETCH_ERRORS.inc(reason='status')
+        logger.error(f"GPS API error for {device.device_id}: Status {response.status_code}, Response: {response.text}")
+        return None
+    try:
+        return response.json()
+    except ValueError as e:
+        VENDOR_FETCH_ERRORS.inc(reason='json')
+        logger.error(f"Invalid JSON from GPS API for {device.device_id}: {str(e)}")
+        return None
+
+
+def parse_api_data(device, api_data):
+    """Validate a vendor API payload and return the process_device_data kwargs for it, or None."""
+    if not isinstance(api_data, dict):
+        logger.error(f"Invalid API response for {device.device_id}: expected an object, got {type(api_data).__name__}")
+        return None
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in api_data or api_data[field] is None]
+    if missing_fields:
+        logger.error(f"Invalid API response for {device.device_id}: missing fields: {', '.join(missing_fields)}")
+        return None
+    try:
+        latitude = float(api_data["latitude"])
+        longitude = float(api_data["longitude"])
+        altitude = float(api_data.get("altitude", 0))
+        charge = int(api_data["Charge"])
+        parsed_timestamp = parse_timestamp(api_data["event_time"])
+    except (ValueError, TypeError, AttributeError, KeyError, OverflowError) as e:
+        logger.error(f"Data type conversion error for {device.device_id}: {str(e)}")
+        return None
+    # NaN fails both comparisons, so non-finite coordinates are rejected here too
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        logger.error(f"Coordinates out of range for {device.device_id}: {latitude}, {longitude}")
+        return None
+    if not parsed_timestamp or parsed_timestamp.tzinfo is None:
+        logger.error(f"Invalid or naive timestamp for {device.device_id}: raw event_time='{api_data['event_time']}', parsed={parsed_timestamp}")
+        return None
+    return {
+        'device': device,
+        'latitude': latitude,
+        'longitude': longitude,
+        'altitude': altitude,
+        'charge': charge,
+        'timestamp': parsed_timestamp,
+        'power_source': api_data["power_source"],
+    }
+
+
+async def _poll(devices, api_url, concurrency, timeout):
+    loop = asyncio.get_running_loop()
+    with make_session(concurrency) as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        tasks = [
+            loop.run_in_executor(executor, fetch_device, session, api_url, device, timeout)
+            for device in devices
+        ]
+        return await asyncio.gather(*tasks)
+
+
+def poll_devices(devices, api_url, concurrency=50, timeout=5):
+    """
+    Fetch every device concurrently and return (device, api_data) pairs in
+    input order; api_data is None for failed fetches. A sweep takes about as
+    long as the slowest request instead of the sum of all of them.
+    """
+    devices = list(devices)
+    if not devices:
+        return []
+    results = asyncio.run(_poll(devices, api_url, max(1, concurrency), timeout))
+    return list(zip(devices, results))
@@ -0,0 +1,35 @@
+import redis
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+_clients = {}
+
+
+def get_redis_client(url=None):
+    """
+    Return a shared Redis client. ``url`` (or settings.REDIS_URL) wins over
+    REDIS_HOST/REDIS_PORT/REDIS_DB; a ``fakeredis://`` URL gives an in-process
+    stand-in (needs the optional fakeredis package). It is private to the
+    process, so it only serves single-process runs; several pollers or a
+    poller and a separate consumer need a real Redis.
+    """
+    url = url or getattr(settings, 'REDIS_URL', None)
+    if url in _clients:
+        return _clients[url]
+    if url and url.startswith('fakeredis://'):
+        try:
+            import fakeredis
+        except ImportError:
+            raise ImproperlyConfigured('fakeredis:// URLs require the fakeredis package')
+        client = fakeredis.FakeRedis(decode_responses=True)
+    elif url:
+        client = redis.Redis.from_url(url, decode_responses=True)
+    else:
+        client = redis.Redis(
+            host=getattr(settings, 'REDIS_HOST', 'localhost'),
+            port=getattr(settings, 'REDIS_PORT', 6379),
+            db=getattr(settings, 'REDIS_DB', 0),
+            decode_responses=True
+        )
+    _clients[url] = client
+    return client
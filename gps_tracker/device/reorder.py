@@ -0,0 +1,59 @@
+import time
+
+
+class ReorderBuffer:
+    """
+    Holds each device's readings for up to ``window`` seconds so points that
+    arrive slightly out of order are released in timestamp order, and speed
+    and heading are derived from the right predecessor.
+
+    A reading is released once the device has sent a point ``window`` seconds
+    newer than it, or once it has been held for ``window`` seconds of wall
+    clock time, so a device that goes quiet does not keep its last points.
+    Anything arriving later than that is still stored correctly by
+    utils.store_readings, which slots it into the history.
+    """
+
+    def __init__(self, window=5, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.held = {}
+        self.newest = {}
+
+    def __len__(self):
+        return sum(len(readings) for readings in self.held.values())
+
+    def add(self, reading):
+        pk = reading['device'].pk
+        self.held.setdefault(pk, []).append((self.clock(), reading))
+        if pk not in self.newest or reading['timestamp'] > self.newest[pk]:
+            self.newest[pk] = reading['timestamp']
+
+    def extend(self, readings):
+        for reading in readings:
+            self.add(reading)
+
+    def release(self):
+        """Readings that are ready, oldest first."""
+        now = self.clock()
+        released = []
+        for pk in list(self.held):
+            held = sorted(self.held[pk], key=lambda item: item[1]['timestamp'])
+            cut = 0
+            for index, (arrived, reading) in enumerate(held):
+                watermark = (self.newest[pk] - reading['timestamp']).total_seconds()
+                if watermark >= self.window or now - arrived >= self.window:
+                    # Everything before a releasable point goes with it, keeping order.
+                    cut = index + 1
+            released.extend(reading for _, reading in held[:cut])
+            if cut == len(held):
+                del self.held[pk]
+            else:
+                self.held[pk] = held[cut:]
+        return sorted(released, key=lambda reading: reading['timestamp'])
+
+    def drain(self):
+        """Every held reading, oldest first."""
+        released = [reading for held in self.held.values() for _, reading in held]
+        self.held = {}
+        return sorted(released, key=lambda reading: reading['timestamp'])
@@ -0,0 +1,187 @@
+"""
+Minute/hour/day rollups of DeviceData, kept current at ingest.
+
+Each stored point adds to one DeviceRollup row per granularity. The point
+contributes its speed and charge, the distance from its predecessor (the
+odometer delta), the time since its predecessor as moving time if it is
+moving (capped at GPS_ROLLUP_MAX_GAP seconds so a device that was offline
+does not count the gap), and any on/off status change. Status changes use the
+same rules as the old full-history loop in the device_data view. Rows are
+upserted with ON CONFLICT ... DO UPDATE, one executemany per batch.
+
+Late points (see utils.insert_late_readings) are counted but only approximated
+for distance, moving time and status; ``manage.py rebuild_rollups`` recomputes
+any device exactly from its history.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, Sum, Min, Max
+
+from device import archive
+from device.models import DeviceRollup
+
+GRANULARITIES = {'minute': 60, 'hour': 3600, 'day': 86400}
+STATIONARY_MINUTES = 10
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def bucket_start(timestamp, granularity):
+    seconds = GRANULARITIES[granularity]
+    offset = (timestamp - EPOCH) // timedelta(seconds=seconds)
+    return EPOCH + timedelta(seconds=offset * seconds)
+
+
+def point_status(point, previous):
+    """
+    (status, changed) for point after previous: a stop only counts once the
+    device has been silent for STATIONARY_MINUTES, a start counts at once.
+    """
+    current = 'on' if point.speed > 0 else 'off'
+    if previous is None:
+        return current, 0
+    previous_status = getattr(previous, 'status', None) or ('on' if previous.speed > 0 else 'off')
+    if current == previous_status:
+        return previous_status, 0
+    if current == 'off':
+        if (point.timestamp - previous.timestamp).total_seconds() / 60 >= STATIONARY_MINUTES:
+            return current, 1
+        return previous_status, 0
+    return current, 1
+
+
+def point_entry(device_pk, point, previous, max_gap=None):
+    """
+    Rollup contribution of a stored point (DeviceData or DeviceState) given
+    the point before it. Sets ``point.status`` so the state store can carry
+    it forward.
+    """
+    max_gap = getattr(settings, 'GPS_ROLLUP_MAX_GAP', 600) if max_gap is None else max_gap
+    point.status, changed = point_status(point, previous)
+    distance = moving = 0
+    if previous is not None:
+        distance = max(point.odometer - previous.odometer, 0)
+        if point.speed > 0:
+            moving = min(max((point.timestamp - previous.timestamp).total_seconds(), 0), max_gap)
+    return (device_pk, point.timestamp, point.speed, point.charge, distance, moving, changed)
+
+
+def aggregate(entries):
+    """{(device pk, granularity, bucket): [count, distance, speed_sum, min_speed, max_speed, moving, min_charge, max_charge, changes]}"""
+    buckets = {}
+    for device_pk, timestamp, speed, charge, distance, moving, changed in entries:
+        for granularity in GRANULARITIES:
+            key = (device_pk, granularity, bucket_start(timestamp, granularity))
+            row = buckets.get(key)
+            if row is None:
+                buckets[key] = [1, distance, speed, speed, speed, moving, charge, charge, changed]
+                continue
+            row[0] += 1
+            row[1] += distance
+            row[2] += speed
+            row[3] = min(row[3], speed)
+            row[4] = max(row[4], speed)
+            row[5] += moving
+            row[6] = min(row[6], charge)
+            row[7] = max(row[7], charge)
+            row[8] += changed
+    return buckets
+
+
+def record(entries):
+    """Add point entries to their rollup rows; call inside the transaction that stores the points."""
+    buckets = aggregate(entries)
+    if not buckets:
+        return
+    table = connection.ops.quote_name(DeviceRollup._meta.db_table)
+    least, greatest = ('LEAST', 'GREATEST') if connection.vendor == 'postgresql' else ('MIN', 'MAX')
+    sql = (
+        f"INSERT INTO {table} (device_id, granularity, bucket, point_count, distance, speed_sum, min_speed, max_speed, "
+        f"moving_seconds, min_charge, max_charge, status_changes) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
+        f"ON CONFLICT (device_id, granularity, bucket) DO UPDATE SET "
+        f"point_count = {table}.point_count + EXCLUDED.point_count, "
+        f"distance = {table}.distance + EXCLUDED.distance, "
+        f"speed_sum = {table}.speed_sum + EXCLUDED.speed_sum, "
+        f"min_speed = {least}({table}.min_speed, EXCLUDED.min_speed), "
+        f"max_speed = {greatest}({table}.max_speed, EXCLUDED.max_speed), "
+        f"moving_seconds = {table}.moving_seconds + EXCLUDED.moving_seconds, "
+        f"min_charge = {least}({table}.min_charge, EXCLUDED.min_charge), "
+        f"max_charge = {greatest}({table}.max_charge, EXCLUDED.max_charge), "
+        f"status_changes = {table}.status_changes + EXCLUDED.status_changes"
+    )
+    params = [
+        (device_pk, granularity, connection.ops.adapt_datetimefield_value(bucket), *row)
+        for (device_pk, granularity, bucket), row in sorted(buckets.items())
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def rebuild(device, chunk_size=2000):
+    """Recompute a device's rollups from its full history, archived days included; returns how many points were read."""
+    DeviceRollup.objects.filter(device=device).delete()
+    previous = None
+    entries = []
+    for point in archive.track(device, chunk_size=chunk_size):
+        entries.append(point_entry(device.pk, point, previous))
+        previous = point
+    DeviceRollup.objects.bulk_create([
+        DeviceRollup(device_id=device_pk, granularity=granularity, bucket=bucket, point_count=row[0], distance=row[1],
+                     speed_sum=row[2], min_speed=row[3], max_speed=row[4], moving_seconds=row[5], min_charge=row[6],
+                     max_charge=row[7], status_changes=row[8])
+        for (device_pk, granularity, bucket), row in aggregate(entries).items()
+    ], batch_size=chunk_size)
+    return len(entries)
+
+
+def _ceil(timestamp, granularity):
+    start = bucket_start(timestamp, granularity)
+    return start if start == timestamp else start + timedelta(seconds=GRANULARITIES[granularity])
+
+
+def covering_buckets(start, end):
+    """
+    (granularity, from, to) ranges covering minute-aligned [start, end) with
+    as few rows as possible: whole days in the middle, whole hours around
+    them, minutes at the edges.
+    """
+    ranges = []
+    for finer, coarser in (('minute', 'hour'), ('hour', 'day')):
+        coarse_start, coarse_end = _ceil(start, coarser), bucket_start(end, coarser)
+        if coarse_start >= coarse_end:
+            ranges.append((finer, start, end))
+            return ranges
+        ranges += [(finer, start, coarse_start), (finer, coarse_end, end)]
+        start, end = coarse_start, coarse_end
+    ranges.append(('day', start, end))
+    return ranges
+
+
+def window_stats(device, since=None, until=None):
+    """
+    Aggregate stats for a device's points in [since, until], to minute
+    precision, reading at most a few hundred rollup rows whatever the span.
+    Without ``since`` the whole history is summed from the day rollups.
+    """
+    rows = DeviceRollup.objects.filter(device=device)
+    if since is None:
+        rows = rows.filter(granularity='day')
+        if until is not None:
+            rows = rows.filter(bucket__lt=until)
+    else:
+        until = until or datetime.now(dt_timezone.utc)
+        condition = Q(pk__in=[])
+        ranges = covering_buckets(bucket_start(since, 'minute'), bucket_start(until, 'minute') + timedelta(minutes=1))
+        for granularity, start, end in ranges:
+            if start < end:
+                condition |= Q(granularity=granularity, bucket__gte=start, bucket__lt=end)
+        rows = rows.filter(condition)
+    totals = rows.aggregate(
+        point_count=Sum('point_count'), distance=Sum('distance'), speed_sum=Sum('speed_sum'),
+        min_speed=Min('min_speed'), max_speed=Max('max_speed'), moving_seconds=Sum('moving_seconds'),
+        min_charge=Min('min_charge'), max_charge=Max('max_charge'), status_changes=Sum('status_changes'),
+    )
+    totals = {key: value or 0 for key, value in totals.items()}
+    totals['average_speed'] = totals['speed_sum'] / totals['point_count'] if totals['point_count'] else 0
+    return totals
@@ -0,0 +1,138 @@
+import heapq
+import logging
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from device.models import Device
+
+logger = logging.getLogger(__name__)
+
+
+class PollScheduler:
+    """
+    Min-heap of per-device poll deadlines.
+
+    Direct-powered devices are due every ``direct_interval`` seconds, battery
+    devices ``update_interval`` minutes after their last reading. Heap entries
+    are invalidated lazily: ``self.due`` holds the live deadline per device and
+    anything popped that does not match it is discarded.
+
+    With a PollHealth, failing devices back off and stationary ones are
+    polled less often: a device is never due before its health allows it.
+    """
+
+    def __init__(self, direct_interval=4, sync_interval=30, clock=time.time, health=None):
+        self.direct_interval = direct_interval
+        self.health = health
+        self.sync_interval = sync_interval
+        self.clock = clock
+        self.heap = []
+        self.due = {}
+        self.devices = {}
+        self.power_sources = {}
+        self.last_seen = {}
+        self.synced_at = None
+        self.next_sync = 0
+
+    def __len__(self):
+        return len(self.devices)
+
+    def load(self):
+        now = self.clock()
+        self.synced_at = timezone.now()
+        for device in Device.objects.all():
+            if device.last_timestamp:
+                self.power_sources[device.pk] = device.last_power_source
+                self.last_seen[device.pk] = device.last_timestamp.timestamp()
+            self.add(device, now)
+        self.next_sync = now + self.sync_interval
+
+    def interval_for(self, device):
+        if self.power_sources.get(device.pk, 'direct') == 'battery':
+            return device.update_interval * 60
+        return self.direct_interval
+
+    def add(self, device, now=None):
+        now = self.clock() if now is None else now
+        self.devices[device.pk] = device
+        last_seen = self.last_seen.get(device.pk)
+        due = now if last_seen is None else max(now, last_seen + self.interval_for(device))
+        self.schedule(device.pk, due)
+
+    def remove(self, device_pk):
+        self.devices.pop(device_pk, None)
+        self.due.pop(device_pk, None)
+        self.power_sources.pop(device_pk, None)
+        self.last_seen.pop(device_pk, None)
+        if self.health:
+            self.health.forget(device_pk)
+
+    def schedule(self, device_pk, due):
+        self.due[device_pk] = due
+        heapq.heappush(self.heap, (due, device_pk))
+
+    def pop_due(self, now=None):
+        now = self.clock() if now is None else now
+        devices = []
+        while self.heap and self.heap[0][0] <= now:
+            due, device_pk = heapq.heappop(self.heap)
+            if self.due.get(device_pk) != due:
+                continue
+            del self.due[device_pk]
+            if self.health:
+                self.health.allow(device_pk, now)
+            devices.append(self.devices[device_pk])
+        return devices
+
+    def reschedule(self, device, reading=None, now=None):
+        """Queue the next poll of a device after it has been polled; reading is None if the poll failed."""
+        now = self.clock() if now is None else now
+        # Use the freshest copy in case the device was edited while it was being polled.
+        device = self.devices.get(device.pk)
+        if device is None:
+            return
+        due = now + self.interval_for(device)
+        if reading is not None:
+            self.power_sources[device.pk] = reading['power_source']
+            self.last_seen[device.pk] = reading['timestamp'].timestamp()
+            # The vendor may hand back a stale point, so never schedule in the past.
+            due = max(now + self.direct_interval, self.last_seen[device.pk] + self.interval_for(device))
+        if self.health:
+            due = max(due, self.health.record(device, reading, now))
+        self.schedule(device.pk, due)
+
+    def sync(self, now=None):
+        """Pick up devices added, edited or deleted since the last sync."""
+        now = self.clock() if now is None else now
+        if now < self.next_sync:
+            return
+        self.next_sync = now + self.sync_interval
+        if self.health:
+            logger.info(f"Poll health: {self.health.summary()}")
+        # Overlap the window so a row committed just after the previous sync is not missed.
+        since = self.synced_at - timedelta(seconds=self.sync_interval)
+        self.synced_at = timezone.now()
+        for device in Device.objects.filter(updated_at__gte=since):
+            known = device.pk in self.devices
+            self.devices[device.pk] = device
+            if not known or device.pk in self.due:
+                self.add(device, now)
+        if Device.objects.count() != len(self.devices):
+            existing = set(Device.objects.values_list('pk', flat=True))
+            for device_pk in list(self.devices):
+                if device_pk not in existing:
+                    self.remove(device_pk)
+
+    def next_deadline(self):
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        deadline = self.heap[0][0] if self.heap else self.next_sync
+        return min(deadline, self.next_sync)
+
+    def wait(self):
+        """Sleep until the next device is due or the next sync, whichever comes first."""
+        delay = self.next_deadline() - self.clock()
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,156 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring; each node gets ``replicas`` virtual points so load stays even."""
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = frozenset(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self.keys = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.keys:
+            return None
+        index = bisect.bisect(self.keys, _hash(key)) % len(self.keys)
+        return self.owners[index]
+
+
+class ShardCoordinator:
+    """
+    Splits devices between poller processes sharing one Redis.
+
+    Live workers are the members of a sorted set scored by their last
+    heartbeat; a worker that misses ``lease_ttl`` seconds of heartbeats drops
+    out and the ring rebalances its devices to the survivors. On top of ring
+    ownership each polled device carries a per-device lease key, so during a
+    rebalance the new owner waits for the old owner's lease to expire instead
+    of polling the same device twice.
+    """
+
+    def __init__(self, client, worker_id=None, lease_ttl=15, prefix='gps:shard', replicas=64):
+        self.client = client
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_ttl = lease_ttl
+        self.prefix = prefix
+        self.replicas = replicas
+        self.ring = HashRing((), replicas)
+        self.leased = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def workers_key(self):
+        return f"{self.prefix}:workers"
+
+    def lease_key(self, device_id):
+        return f"{self.prefix}:lease:{device_id}"
+
+    def heartbeat(self):
+        now = time.time()
+        pipeline = self.client.pipeline()
+        pipeline.zadd(self.workers_key, {self.worker_id: now})
+        pipeline.zremrangebyscore(self.workers_key, '-inf', now - self.lease_ttl)
+        pipeline.zrange(self.workers_key, 0, -1)
+        workers = pipeline.execute()[-1]
+        with self._lock:
+            if frozenset(workers) != self.ring.nodes:
+                logger.info(f"Shard membership changed: {sorted(workers)}")
+                self.ring = HashRing(workers, self.replicas)
+            leased = list(self.leased)
+        self._renew(leased)
+        return workers
+
+    def owns(self, device_id):
+        with self._lock:
+            return self.ring.owner(device_id) == self.worker_id
+
+    def acquire(self, device_ids):
+        """Take or renew leases for the owned subset of device_ids and return the ones now held."""
+        owned = [device_id for device_id in device_ids if self.owns(device_id)]
+        ttl_ms = int(self.lease_ttl * 1000)
+        pipeline = self.client.pipeline()
+        for device_id in owned:
+            pipeline.set(self.lease_key(device_id), self.worker_id, nx=True, px=ttl_ms)
+        acquired = pipeline.execute() if owned else []
+        contested = [device_id for device_id, ok in zip(owned, acquired) if not ok]
+        held = {device_id for device_id, ok in zip(owned, acquired) if ok}
+        if contested:
+            pipeline = self.client.pipeline()
+            for device_id in contested:
+                pipeline.get(self.lease_key(device_id))
+            holders = pipeline.execute()
+            held.update(device_id for device_id, holder in zip(contested, holders) if holder == self.worker_id)
+        with self._lock:
+            # Leases on devices that moved away are simply left to expire.
+            self.leased = held
+        return [device_id for device_id in device_ids if device_id in held]
+
+    def _renew(self, device_ids):
+        ttl_ms = int(self.lease_ttl * 1000)
+        self._on_own_leases(device_ids, lambda pipeline, key: pipeline.pexpire(key, ttl_ms))
+
+    def _on_own_leases(self, device_ids, command):
+        """
+        Apply command(pipeline, key) to the leases this worker still holds.
+        The keys are WATCHed, so a lease that expires and is taken by another
+        worker between the check and the write aborts the transaction and the
+        check is repeated, rather than extending or deleting someone else's lease.
+        """
+        if not device_ids:
+            return
+        keys = [self.lease_key(device_id) for device_id in device_ids]
+        with self.client.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(*keys)
+                    holders = pipeline.mget(keys)
+                    pipeline.multi()
+                    for key, holder in zip(keys, holders):
+                        if holder == self.worker_id:
+                            command(pipeline, key)
+                    pipeline.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def start(self):
+        """Heartbeat from a background thread so a long sweep does not look like a dead worker."""
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._run, name='shard-heartbeat', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.lease_ttl / 3):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"Shard heartbeat failed for {self.worker_id}: {str(e)}")
+
+    def stop(self):
+        """Leave the ring and hand back leases so survivors pick up our devices immediately."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            leased = list(self.leased)
+            self.leased = set()
+        self._on_own_leases(leased, lambda pipeline, key: pipeline.delete(key))
+        self.client.zrem(self.workers_key, self.worker_id)
@@ -0,0 +1,394 @@
+"""
+Spatial lookups over current device positions.
+
+Positions are bucketed into geohash cells. ``Device.last_geohash`` holds each
+device's latest position at GEOHASH_LENGTH characters (about 5 m), so
+``in_bbox`` can narrow a queryset with indexed prefix matches. The in-process
+SpatialIndex keeps the occupied cells of every precision up to GPS_SPATIAL_PRECISION
+characters (default 6, about 1.2 x 0.6 km) as a tree and answers bbox,
+radius and k-nearest queries without touching the database.
+
+A cell at precision p is the (row, col) pair of the geohash grid, which has
+2^floor(5p/2) rows of latitude and 2^ceil(5p/2) columns of longitude. Its
+geohash is the interleaved bits of row and col, so the two forms are
+interchangeable.
+
+The index is built on first use. Ingest in this process updates it when its
+transaction commits (see utils.save_latest_points), and other writers are
+picked up every GPS_SPATIAL_REFRESH_INTERVAL seconds by reading the devices
+whose latest reading is newer than the previous refresh minus
+GPS_SPATIAL_REFRESH_LAG seconds. Readings delivered later than that, and
+deleted devices, are caught by a full reload every GPS_SPATIAL_RELOAD_INTERVAL
+seconds. Queries that take ``device_ids`` only return those devices, so a
+user never sees a device they cannot access (see visible_device_ids).
+"""
+import heapq
+import threading
+import time
+from datetime import timedelta
+from math import asin, cos, degrees, radians, sin
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from device import geodesy
+from device.models import Device
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_LENGTH = 9
+MAX_PREFIXES = 16
+METRES_PER_DEGREE = radians(1) * geodesy.EARTH_RADIUS_M
+MAX_WALK = 1024
+SMALL_SCOPE = 256
+
+
+def grid_size(precision):
+    """(rows, cols) of the geohash grid at precision characters."""
+    bits = 5 * precision
+    return 1 << (bits // 2), 1 << ((bits + 1) // 2)
+
+
+def cell_of(latitude, longitude, precision):
+    rows, cols = grid_size(precision)
+    row = min(int((latitude + 90) / 180 * rows), rows - 1)
+    col = min(int((longitude + 180) / 360 * cols), cols - 1)
+    return max(row, 0), max(col, 0)
+
+
+def cell_geohash(cell, precision):
+    row, col = cell
+    lat_bits, lon_bits = (5 * precision) // 2, (5 * precision + 1) // 2
+    value = 0
+    for i in range(5 * precision):
+        # Geohash interleaves bits starting with longitude, most significant first
+        if i % 2 == 0:
+            lon_bits -= 1
+            value = (value << 1) | ((col >> lon_bits) & 1)
+        else:
+            lat_bits -= 1
+            value = (value << 1) | ((row >> lat_bits) & 1)
+    return ''.join(BASE32[(value >> shift) & 31] for shift in range(5 * (precision - 1), -1, -5))
+
+
+def encode(latitude, longitude, precision=GEOHASH_LENGTH):
+    return cell_geohash(cell_of(latitude, longitude, precision), precision)
+
+
+def cell_ranges(south, west, north, east, precision):
+    """
+    Inclusive (first row, last row, first col, last col) ranges of the cells
+    a bbox touches. A bbox with west > east crosses the antimeridian and
+    becomes two ranges.
+    """
+    if west > east:
+        return cell_ranges(south, west, north, 180, precision) + cell_ranges(south, -180, north, east, precision)
+    first_row, first_col = cell_of(south, west, precision)
+    last_row, last_col = cell_of(north, east, precision)
+    return [(first_row, last_row, first_col, last_col)]
+
+
+def range_size(ranges):
+    return sum((last_row - first_row + 1) * (last_col - first_col + 1) for first_row, last_row, first_col, last_col in ranges)
+
+
+def inside_bbox(latitude, longitude, south, west, north, east):
+    if not south <= latitude <= north:
+        return False
+    return west <= longitude <= east if west <= east else longitude >= west or longitude <= east
+
+
+def radius_bbox(latitude, longitude, radius):
+    """(south, west, north, east) enclosing every point within radius metres."""
+    delta = degrees(radius / geodesy.EARTH_RADIUS_M)
+    south, north = max(latitude - delta, -90), min(latitude + delta, 90)
+    if south == -90 or north == 90 or delta >= 90:
+        return south, -180, north, 180
+    # Widest longitude span of the circle, reached away from the centre's parallel
+    ratio = sin(radians(delta)) / cos(radians(latitude))
+    if ratio >= 1:
+        return south, -180, north, 180
+    delta_lon = degrees(asin(ratio))
+    west, east = longitude - delta_lon, longitude + delta_lon
+    return south, (west + 540) % 360 - 180, north, (east + 540) % 360 - 180
+
+
+def in_bbox(queryset, south, west, north, east):
+    """
+    Filter a Device queryset to the devices whose latest position is inside
+    the bbox, using prefix matches on the indexed last_geohash column when the
+    bbox is small enough to be covered by a few cells.
+    """
+    precision = GEOHASH_LENGTH
+    ranges = cell_ranges(south, west, north, east, precision)
+    while precision > 1 and range_size(ranges) > MAX_PREFIXES:
+        precision -= 1
+        ranges = cell_ranges(south, west, north, east, precision)
+    if range_size(ranges) <= MAX_PREFIXES:
+        condition = Q(pk__in=[])
+        for first_row, last_row, first_col, last_col in ranges:
+            for row in range(first_row, last_row + 1):
+                for col in range(first_col, last_col + 1):
+                    condition |= Q(last_geohash__startswith=cell_geohash((row, col), precision))
+        queryset = queryset.filter(condition)
+    queryset = queryset.filter(last_latitude__gte=south, last_latitude__lte=north)
+    if west <= east:
+        return queryset.filter(last_longitude__gte=west, last_longitude__lte=east)
+    return queryset.filter(Q(last_longitude__gte=west) | Q(last_longitude__lte=east))
+
+
+def visible_device_ids(user):
+    """Pks of the devices a user owns or has been shared."""
+    return set(Device.objects.filter(Q(user=user) | Q(deviceshare__shared_with=user)).values_list('pk', flat=True))
+
+
+def _in_ranges(cell, ranges):
+    row, col = cell
+    return any(first_row <= row <= last_row and first_col <= col <= last_col
+               for first_row, last_row, first_col, last_col in ranges)
+
+
+class SpatialIndex:
+    """
+    Latest position per device (keyed by Device pk) in a tree of geohash
+    cells: ``levels[i]`` holds the occupied cells at precision i + 1, each
+    mapped to its occupied cells one character finer, and the finest level
+    (GPS_SPATIAL_PRECISION) maps cells to device pks. Queries walk down from
+    the 32 one-character cells, so they only visit cells near the answer
+    however the devices are spread. They return pks, or (pk, metres) pairs
+    nearest first.
+    """
+
+    def __init__(self, precision=None, clock=time.time):
+        self.precision = precision or getattr(settings, 'GPS_SPATIAL_PRECISION', 6)
+        self.levels = [{} for _ in range(self.precision)]
+        # Cell height and width in degrees per level
+        self.steps = [(180 / rows, 360 / cols) for rows, cols in map(grid_size, range(1, self.precision + 1))]
+        # Bits dropped from (row, col) going from precision level + 2 to level + 1
+        self.shifts = [(5 * (level + 1) // 2 - 5 * level // 2, (5 * (level + 1) + 1) // 2 - (5 * level + 1) // 2)
+                       for level in range(1, self.precision)]
+        self.clock = clock
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.refreshed_at = None
+        self.next_refresh = 0
+        self.next_reload = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _add(self, pk, cell):
+        members = self.levels[-1].setdefault(cell, set())
+        members.add(pk)
+        for level in range(self.precision - 2, -1, -1):
+            if len(members) > 1:
+                return
+            row_shift, col_shift = self.shifts[level]
+            parent = (cell[0] >> row_shift, cell[1] >> col_shift)
+            members = self.levels[level].setdefault(parent, set())
+            members.add(cell)
+            cell = parent
+
+    def _discard(self, pk, cell):
+        members, item = self.levels[-1].get(cell), pk
+        for level in range(self.precision - 1, -1, -1):
+            members.discard(item)
+            if members:
+                return
+            del self.levels[level][cell]
+            if level:
+                row_shift, col_shift = self.shifts[level - 1]
+                item, cell = cell, (cell[0] >> row_shift, cell[1] >> col_shift)
+                members = self.levels[level - 1][cell]
+
+    def _move(self, pk, latitude, longitude, timestamp):
+        current = self.positions.get(pk)
+        cell = cell_of(latitude, longitude, self.precision)
+        if current is not None:
+            if timestamp is not None and current[2] is not None and timestamp < current[2]:
+                return
+            if current[3] != cell:
+                self._discard(pk, current[3])
+        if current is None or current[3] != cell:
+            self._add(pk, cell)
+        self.positions[pk] = (latitude, longitude, timestamp, cell)
+
+    def update_many(self, points):
+        """Record {device pk: DeviceData or DeviceState}, keeping whichever point is newer."""
+        with self.lock:
+            for pk, point in points.items():
+                self._move(pk, point.latitude, point.longitude, point.timestamp)
+
+    def remove(self, device_pk):
+        with self.lock:
+            current = self.positions.pop(device_pk, None)
+            if current is not None:
+                self._discard(device_pk, current[3])
+
+    @staticmethod
+    def _rows(devices):
+        return list(devices.filter(last_timestamp__isnull=False).values_list(
+            'pk', 'last_latitude', 'last_longitude', 'last_timestamp').iterator(chunk_size=5000))
+
+    def load(self):
+        """Rebuild from the Device rows' latest-position columns in one query."""
+        now = self.clock()
+        refreshed_at = timezone.now()
+        index = SpatialIndex(self.precision, self.clock)
+        for row in self._rows(Device.objects.all()):
+            index._move(*row)
+        with self.lock:
+            self.levels, self.positions = index.levels, index.positions
+            self.refreshed_at = refreshed_at
+        self.next_refresh = now + getattr(settings, 'GPS_SPATIAL_REFRESH_INTERVAL', 5)
+        self.next_reload = now + getattr(settings, 'GPS_SPATIAL_RELOAD_INTERVAL', 600)
+        return len(self.positions)
+
+    def refresh(self, now=None):
+        """Pick up positions written by other processes; a no-op until the refresh interval has passed."""
+        now = self.clock() if now is None else now
+        if now >= self.next_reload:
+            self.load()
+            return
+        if now < self.next_refresh:
+            return
+        self.next_refresh = now + getattr(settings, 'GPS_SPATIAL_REFRESH_INTERVAL', 5)
+        since = self.refreshed_at - timedelta(seconds=getattr(settings, 'GPS_SPATIAL_REFRESH_LAG', 60))
+        self.refreshed_at = timezone.now()
+        rows = self._rows(Device.objects.filter(last_timestamp__gte=since))
+        with self.lock:
+            for row in rows:
+                self._move(*row)
+
+    def _candidates(self, south, west, north, east, device_ids):
+        """
+        Pks that may lie in the bbox: the scope if it is small, else the
+        finest cells the bbox covers if there are few of them, else the
+        occupied cells found by walking down the tree.
+        """
+        if device_ids is not None and len(device_ids) <= SMALL_SCOPE:
+            return [pk for pk in device_ids if pk in self.positions]
+        ranges = [cell_ranges(south, west, north, east, level + 1) for level in range(self.precision)]
+        finest = self.levels[-1]
+        if range_size(ranges[-1]) <= min(len(finest), MAX_WALK):
+            pks = [pk for first_row, last_row, first_col, last_col in ranges[-1]
+                   for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)
+                   for pk in finest.get((row, col), ())]
+        else:
+            stack = [(0, cell) for cell in self.levels[0] if _in_ranges(cell, ranges[0])]
+            pks = []
+            while stack:
+                level, cell = stack.pop()
+                if level == self.precision - 1:
+                    pks.extend(finest[cell])
+                else:
+                    stack.extend((level + 1, child) for child in self.levels[level][cell]
+                                 if _in_ranges(child, ranges[level + 1]))
+        return pks if device_ids is None else [pk for pk in pks if pk in device_ids]
+
+    def bbox(self, south, west, north, east, device_ids=None):
+        """Pks of the devices inside the bbox; west > east crosses the antimeridian."""
+        with self.lock:
+            return [pk for pk in self._candidates(south, west, north, east, device_ids)
+                    if inside_bbox(*self.positions[pk][:2], south, west, north, east)]
+
+    def radius(self, latitude, longitude, radius, device_ids=None):
+        """(pk, metres) of the devices within radius metres, nearest first."""
+        with self.lock:
+            found = [(pk, geodesy.haversine(latitude, longitude, *self.positions[pk][:2]))
+                     for pk in self._candidates(*radius_bbox(latitude, longitude, radius), device_ids)]
+        return sorted((pair for pair in found if pair[1] <= radius), key=lambda pair: pair[1])
+
+    def _cell_distance(self, latitude, longitude, factor, level, cell):
+        """Lower bound, in metres, on the distance from a point to anything in a cell; factor is cos(latitude)."""
+        lat_step, lon_step = self.steps[level]
+        south = cell[0] * lat_step - 90
+        distance = max(south - latitude, latitude - south - lat_step, 0) * METRES_PER_DEGREE
+        west = cell[1] * lon_step - 180
+        if west <= longitude <= west + lon_step:
+            return distance
+        # A path into the cell crosses the great circle of its west or east meridian
+        meridian = min(abs(sin(radians(longitude - west))), abs(sin(radians(longitude - west - lon_step))))
+        return max(distance, geodesy.EARTH_RADIUS_M * asin(min(factor * meridian, 1)))
+
+    def _block_clearance(self, latitude, longitude, factor, row, col):
+        """Lower bound, in metres, on the distance from a point in finest cell (row, col) to anything outside its 3 x 3 block."""
+        lat_step, lon_step = self.steps[-1]
+        south, west = (row - 1) * lat_step - 90, (col - 1) * lon_step - 180
+        north, east = south + 3 * lat_step, west + 3 * lon_step
+        clearance = min(latitude - south if south > -90 else 180, north - latitude if north < 90 else 180)
+        clearance *= METRES_PER_DEGREE
+        delta = min(longitude - west, east - longitude)
+        if delta >= 90:
+            return clearance
+        return min(clearance, geodesy.EARTH_RADIUS_M * asin(min(factor * sin(radians(delta)), 1)))
+
+    def nearest(self, latitude, longitude, k=1, device_ids=None):
+        """
+        The k devices nearest to the point as (pk, metres), nearest first.
+        The point's finest cell and its neighbours are read first; the rest
+        of the tree is then opened closest cell first until the next cell
+        cannot hold anything nearer than the k-th device found.
+        """
+        if k < 1:
+            return []
+        best = []
+
+        def consider(pks):
+            for pk in pks:
+                if device_ids is None or pk in device_ids:
+                    distance = geodesy.haversine(latitude, longitude, *self.positions[pk][:2])
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, pk))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, pk))
+
+        with self.lock:
+            if device_ids is not None and len(device_ids) <= SMALL_SCOPE:
+                consider([pk for pk in device_ids if pk in self.positions])
+                return sorted(((pk, -distance) for distance, pk in best), key=lambda pair: pair[1])
+            finest, last = self.levels[-1], self.precision - 1
+            row, col = cell_of(latitude, longitude, self.precision)
+            rows, cols = grid_size(self.precision)
+            seen = {(r, c % cols) for r in range(row - 1, row + 2) for c in range(col - 1, col + 2) if 0 <= r < rows}
+            for cell in seen:
+                consider(finest.get(cell, ()))
+            factor = cos(radians(latitude))
+            if len(best) == k and -best[0][0] <= self._block_clearance(latitude, longitude, factor, row, col):
+                return sorted(((pk, -distance) for distance, pk in best), key=lambda pair: pair[1])
+            heap = [(self._cell_distance(latitude, longitude, factor, 0, cell), 0, cell) for cell in self.levels[0]]
+            heapq.heapify(heap)
+            while heap:
+                bound, level, cell = heapq.heappop(heap)
+                if len(best) == k and bound >= -best[0][0]:
+                    break
+                if level == last:
+                    if cell not in seen:
+                        consider(finest[cell])
+                    continue
+                for child in self.levels[level][cell]:
+                    distance = self._cell_distance(latitude, longitude, factor, level + 1, child)
+                    if len(best) < k or distance < -best[0][0]:
+                        heapq.heappush(heap, (distance, level + 1, child))
+        return sorted(((pk, -distance) for distance, pk in best), key=lambda pair: pair[1])
+
+
+_index = None
+
+
+def get_index():
+    """Process-wide index, loaded on first use and refreshed from the database as it is used."""
+    global _index
+    if _index is None:
+        index = SpatialIndex()
+        index.load()
+        _index = index
+    else:
+        _index.refresh()
+    return _index
+
+
+def index_points(points):
+    """Move {device pk: point} in this process's index, if it has one; ingest calls this on commit."""
+    if _index is not None:
+        _index.update_many(points)
@@ -0,0 +1,201 @@
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from device.models import Device
+from device.utils import latest_data_for_devices
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class DeviceState:
+    """
+    Compact copy of a device's latest point. It has the attributes
+    calculate_speed/calculate_heading and the ingest rules read from a
+    DeviceData, so it can stand in for one. ``status`` is the on/off state the
+    rollups track for status changes (see device.rollups). When the latest
+    reading was dropped by compression, ``anchor`` is the state of the last
+    stored point (see device.compression).
+    """
+    __slots__ = ('latitude', 'longitude', 'timestamp', 'speed', 'heading', 'power_source', 'charge', 'odometer', 'status',
+                 'dwell', 'anchor', 'altitude')
+
+    def __init__(self, latitude, longitude, timestamp, speed=0, heading=0, power_source='battery', charge=0, odometer=0,
+                 status=None, dwell=0, anchor=None, altitude=0):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timestamp = timestamp
+        self.speed = speed
+        self.heading = heading
+        self.power_source = power_source
+        self.charge = charge
+        self.odometer = odometer
+        self.status = status
+        self.dwell = dwell
+        self.anchor = anchor
+        self.altitude = altitude
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(data.latitude, data.longitude, data.timestamp, data.speed, data.heading, data.power_source, data.charge,
+                   data.odometer, getattr(data, 'status', None), getattr(data, 'dwell', 0),
+                   altitude=getattr(data, 'altitude', 0))
+
+    @classmethod
+    def from_device(cls, device):
+        """The latest reading held in a Device row's last_* columns."""
+        return cls(device.last_latitude, device.last_longitude, device.last_timestamp, device.last_speed,
+                   device.last_heading, device.last_power_source, device.last_charge, device.odometer,
+                   altitude=device.last_altitude)
+
+    def _fields(self):
+        epoch_us = (self.timestamp - EPOCH) // timedelta(microseconds=1)
+        return [self.latitude, self.longitude, epoch_us, self.speed, self.heading, self.power_source, self.charge,
+                self.odometer, self.status, self.dwell, self.anchor._fields() if self.anchor else None, self.altitude]
+
+    @classmethod
+    def _from_fields(cls, fields):
+        latitude, longitude, epoch_us, *rest = fields
+        state = cls(latitude, longitude, EPOCH + timedelta(microseconds=epoch_us), *rest)
+        if state.anchor:
+            state.anchor = cls._from_fields(state.anchor)
+        return state
+
+    def dumps(self):
+        return json.dumps(self._fields(), separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, raw):
+        return cls._from_fields(json.loads(raw))
+
+
+def load_states(device_ids=None, lock=False):
+    """
+    {device pk: DeviceState} from the Device rows' last_* columns in one
+    query. For compressing devices whose latest reading was not stored, the
+    last stored point is looked up as the anchor. With lock, inside a
+    transaction, the Device rows are locked (SELECT ... FOR UPDATE) until it
+    ends, so no other writer can store a point for them in the meantime.
+    """
+    devices = Device.objects.all() if device_ids is None else Device.objects.filter(pk__in=device_ids)
+    if lock and connection.in_atomic_block:
+        devices = devices.select_for_update().order_by('pk')
+    states, compressing = {}, []
+    for device in devices:
+        if device.last_timestamp is None:
+            continue
+        states[device.pk] = DeviceState.from_device(device)
+        if device.compression_tolerance:
+            compressing.append(device.pk)
+    if compressing:
+        for pk, data in latest_data_for_devices(compressing).items():
+            if data.timestamp < states[pk].timestamp:
+                states[pk].anchor = DeviceState.from_data(data)
+    return states
+
+
+class LastKnownStateStore:
+    """
+    Latest point per device (keyed by Device pk), so ingest never has to read
+    the previous point back from DeviceData.
+
+    By default nothing is kept between calls: every lookup reads the Device
+    rows' latest-reading columns (see load_states) in one query, locking the
+    rows when called inside a transaction. That is correct with any number of
+    writing processes (web workers, pollers, listeners, consumers), because
+    a writer reads its predecessor and stores its point under the same lock.
+
+    With ``cache`` the store lives in process memory instead. That is only
+    correct while this process is the sole writer for its devices, such as a
+    sharded poller that nothing else writes for, or one whose write-behind
+    buffer runs ahead of the database.
+
+    With a Redis client the hash at ``key`` is the shared copy: lookups read
+    it in one round trip and writes go through to it, and it has no TTL, so a
+    device that goes quiet keeps its previous point. Every writer has to use
+    it for it to stay current. Misses fall back to the Device rows.
+    """
+
+    def __init__(self, redis_client=None, key='gps:state', cache=False):
+        self.redis = redis_client
+        self.key = key
+        self.cache = cache or redis_client is not None
+        self.states = {}
+
+    def warm_start(self, device_ids=None):
+        """Load the latest point of every (or the given) device in one query."""
+        states = load_states(device_ids)
+        if not self.cache:
+            return len(states)
+        self.states.update(states)
+        if self.redis and states:
+            self.redis.hset(self.key, mapping={pk: state.dumps() for pk, state in states.items()})
+        return len(states)
+
+    def get(self, device_pk):
+        return self.get_many([device_pk]).get(device_pk)
+
+    def get_many(self, device_pks):
+        device_pks = list(dict.fromkeys(device_pks))
+        if not self.cache:
+            return load_states(device_pks, lock=True)
+        found = {}
+        if self.redis:
+            for pk, raw in zip(device_pks, self.redis.hmget(self.key, device_pks) if device_pks else []):
+                if raw:
+                    found[pk] = DeviceState.loads(raw)
+            self.states.update(found)
+        else:
+            found = {pk: self.states[pk] for pk in device_pks if pk in self.states}
+        missing = [pk for pk in device_pks if pk not in found]
+        if missing:
+            loaded = load_states(missing)
+            self.put_many(loaded)
+            found.update(loaded)
+        return found
+
+    def put(self, device_pk, data):
+        self.put_many({device_pk: data})
+
+    def put_many(self, points):
+        """Record {device pk: DeviceData or DeviceState}, keeping whichever point is newer."""
+        if not self.cache:
+            return
+        updates = {}
+        for pk, data in points.items():
+            current = self.states.get(pk)
+            if current is None or data.timestamp >= current.timestamp:
+                state = data if isinstance(data, DeviceState) else DeviceState.from_data(data)
+                self.states[pk] = updates[pk] = state
+        if self.redis and updates:
+            self.redis.hset(self.key, mapping={pk: state.dumps() for pk, state in updates.items()})
+
+    def put_on_commit(self, points):
+        """put_many once the surrounding transaction commits, so rolled-back rows never become state."""
+        transaction.on_commit(lambda: self.put_many(points))
+
+    def forget(self, device_pk):
+        self.states.pop(device_pk, None)
+        if self.redis:
+            self.redis.hdel(self.key, device_pk)
+
+
+_store = None
+
+
+def get_state_store():
+    """
+    Process-wide store. It reads the Device rows unless GPS_STATE_REDIS = True
+    backs it with the shared Redis, or GPS_STATE_CACHE = True keeps it in
+    memory for a process that is the only writer of its devices.
+    """
+    global _store
+    if _store is None:
+        redis_client = None
+        if getattr(settings, 'GPS_STATE_REDIS', False):
+            from device.redis_client import get_redis_client
+            redis_client = get_redis_client()
+        _store = LastKnownStateStore(redis_client, cache=getattr(settings, 'GPS_STATE_CACHE', False))
+    return _store
@@ -0,0 +1,162 @@
+"""
+Redis Streams hand-off between pollers and database writers.
+
+Producers XADD one entry per raw reading to ``gps:readings``. Writer processes
+share the ``gps-writers`` consumer group, so each entry is delivered to a
+single writer and only XACKed after its batch is committed. Entries left
+pending by a crashed writer are taken over with XAUTOCLAIM once they have
+been idle for ``claim_idle`` seconds. Entries that keep failing are moved to
+``gps:readings:dead``.
+
+A consumer that cannot reach the database keeps its batch and retries it
+rather than reading or claiming more (see consume_gps_stream); ``hold`` keeps
+the batch from looking abandoned meanwhile, so a long outage does not count
+as failed deliveries and bury valid readings. Producers and consumers run in
+separate processes, so they need a real Redis, not fakeredis://.
+"""
+import logging
+import os
+import socket
+
+import redis
+
+from device.models import Device
+from device.utils import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+STREAM = 'gps:readings'
+GROUP = 'gps-writers'
+
+
+def reading_to_entry(reading):
+    """Flat string fields for a process_device_data kwargs dict."""
+    return {
+        'device': reading['device'].pk,
+        'latitude': reading['latitude'],
+        'longitude': reading['longitude'],
+        'altitude': reading.get('altitude', 0),
+        'charge': reading['charge'],
+        'timestamp': reading['timestamp'].isoformat(),
+        'power_source': reading['power_source'],
+        'speed': reading.get('speed', 0),
+        'heading': reading.get('heading', 0),
+    }
+
+
+def entry_to_reading(fields, devices):
+    """process_device_data kwargs for a stream entry; raises ValueError/KeyError for a bad one."""
+    device = devices[int(fields['device'])]
+    timestamp = parse_timestamp(fields['timestamp'])
+    if not timestamp:
+        raise ValueError(f"invalid timestamp {fields['timestamp']!r}")
+    return {
+        'device': device,
+        'latitude': float(fields['latitude']),
+        'longitude': float(fields['longitude']),
+        'altitude': float(fields.get('altitude', 0)),
+        'charge': int(fields['charge']),
+        'timestamp': timestamp,
+        'power_source': fields['power_source'],
+        'speed': float(fields.get('speed', 0)),
+        'heading': float(fields.get('heading', 0)),
+    }
+
+
+class StreamProducer:
+    """Appends readings to the stream, capped at roughly ``maxlen`` entries."""
+
+    def __init__(self, client, stream=STREAM, maxlen=1000000):
+        self.client = client
+        self.stream = stream
+        self.maxlen = maxlen
+
+    def publish(self, readings):
+        pipe = self.client.pipeline(transaction=False)
+        for reading in readings:
+            pipe.xadd(self.stream, reading_to_entry(reading), maxlen=self.maxlen, approximate=True)
+        return len(pipe.execute())
+
+
+class StreamConsumer:
+    """One member of the writer consumer group."""
+
+    def __init__(self, client, consumer=None, stream=STREAM, group=GROUP, batch_size=500, block=5,
+                 claim_idle=60, max_deliveries=5):
+        self.client = client
+        self.consumer = consumer or f"{socket.gethostname()}:{os.getpid()}"
+        self.stream = stream
+        self.group = group
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self.claim_cursor = '0-0'
+
+    def ensure_group(self):
+        try:
+            self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def claim(self):
+        """Take over entries other consumers have left unacknowledged for claim_idle seconds."""
+        self.claim_cursor, entries, *_ = self.client.xautoclaim(
+            self.stream, self.group, self.consumer, min_idle_time=int(self.claim_idle * 1000),
+            start_id=self.claim_cursor, count=self.batch_size,
+        )
+        entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+        return self.bury_poison(entries) if entries else []
+
+    def bury_poison(self, entries):
+        """Move entries delivered more than max_deliveries times to the dead-letter stream; returns the rest."""
+        pending = self.client.xpending_range(self.stream, self.group, entries[0][0], entries[-1][0],
+                                             len(entries), consumername=self.consumer)
+        deliveries = {row['message_id']: row['times_delivered'] for row in pending}
+        poison = [entry_id for entry_id, _ in entries if deliveries.get(entry_id, 0) > self.max_deliveries]
+        if not poison:
+            return entries
+        pipe = self.client.pipeline()
+        for entry_id, fields in entries:
+            if entry_id in poison:
+                pipe.xadd(f"{self.stream}:dead", dict(fields, source_id=entry_id))
+        pipe.xack(self.stream, self.group, *poison)
+        pipe.execute()
+        logger.error(f"Moved {len(poison)} repeatedly failing entries to {self.stream}:dead")
+        return [(entry_id, fields) for entry_id, fields in entries if entry_id not in poison]
+
+    def read(self):
+        """Next batch of (entry id, fields): reclaimed entries first, then new ones (blocking up to ``block`` seconds)."""
+        entries = self.claim()
+        if entries:
+            return entries
+        response = self.client.xreadgroup(self.group, self.consumer, {self.stream: '>'}, count=self.batch_size,
+                                          block=int(self.block * 1000))
+        return response[0][1] if response else []
+
+    def hold(self, entry_ids):
+        """Reset the idle time of entries this consumer is still working on, without counting a delivery."""
+        if entry_ids:
+            self.client.xclaim(self.stream, self.group, self.consumer, 0, entry_ids, justid=True)
+
+    def ack(self, entry_ids):
+        if entry_ids:
+            self.client.xack(self.stream, self.group, *entry_ids)
+
+    def process(self, entries, save_fn):
+        """
+        Decode a batch, hand the readings to save_fn and acknowledge the batch.
+        Undecodable entries are acknowledged and dropped. If save_fn raises,
+        nothing is acknowledged and the batch is reclaimed after claim_idle.
+        """
+        devices = Device.objects.in_bulk({int(fields['device']) for _, fields in entries if fields.get('device', '').isdigit()})
+        readings = []
+        for entry_id, fields in entries:
+            try:
+                readings.append(entry_to_reading(fields, devices))
+            except (KeyError, ValueError, TypeError) as e:
+                logger.error(f"Dropping unreadable stream entry {entry_id}: {str(e)}")
+        saved = save_fn(readings)
+        self.ack([entry_id for entry_id, _ in entries])
+        return saved
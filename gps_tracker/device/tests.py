@@ -1,3 +1,1269 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import importlib
+import io
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+import uuid
 
-# Create your tests here.
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+
+import redis
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DataError, connection
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from device import alerts, archive, backfill, compact, geodesy, listener, partitions, poller, rollups, spatial
+from device.buffer import WriteBehindBuffer
+from device.compact import decode_deltas
+from device.geodesy import haversine
+from device.ingest import TooManyItems, ingest_items
+from device.management.commands import fetch_gps_redis, fix_devicedata_timestamps
+from device.metrics import INGEST_LAG_SECONDS, Registry, observe_batch
+from device.models import AlertState, BackfillCheckpoint, Device, DeviceData, DeviceRollup, DeviceShare, Geofence, Notification, SpeedAlert
+from device.health import PollHealth
+from device.scheduler import PollScheduler
+from device.sharding import ShardCoordinator
+from device.state import LastKnownStateStore, load_states
+from device.streams import GROUP, STREAM, StreamConsumer, StreamProducer
+from device.utils import (calculate_heading, calculate_speed, process_device_data, process_device_data_batch,
+                          save_latest_points, save_readings, store_readings)
+
+try:
+    import fakeredis
+except ImportError:  # optional: the fake-Redis tests are skipped
+    fakeredis = None
+
+
+class PollerTests(SimpleTestCase):
+    device = mock.Mock(device_id='tracker-1')
+
+    def payload(self, **values):
+        return {'device_id': 'tracker-1', 'event_time': '2026-01-05T12:00:00+00:00', 'latitude': '10.5',
+                'longitude': 77.5, 'Charge': 80, 'power_source': 'direct', **values}
+
+    def test_parses_vendor_payload(self):
+        reading = poller.parse_api_data(self.device, self.payload())
+        self.assertEqual((reading['latitude'], reading['charge']), (10.5, 80))
+        self.assertEqual(reading['timestamp'], datetime(2026, 1, 5, 12, tzinfo=dt_timezone.utc))
+
+    def test_malformed_payloads_are_skipped(self):
+        for api_data in (42, ['latitude'], 'text', self.payload(event_time=1767614400), self.payload(Charge='full'),
+                         self.payload(event_time='2026-01-05 12:00:00'), self.payload(latitude='nan'),
+                         self.payload(longitude=float('inf')), self.payload(latitude=91)):
+            self.assertIsNone(poller.parse_api_data(self.device, api_data), api_data)
+
+    def test_poll_devices_keeps_input_order(self):
+        devices = [mock.Mock(device_id=str(i)) for i in range(5)]
+
+        def fetch(session, api_url, device, timeout):
+            time.sleep(0.01 * (5 - int(device.device_id)))
+            return None if device.device_id == '2' else {'device_id': device.device_id}
+
+        with mock.patch('device.poller.fetch_device', side_effect=fetch):
+            results = poller.poll_devices(devices, 'http://vendor.invalid/', concurrency=5)
+        self.assertEqual([device for device, _ in results], devices)
+        self.assertEqual([api_data and api_data['device_id'] for _, api_data in results], ['0', '1', None, '3', '4'])
+
+
+class PollHealthTests(SimpleTestCase):
+    device = mock.Mock(pk=1, device_id='tracker-1')
+
+    def setUp(self):
+        self.health = PollHealth(failure_threshold=3, base_backoff=4, max_backoff=10, open_interval=600,
+                                 stationary_interval=30, stationary_radius=25, history=3, jitter=0, clock=lambda: 0)
+
+    def fix(self, latitude):
+        return {'latitude': latitude, 'longitude': 77.5}
+
+    def test_failures_back_off_then_open_the_circuit(self):
+        self.enterContext(self.assertLogs('device.health', 'INFO'))
+        self.assertEqual([self.health.record(self.device, None, 100) for _ in range(2)], [104, 108])
+        self.assertFalse(self.health.allow(1, 107))
+        self.assertEqual(self.health.record(self.device, None, 100), 700)
+        self.assertEqual(self.health.summary()['open'], 1)
+        self.assertFalse(self.health.allow(1, 699))
+        self.assertTrue(self.health.allow(1, 700))
+        self.assertEqual(self.health.get(1).state, 'half-open')
+        # A failed trial reopens the circuit at once, a good one closes it
+        self.assertEqual(self.health.record(self.device, None, 700), 1300)
+        self.assertTrue(self.health.allow(1, 1300))
+        self.assertEqual(self.health.record(self.device, self.fix(10.0), 1300), 1300)
+        self.assertEqual((self.health.get(1).state, self.health.get(1).failures), ('closed', 0))
+
+    def test_backoff_is_capped(self):
+        self.health.failure_threshold = 100
+        delays = [self.health.record(self.device, None, 0) for _ in range(5)]
+        self.assertEqual(delays, [4, 8, 10, 10, 10])
+
+    def test_stationary_devices_are_polled_less_often(self):
+        self.assertEqual([self.health.record(self.device, self.fix(10.0), 0) for _ in range(2)], [0, 0])
+        self.assertEqual(self.health.record(self.device, self.fix(10.0001), 0), 30)
+        self.assertEqual(self.health.summary()['stationary'], 1)
+        self.assertEqual(self.health.record(self.device, self.fix(10.01), 40), 40)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        registry = Registry()
+        latency = registry.histogram('test_seconds', 'Test latency', ['writer'], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value, writer='a')
+        registry.counter('test_total', 'Test count').inc(2)
+        text = registry.render()
+        for line in ('# TYPE test_seconds histogram', 'test_seconds_bucket{writer="a",le="0.1"} 2',
+                     'test_seconds_bucket{writer="a",le="1"} 3', 'test_seconds_bucket{writer="a",le="+Inf"} 4',
+                     'test_seconds_sum{writer="a"} 3.65', 'test_seconds_count{writer="a"} 4', 'test_total 2'):
+            self.assertIn(line, text.splitlines())
+        self.assertEqual(registry.summary(), 'test_seconds=4/0.9125 test_total=2')
+
+    def test_registering_twice_returns_the_same_metric(self):
+        registry = Registry()
+        self.assertIs(registry.counter('test_total', 'Test'), registry.counter('test_total', 'Test'))
+
+    def test_observe_batch_records_lag(self):
+        before = INGEST_LAG_SECONDS.count_and_sum()
+        observe_batch('test', [datetime.fromtimestamp(90, dt_timezone.utc)], 0.01, now=100)
+        after = INGEST_LAG_SECONDS.count_and_sum()
+        self.assertEqual((after[0] - before[0], after[1] - before[1]), (1, 10))
+
+    @override_settings(GPS_METRICS_TOKEN='secret')
+    def test_endpoint_requires_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE gps_batch_size histogram', response.content.decode())
+
+
+class CompactEncodingTests(SimpleTestCase):
+    def test_matches_google_polyline(self):
+        points = [(3850000, -12020000), (4070000, -12095000), (4325200, -12645300)]
+        deltas = [value for previous, point in zip([(0, 0)] + points, points) for value in
+                  (point[0] - previous[0], point[1] - previous[1])]
+        self.assertEqual(compact.encode_ints(deltas), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_deltas_round_trip(self):
+        values = [0, 1, -1, 15, 16, -16, 2 ** 40, -(2 ** 40), 7, 7, 2 ** 62 // 3]
+        self.assertEqual(compact.decode_deltas(compact.encode_deltas(values)), values)
+        self.assertEqual(compact.encode_deltas([]), '')
+
+    def test_history_columns_round_trip(self):
+        start = datetime(2026, 1, 5, 12, tzinfo=dt_timezone.utc)
+        points = [mock.Mock(timestamp=start + timedelta(seconds=i * 1.5), latitude=-33.86 + i * 1e-6, longitude=151.2 - i * 1e-5,
+                            speed=i * 1.5, heading=(i * 47) % 360, altitude=-5 + i, charge=100 - i, dwell=i * 60,
+                            power_source=('battery', 'direct')[i % 2]) for i in range(6)]
+        encoded = compact.compact_history(points)
+        # decode_deltas sums the interleaved latitude/longitude deltas as one stream; undo that first
+        sums = compact.decode_deltas(encoded['path'])
+        deltas = [value - previous for previous, value in zip([0] + sums, sums)]
+        coordinates = list(zip(itertools.accumulate(deltas[0::2]), itertools.accumulate(deltas[1::2])))
+        self.assertEqual(coordinates, [(round(point.latitude * 1e6), round(point.longitude * 1e6)) for point in points])
+        self.assertEqual([encoded['time_start'] + offset for offset in compact.decode_deltas(encoded['time'])],
+                         [round(point.timestamp.timestamp() * 1000) for point in points])
+        self.assertEqual([value / 10 for value in compact.decode_deltas(encoded['speed'])], [point.speed for point in points])
+        self.assertEqual(compact.decode_deltas(encoded['altitude']), [point.altitude for point in points])
+        self.assertEqual(compact.decode_deltas(encoded['dwell']), [point.dwell for point in points])
+        self.assertEqual(compact.decode_deltas(encoded['power_source']), [i % 2 for i in range(6)])
+        self.assertEqual(compact.compact_history([])['time'], '')
+
+    def test_compress_response_follows_accept_encoding(self):
+        request = mock.Mock(META={'HTTP_ACCEPT_ENCODING': 'gzip;q=1.0, identity'})
+        response = compact.compress_response(request, HttpResponse('x' * 1000))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), b'x' * 1000)
+        self.assertFalse(compact.compress_response(mock.Mock(META={}), HttpResponse('x' * 1000)).has_header('Content-Encoding'))
+        self.assertFalse(compact.compress_response(request, HttpResponse('short')).has_header('Content-Encoding'))
+
+
+class ShardCoordinatorTests(SimpleTestCase):
+    """
+    Leases and rebalancing between pollers, each with its own connection to
+    one Redis: a fakeredis FakeServer shared by the workers, like separate
+    processes on one server. Set GPS_TEST_REDIS_URL to run the same tests
+    against a real Redis.
+    """
+    lease_ttl = 0.3
+    devices = [f"device-{i}" for i in range(200)]
+
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest('fakeredis is not installed')
+        server = fakeredis.FakeServer()
+        self.connect = lambda: fakeredis.FakeRedis(server=server, decode_responses=True)
+        self.prefix = f"test:shard:{uuid.uuid4().hex}"
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker._stop.set()
+
+    def worker(self, name):
+        worker = ShardCoordinator(self.connect(), worker_id=name, lease_ttl=self.lease_ttl, prefix=self.prefix)
+        self.workers.append(worker)
+        return worker
+
+    def test_acquire_splits_devices_without_overlap(self):
+        first, second = self.worker('a'), self.worker('b')
+        first.heartbeat(), second.heartbeat()
+        first.heartbeat()
+        held_first, held_second = set(first.acquire(self.devices)), set(second.acquire(self.devices))
+        self.assertFalse(held_first & held_second)
+        self.assertEqual(held_first | held_second, set(self.devices))
+        self.assertGreater(len(held_first), 50)
+        self.assertGreater(len(held_second), 50)
+
+    def test_acquire_renews_own_lease(self):
+        worker = self.worker('a')
+        worker.heartbeat()
+        self.assertEqual(worker.acquire(self.devices), self.devices)
+        time.sleep(self.lease_ttl / 2)
+        self.assertEqual(worker.acquire(self.devices), self.devices)
+
+    def test_heartbeat_renews_leases(self):
+        worker = self.worker('a')
+        worker.heartbeat()
+        worker.acquire(self.devices[:5])
+        time.sleep(self.lease_ttl / 2)
+        worker.heartbeat()
+        ttl = worker.client.pttl(worker.lease_key(self.devices[0]))
+        self.assertGreater(ttl, self.lease_ttl * 1000 * 0.75)
+
+    def test_renew_leaves_other_workers_leases_alone(self):
+        worker = self.worker('a')
+        worker.heartbeat()
+        worker.acquire(self.devices[:2])
+        # The lease expired and another worker took it before the renewal
+        worker.client.set(worker.lease_key(self.devices[0]), 'b', px=100000)
+        worker.heartbeat()
+        self.assertEqual(worker.client.get(worker.lease_key(self.devices[0])), 'b')
+        self.assertGreater(worker.client.pttl(worker.lease_key(self.devices[0])), 90000)
+        worker.stop()
+        self.assertEqual(worker.client.get(worker.lease_key(self.devices[0])), 'b')
+        self.assertIsNone(worker.client.get(worker.lease_key(self.devices[1])))
+
+    def test_dead_worker_is_rebalanced_after_lease_expiry(self):
+        first, second = self.worker('a'), self.worker('b')
+        first.heartbeat(), second.heartbeat()
+        first.heartbeat()
+        first.acquire(self.devices)
+        held_second = set(second.acquire(self.devices))
+        # b stops heartbeating; until its heartbeat and leases expire a keeps to its own share
+        time.sleep(self.lease_ttl / 3)
+        first.heartbeat()
+        self.assertFalse(set(first.acquire(self.devices)) & held_second)
+        time.sleep(self.lease_ttl)
+        self.assertEqual(first.heartbeat(), ['a'])
+        self.assertEqual(first.acquire(self.devices), self.devices)
+
+    def test_new_owner_waits_for_old_lease(self):
+        first = self.worker('a')
+        first.heartbeat()
+        first.acquire(self.devices)
+        second = self.worker('b')
+        second.heartbeat()
+        first.heartbeat()
+        moved = [device_id for device_id in self.devices if second.owns(device_id)]
+        self.assertTrue(moved)
+        # a still holds the leases of the devices that moved to b
+        self.assertEqual(second.acquire(self.devices), [])
+        self.assertFalse(set(first.acquire(self.devices)) & set(moved))
+        time.sleep(self.lease_ttl * 1.2)
+        self.assertEqual(second.acquire(self.devices), moved)
+
+    def test_stop_hands_devices_over_at_once(self):
+        first, second = self.worker('a'), self.worker('b')
+        first.heartbeat(), second.heartbeat()
+        first.heartbeat()
+        first.acquire(self.devices)
+        second.acquire(self.devices)
+        second.stop()
+        self.assertEqual(first.heartbeat(), ['a'])
+        self.assertEqual(first.acquire(self.devices), self.devices)
+
+    def test_workers_in_threads_never_share_a_device(self):
+        """Pollers polling concurrently with background heartbeats, one of them leaving half way."""
+        workers = [self.worker(name) for name in 'abc']
+        polled = {worker.worker_id: [] for worker in workers}
+        stopping = {worker.worker_id: threading.Event() for worker in workers}
+
+        def poll(worker):
+            worker.start()
+            while not stopping[worker.worker_id].is_set():
+                polled[worker.worker_id].append((time.monotonic(), set(worker.acquire(self.devices))))
+                time.sleep(0.02)
+            worker.stop()
+            polled[worker.worker_id].append((time.monotonic(), set()))
+
+        threads = {worker.worker_id: threading.Thread(target=poll, args=(worker,)) for worker in workers}
+        for thread in threads.values():
+            thread.start()
+        time.sleep(self.lease_ttl * 2)
+        stopping['c'].set()
+        threads['c'].join()
+        time.sleep(self.lease_ttl * 3)
+        final = {name: polled[name][-1][1] for name in 'ab'}
+        for name in 'ab':
+            stopping[name].set()
+            threads[name].join()
+        # At every sweep of one worker, no other worker's latest sweep holds the same device
+        sweeps = sorted((moment, name, held) for name, history in polled.items() for moment, held in history)
+        latest = {}
+        for moment, name, held in sweeps:
+            latest[name] = held
+            for other, other_held in latest.items():
+                if other != name:
+                    self.assertFalse(held & other_held, f"{name} and {other} both hold devices")
+        self.assertEqual(final['a'] | final['b'], set(self.devices))
+
+
+@unittest.skipUnless(os.environ.get('GPS_TEST_REDIS_URL'), 'set GPS_TEST_REDIS_URL to test against a real Redis')
+class RedisShardCoordinatorTests(ShardCoordinatorTests):
+    def setUp(self):
+        url = os.environ['GPS_TEST_REDIS_URL']
+        try:
+            redis.Redis.from_url(url).ping()
+        except redis.ConnectionError:
+            self.skipTest(f"No Redis at {url}")
+        self.connect = lambda: redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = f"test:shard:{uuid.uuid4().hex}"
+        self.workers = []
+
+
+def reading(device, latitude, timestamp, **values):
+    return {'device': device, 'latitude': latitude, 'longitude': 77.5, 'altitude': 0, 'charge': 50,
+            'timestamp': timestamp, 'power_source': 'direct', 'speed': 0, 'heading': 0, **values}
+
+
+class IngestTestCase(TestCase):
+    start = datetime(2026, 1, 5, 12, tzinfo=dt_timezone.utc)
+
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.device = Device.objects.create(user=self.user, device_id='tracker-1', device_password='secret')
+
+    def at(self, minutes):
+        return self.start + timedelta(minutes=minutes)
+
+    def odometers(self):
+        return list(DeviceData.objects.filter(device=self.device).order_by('timestamp').values_list('odometer', flat=True))
+
+
+class PollSchedulerTests(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        Device.objects.filter(pk=self.device.pk).update(last_timestamp=datetime.fromtimestamp(990, dt_timezone.utc),
+                                                        last_power_source='battery', update_interval=2)
+        self.direct = Device.objects.create(user=self.user, device_id='tracker-2', device_password='secret')
+        self.scheduler = PollScheduler(direct_interval=4, sync_interval=30, clock=lambda: self.now)
+        self.scheduler.load()
+
+    def due_ids(self, now):
+        return sorted(device.device_id for device in self.scheduler.pop_due(now))
+
+    def poll(self, device, now, timestamp=None, power_source='direct'):
+        reading = None
+        if timestamp is not None:
+            reading = {'power_source': power_source, 'timestamp': datetime.fromtimestamp(timestamp, dt_timezone.utc)}
+        self.scheduler.reschedule(device, reading, now)
+
+    def test_deadlines_follow_power_source(self):
+        self.assertEqual(self.due_ids(1000), ['tracker-2'])
+        self.poll(self.direct, 1000, timestamp=1000)
+        self.assertEqual(self.due_ids(1003.9), [])
+        self.assertEqual(self.due_ids(1004), ['tracker-2'])
+        # The battery device is next due update_interval minutes after its last reading
+        self.assertEqual(self.due_ids(1109), [])
+        self.assertEqual(self.due_ids(1110), ['tracker-1'])
+        self.assertEqual(self.scheduler.next_deadline(), 1030)
+
+    def test_stale_or_failed_polls_are_never_due_in_the_past(self):
+        self.due_ids(1000)
+        self.poll(self.direct, 1000, timestamp=100)
+        self.assertEqual(self.scheduler.due[self.direct.pk], 1004)
+        self.due_ids(1004)
+        self.poll(self.direct, 1004)
+        self.assertEqual(self.scheduler.due[self.direct.pk], 1008)
+
+    def test_rescheduling_replaces_the_old_deadline(self):
+        self.scheduler.schedule(self.direct.pk, 1500)
+        self.assertEqual(self.due_ids(1200), ['tracker-1'])
+        self.assertEqual(self.due_ids(1500), ['tracker-2'])
+        self.assertEqual(self.due_ids(2000), [])
+
+    def test_sync_picks_up_new_and_deleted_devices(self):
+        added = Device.objects.create(user=self.user, device_id='tracker-3', device_password='secret')
+        self.direct.delete()
+        self.scheduler.sync(1010)
+        self.assertEqual(self.scheduler.next_sync, 1030)
+        self.scheduler.sync(1030)
+        self.assertEqual(len(self.scheduler), 2)
+        self.assertEqual(self.due_ids(1030), ['tracker-3'])
+        self.assertNotIn(self.direct.pk, self.scheduler.devices)
+        self.assertIn(added.pk, self.scheduler.devices)
+
+
+class BatchIngestTests(IngestTestCase):
+    def fleet(self, count, prefix):
+        return [Device.objects.create(user=self.user, device_id=f"{prefix}-{i}", device_password='secret')
+                for i in range(count)]
+
+    def track(self, devices):
+        return [reading(device, 10 + step / 50, self.at(step), speed=60 * (step % 2), power_source='battery')
+                for step in range(4) for device in devices]
+
+    def stored(self, devices):
+        return [(point.timestamp, round(point.speed, 6), round(point.heading, 6), round(point.odometer, 6))
+                for device in devices for point in DeviceData.objects.filter(device=device).order_by('timestamp')]
+
+    def alerts(self, devices):
+        return sorted((alert.timestamp, alert.message) for alert in SpeedAlert.objects.filter(device__in=devices))
+
+    def test_batch_matches_one_reading_at_a_time(self):
+        batched, single = self.fleet(3, 'batched'), self.fleet(3, 'single')
+        process_device_data_batch(self.track(batched))
+        for item in self.track(single):
+            process_device_data(**item)
+        self.assertEqual(self.stored(batched), self.stored(single))
+        self.assertTrue(self.alerts(batched))
+        self.assertEqual(self.alerts(batched), self.alerts(single))
+        self.assertEqual(Notification.objects.filter(device__in=batched).count(),
+                         Notification.objects.filter(device__in=single).count())
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        queries = []
+        for count in (2, 10):
+            devices = self.fleet(count, f"fleet{count}")
+            process_device_data_batch([reading(device, 10.0, self.at(0)) for device in devices])
+            with CaptureQueriesContext(connection) as captured:
+                process_device_data_batch(self.track(devices)[len(devices):])
+            queries.append(len(captured))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_repeated_timestamp_is_shifted_unless_idempotent(self):
+        process_device_data_batch([reading(self.device, 10.0, self.at(0))])
+        self.assertEqual(len(process_device_data_batch([reading(self.device, 10.0, self.at(0))], ignore_conflicts=True)), 0)
+        process_device_data_batch([reading(self.device, 10.0, self.at(0))])
+        self.assertEqual(list(DeviceData.objects.filter(device=self.device).order_by('timestamp').values_list('timestamp', flat=True)),
+                         [self.at(0), self.at(0) + timedelta(microseconds=1)])
+
+
+class PartitionTests(IngestTestCase):
+    def utc(self, *args):
+        return datetime(*args, tzinfo=dt_timezone.utc)
+
+    def test_periods_and_names_round_trip(self):
+        # 2026-12-31 is in ISO week 53 of 2026, 2027-01-04 starts week 1 of 2027
+        for moment, interval, name, start, end in (
+                (self.utc(2026, 12, 31, 23), 'week', 'p2026w53', self.utc(2026, 12, 28), self.utc(2027, 1, 4)),
+                (self.utc(2027, 1, 4), 'week', 'p2027w01', self.utc(2027, 1, 4), self.utc(2027, 1, 11)),
+                (self.utc(2026, 12, 31, 23), 'month', 'p2026_12', self.utc(2026, 12, 1), self.utc(2027, 1, 1)),
+                (self.utc(2026, 1, 31), 'month', 'p2026_01', self.utc(2026, 1, 1), self.utc(2026, 2, 1))):
+            first = partitions.period_start(moment, interval)
+            self.assertEqual(partitions.partition_name(first, interval), f"{partitions.TABLE}_{name}")
+            self.assertEqual(partitions.partition_range(f"{partitions.TABLE}_{name}"), (start, end, interval))
+        self.assertIsNone(partitions.partition_range(partitions.DEFAULT_PARTITION))
+        # A local-time moment belongs to the UTC period it falls in
+        self.assertEqual(partitions.period_start(datetime(2026, 3, 1, 3, tzinfo=dt_timezone(timedelta(hours=5))),
+                                                 'month'), self.utc(2026, 2, 1))
+
+    def test_ensure_partitions_covers_the_periods_ahead(self):
+        statements = partitions.ensure_partitions(ahead=2, interval='month', now=self.utc(2026, 11, 15), dry_run=True)
+        self.assertEqual([statement.split('"')[1] for statement in statements],
+                         [f"{partitions.TABLE}_p2026_11", f"{partitions.TABLE}_p2026_12", f"{partitions.TABLE}_p2027_01"])
+        self.assertIn("FROM ('2026-12-01T00:00:00+00:00') TO ('2027-01-01T00:00:00+00:00')", statements[1])
+
+    def test_unpartitioned_retention_deletes_in_chunks(self):
+        store_readings([reading(self.device, 10.0, timezone.now() - timedelta(days=days)) for days in (40, 35, 31, 5)])
+        output = io.StringIO()
+        call_command('prune_devicedata', retention_days=30, dry_run=True, stdout=output)
+        self.assertIn('Would delete 3 rows', output.getvalue())
+        self.assertEqual(len(self.odometers()), 4)
+        call_command('prune_devicedata', retention_days=30, chunk_size=2, stdout=output)
+        self.assertEqual(len(self.odometers()), 1)
+
+
+class LatestPointTests(IngestTestCase):
+    def test_device_row_only_moves_forward(self):
+        store_readings([reading(self.device, 10.0, self.at(0)), reading(self.device, 10.2, self.at(10), speed=40)])
+        store_readings([reading(self.device, 10.1, self.at(5))])
+        save_latest_points({self.device.pk: DeviceData(latitude=11.0, longitude=77.5, timestamp=self.at(9))})
+        self.device.refresh_from_db()
+        newest = DeviceData.objects.filter(device=self.device).latest('timestamp')
+        self.assertEqual((self.device.last_timestamp, self.device.last_latitude, self.device.last_speed),
+                         (self.at(10), 10.2, 40))
+        self.assertEqual(self.device.odometer, newest.odometer)
+        self.assertEqual(self.device.last_geohash, spatial.encode(10.2, 77.5))
+        state = load_states([self.device.pk])[self.device.pk]
+        self.assertEqual((state.timestamp, state.latitude, state.odometer), (self.at(10), 10.2, newest.odometer))
+
+    def test_home_counts_active_devices_from_the_columns(self):
+        other = User.objects.create(username='friend')
+        shared = Device.objects.create(user=other, device_id='tracker-2', device_password='secret')
+        DeviceShare.objects.create(device=shared, shared_with=self.user)
+        Device.objects.create(user=self.user, device_id='tracker-3', device_password='secret')
+        now = timezone.now()
+        store_readings([reading(self.device, 10.0, now - timedelta(minutes=2)),
+                        reading(shared, 10.0, now - timedelta(minutes=30))])
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('home'))
+        self.assertEqual((response.context['total_devices'], response.context['active_devices']), (3, 1))
+        self.assertEqual(sorted((entry['device'].device_id, entry['status']) for entry in response.context['all_devices']),
+                         [('tracker-1', 'Active'), ('tracker-2', 'Inactive'), ('tracker-3', 'Inactive')])
+        self.assertFalse([query for query in captured if DeviceData._meta.db_table in query['sql']])
+
+
+class ChargeBackfill(backfill.Backfill):
+    name = 'test_charge'
+    model = DeviceData
+    updates = {'charge': F('charge') + 1}
+
+
+class AltitudeBackfill(backfill.Backfill):
+    name = 'test_altitude'
+    model = DeviceData
+    fields = ('altitude',)
+
+    def apply(self, rows):
+        if any(altitude == 13 for _, altitude in rows):
+            raise RuntimeError('bad row')
+        DeviceData.objects.bulk_update([DeviceData(pk=pk, altitude=altitude * 2) for pk, altitude in rows], ['altitude'])
+        return len(rows)
+
+
+class BackfillTests(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        store_readings([reading(self.device, 10 + i / 100, self.at(i), altitude=i + 1, charge=10) for i in range(10)])
+        self.sleeps = []
+
+    def backfill(self, backfill_class, **options):
+        return backfill_class(chunk_size=3, report_every=0, stdout=io.StringIO(), sleep=self.sleeps.append, **options)
+
+    def values(self, field):
+        return list(DeviceData.objects.filter(device=self.device).order_by('pk').values_list(field, flat=True))
+
+    def test_interrupted_run_resumes_and_skips_later_rows(self):
+        checkpoint = self.backfill(ChargeBackfill).run(max_rows=4)
+        self.assertEqual((checkpoint.rows_processed, checkpoint.finished_at), (4, None))
+        self.assertEqual(self.values('charge'), [11] * 4 + [10] * 6)
+        store_readings([reading(self.device, 11.0, self.at(100), charge=10)])
+        checkpoint = self.backfill(ChargeBackfill).run()
+        self.assertEqual((checkpoint.rows_processed, checkpoint.rows_changed), (10, 10))
+        self.assertIsNotNone(checkpoint.finished_at)
+        self.assertEqual(self.values('charge'), [11] * 10 + [10])
+        self.backfill(ChargeBackfill).run()
+        self.assertEqual(self.values('charge')[0], 11)
+        self.backfill(ChargeBackfill).run(restart=True)
+        self.assertEqual(self.values('charge'), [12] * 10 + [11])
+
+    def test_failed_chunk_rolls_back_with_its_checkpoint(self):
+        DeviceData.objects.filter(device=self.device, timestamp=self.at(7)).update(altitude=13)
+        with self.assertRaises(RuntimeError):
+            self.backfill(AltitudeBackfill).run()
+        self.assertEqual(self.values('altitude'), [2, 4, 6, 8, 10, 12, 7, 13, 9, 10])
+        self.assertEqual(BackfillCheckpoint.objects.get(name='test_altitude').rows_processed, 6)
+
+    def test_throttle_and_pause(self):
+        clock = itertools.count(step=2.0)
+        self.backfill(ChargeBackfill, throttle=0.5, pause=0.1, clock=lambda: next(clock)).run()
+        self.assertEqual(len(self.sleeps), 4)
+        self.assertTrue(all(delay >= 1.0 for delay in self.sleeps))
+        self.sleeps.clear()
+        self.backfill(AltitudeBackfill, throttle=0, pause=0.1).run()
+        self.assertEqual(self.sleeps, [0.1] * 4)
+
+    def test_fix_devicedata_timestamps(self):
+        first, second = DeviceData.objects.filter(device=self.device).order_by('pk')[:2]
+        rows = [(first.pk, first.timestamp.replace(tzinfo=None)), (second.pk, second.timestamp)]
+        self.assertEqual(fix_devicedata_timestamps.NaiveTimestamps().apply(rows), 1)
+        self.assertEqual(DeviceData.objects.get(pk=first.pk).timestamp, self.at(0))
+        output = io.StringIO()
+        call_command('fix_devicedata_timestamps', chunk_size=4, throttle=0, stdout=output)
+        checkpoint = BackfillCheckpoint.objects.get(name='fix_devicedata_timestamps')
+        self.assertEqual((checkpoint.rows_processed, checkpoint.rows_changed), (10, 0))
+        self.assertIn('Updated 0 DeviceData records', output.getvalue())
+        call_command('fix_devicedata_timestamps', stdout=output)
+        self.assertIn('Already finished', output.getvalue())
+
+
+class StateStoreTests(IngestTestCase):
+    def test_writers_in_other_processes_are_seen(self):
+        """A web worker and a poller, each with its own store, writing the same device."""
+        poller, web = LastKnownStateStore(), LastKnownStateStore()
+        store_readings([reading(self.device, 10.0, self.at(0))], web)
+        web.get(self.device.pk)
+        store_readings([reading(self.device, 10.1, self.at(2))], poller)
+        store_readings([reading(self.device, 10.2, self.at(4))], poller)
+        store_readings([reading(self.device, 10.05, self.at(1))], web)
+        odometers = self.odometers()
+        self.assertEqual(odometers, sorted(odometers))
+        self.assertAlmostEqual(odometers[-1], 22239, delta=5)
+        self.device.refresh_from_db()
+        self.assertAlmostEqual(self.device.odometer, odometers[-1])
+        self.assertEqual(web.get(self.device.pk).timestamp, self.at(4))
+
+    def test_cache_is_opt_in(self):
+        cached = LastKnownStateStore(cache=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            store_readings([reading(self.device, 10.0, self.at(0))], cached)
+        store_readings([reading(self.device, 10.1, self.at(2))], LastKnownStateStore())
+        self.assertEqual(cached.get(self.device.pk).timestamp, self.at(0))
+        self.assertEqual(LastKnownStateStore().get(self.device.pk).timestamp, self.at(2))
+
+
+class WriteBehindBufferTests(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = os.path.join(directory.name, 'test.journal')
+        self.command = fetch_gps_redis.Command(stdout=io.StringIO())
+
+    def buffer(self):
+        buffer = WriteBehindBuffer(self.journal, self.command.write_batch, fsync=False)
+        self.addCleanup(buffer.close)
+        return buffer
+
+    def record(self, device, minutes):
+        return {'device': device.pk, 'latitude': 10.0, 'longitude': 77.5, 'altitude': 0, 'speed': 0, 'heading': 0,
+                'charge': 50, 'timestamp': self.at(minutes).isoformat(), 'odometer': 0, 'rollup': None}
+
+    def test_flushes_by_size_or_age_and_keeps_failed_batches(self):
+        now, batches = [0.0], []
+        buffer = WriteBehindBuffer(self.journal, batches.append, max_size=3, max_age=5, fsync=False, clock=lambda: now[0])
+        self.addCleanup(buffer.close)
+        buffer.append({'n': 1})
+        buffer.append({'n': 2})
+        self.assertEqual(buffer.flush_if_due(), 0)
+        now[0] = 5
+        self.assertEqual(buffer.flush_if_due(), 2)
+        for n in range(3, 6):
+            buffer.append({'n': n})
+        self.assertTrue(buffer.due())
+        buffer.flush_fn = mock.Mock(side_effect=RuntimeError('database down'))
+        with self.assertRaises(RuntimeError):
+            buffer.flush()
+        self.assertEqual(len(buffer), 3)
+        buffer.flush_fn = batches.append
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(batches, [[{'n': 1}, {'n': 2}], [{'n': 3}, {'n': 4}, {'n': 5}]])
+
+    def test_unflushed_records_are_replayed_after_a_crash(self):
+        crashed = WriteBehindBuffer(self.journal, mock.Mock(), fsync=False)
+        crashed.append({'n': 1})
+        crashed.append({'n': 2})
+        crashed.journal.write('{"n": 3')  # torn final line
+        crashed.close()
+        replayed = []
+        restarted = WriteBehindBuffer(self.journal, replayed.append, fsync=False)
+        self.addCleanup(restarted.close)
+        with self.assertLogs('device.buffer', 'WARNING'):
+            self.assertEqual(restarted.replay(), 2)
+        self.assertEqual(replayed, [[{'n': 1}, {'n': 2}]])
+        self.assertEqual(restarted.replay(), 0)
+
+    def test_readings_of_deleted_devices_do_not_block_the_queue(self):
+        doomed = Device.objects.create(user=self.user, device_id='tracker-2', device_password='secret')
+        buffer = self.buffer()
+        buffer.append(self.record(doomed, 0))
+        buffer.append(self.record(self.device, 1))
+        doomed.delete()
+        with self.assertLogs('device.management.commands.fetch_gps_redis', 'WARNING'):
+            self.assertEqual(buffer.flush(), 2)
+        connection.check_constraints()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(len(self.odometers()), 1)
+
+    def test_replay_skips_deleted_devices(self):
+        doomed = Device.objects.create(user=self.user, device_id='tracker-2', device_password='secret')
+        self.buffer().append(self.record(doomed, 0))
+        doomed.delete()
+        with self.assertLogs('device.management.commands.fetch_gps_redis', 'WARNING'):
+            self.assertEqual(self.buffer().replay(), 1)
+        connection.check_constraints()
+        self.assertEqual(os.path.getsize(self.journal), 0)
+
+
+class FetchGpsDataTests(IngestTestCase):
+    def poll(self, *payloads):
+        responses = [mock.Mock(status_code=200, json=mock.Mock(return_value={
+            'device_id': 'tracker-1', 'latitude': latitude, 'longitude': 77.5, 'Charge': 50,
+            'event_time': self.at(minutes).isoformat()})) for latitude, minutes in payloads]
+        with mock.patch('device.management.commands.fetch_gps_data.requests.get', side_effect=responses), \
+                mock.patch('device.management.commands.fetch_gps_data.time.sleep', side_effect=[None] * (len(payloads) - 1) + [KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('fetch_gps_data', stdout=io.StringIO())
+
+    def test_repeated_and_late_vendor_points_go_through_ingest(self):
+        self.poll((10.0, 0), (10.2, 10), (10.2, 10), (10.1, 5))
+        points = list(DeviceData.objects.filter(device=self.device).order_by('timestamp'))
+        self.assertEqual([point.timestamp for point in points], [self.at(0), self.at(5), self.at(10)])
+        self.assertAlmostEqual(points[1].odometer, haversine(10.0, 77.5, 10.1, 77.5), places=3)
+        self.assertAlmostEqual(points[2].odometer, haversine(10.0, 77.5, 10.2, 77.5), places=3)
+
+
+class IngestItemsTests(IngestTestCase):
+    def item(self, **values):
+        return {'device_id': 'tracker-1', 'location': {'latitude': 10.0, 'longitude': 77.5}, 'charge': 50,
+                'timestamp': self.at(0).timestamp(), 'power_source': 'direct', **values}
+
+    def test_bad_items_are_rejected_one_by_one(self):
+        results = ingest_items([self.item(timestamp=1e20), self.item(timestamp=float('nan')), self.item(device_id=['x']),
+                                self.item(device_id={'a': 1}), self.item()], self.user)
+        self.assertEqual([result['status'] for result in results], ['error'] * 4 + ['ok'])
+        self.assertEqual(results[0]['message'], 'Timestamp out of range')
+        self.assertEqual(results[2]['message'], 'device_id must be a string')
+        self.assertEqual(len(self.odometers()), 1)
+
+    def test_out_of_range_values_are_rejected_one_by_one(self):
+        results = ingest_items([self.item(charge=10 ** 20), self.item(charge=float('inf')), self.item(charge=-1),
+                                self.item(power_source='x' * 30), self.item(speed='nan'), self.item()], self.user)
+        self.assertEqual([result['status'] for result in results], ['error'] * 5 + ['ok'])
+        self.assertEqual(results[0]['message'], 'Charge out of range')
+        self.assertEqual(len(self.odometers()), 1)
+
+    def test_reading_the_database_refuses_does_not_cost_the_batch(self):
+        def store(readings):
+            if len(readings) > 1 or readings[0]['charge'] == 13:
+                raise DataError('value out of range')
+            return store_readings(readings)
+
+        with mock.patch('device.ingest.store_readings', side_effect=store):
+            results = ingest_items([self.item(), self.item(charge=13, timestamp=self.at(1).timestamp()),
+                                    self.item(timestamp=self.at(2).timestamp())], self.user)
+        self.assertEqual([result['status'] for result in results], ['ok', 'error', 'ok'])
+        self.assertEqual(len(self.odometers()), 2)
+
+    def test_too_many_items(self):
+        with self.assertRaises(TooManyItems):
+            ingest_items([self.item()] * 3, self.user, max_items=2)
+
+
+class GeodesyTests(SimpleTestCase):
+    # Includes a repeated timestamp, a due-north leg and a leg across the antimeridian
+    track = [(10.0, 77.5, 0), (10.01, 77.52, 60), (10.01, 77.52, 60), (10.03, 77.52, 90), (-33.9, 179.99, 3600),
+             (-33.8, -179.98, 7200)]
+
+    def points(self):
+        return [mock.Mock(latitude=lat, longitude=lon, timestamp=datetime.fromtimestamp(seconds, dt_timezone.utc))
+                for lat, lon, seconds in self.track]
+
+    def test_segment_bearings_match_scalar_heading(self):
+        lat, lon, _ = zip(*self.track)
+        points = self.points()
+        expected = [calculate_heading(current, previous) for previous, current in zip(points, points[1:])]
+        for value, scalar in zip(geodesy.segment_bearings(lat, lon), expected):
+            self.assertAlmostEqual(value, scalar, places=9)
+        self.assertEqual(len(geodesy.segment_bearings([10.0], [77.5])), 0)
+
+    def test_segment_speeds_match_scalar_speed(self):
+        lat, lon, seconds = zip(*self.track)
+        points = self.points()
+        expected = [calculate_speed(current, previous) for previous, current in zip(points, points[1:])]
+        speeds = geodesy.segment_speeds(lat, lon, seconds)
+        self.assertEqual(len(speeds), len(expected))
+        for value, scalar in zip(speeds, expected):
+            self.assertAlmostEqual(value, scalar, places=6)
+        self.assertEqual(speeds[1], 0)
+
+
+class SpatialIndexTests(SimpleTestCase):
+    """The geohash index against brute force, with devices on cell edges, at the poles and on the antimeridian."""
+
+    def setUp(self):
+        rng = random.Random(21)
+        lat_step, lon_step = 180 / 2 ** 15, 360 / 2 ** 15  # precision 6 cells
+        points = [(90, 0), (-90, 45), (89.9999, 180), (0, -180), (0, 180), (-0.0001, 179.9999), (10.0, 77.5)]
+        for _ in range(150):
+            # On and either side of a cell boundary
+            row, col = rng.randrange(2 ** 15), rng.randrange(2 ** 15)
+            points.append((row * lat_step - 90 + rng.choice((-1e-9, 0, 1e-9)), col * lon_step - 180 + rng.choice((-1e-9, 0, 1e-9))))
+        for _ in range(150):
+            points.append((rng.uniform(89.5, 90), rng.uniform(-180, 180)))
+            points.append((rng.uniform(-90, -89.5), rng.uniform(-180, 180)))
+            points.append((rng.uniform(-1, 1), rng.choice((-1, 1)) * rng.uniform(179.5, 180)))
+            points.append((10 + rng.uniform(-0.05, 0.05), 77.5 + rng.uniform(-0.05, 0.05)))
+        self.positions = {pk: (min(max(lat, -90), 90), min(max(lon, -180), 180)) for pk, (lat, lon) in enumerate(points)}
+        self.index = spatial.SpatialIndex(precision=6)
+        self.index.update_many({pk: mock.Mock(latitude=lat, longitude=lon, timestamp=None)
+                                for pk, (lat, lon) in self.positions.items()})
+        self.queries = [(90, 0), (-90, 0), (89.99, 179.99), (0, 180), (0, -180), (-0.5, 179.8), (10.0, 77.5),
+                        (0, 0), (45, -179.99)]
+
+    def distances(self, latitude, longitude):
+        return sorted(haversine(latitude, longitude, lat, lon) for lat, lon in self.positions.values())
+
+    def test_encode_matches_geohash(self):
+        self.assertEqual(spatial.encode(42.605, -5.603, 5), 'ezs42')
+        self.assertEqual(spatial.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(spatial.encode(90, 180, 3), 'zzz')
+        self.assertEqual(spatial.encode(-90, -180, 3), '000')
+
+    def test_bbox(self):
+        for bbox in ((89.5, -180, 90, 180), (-1, 179.5, 1, -179.5), (-90, 170, 90, -170), (9.98, 77.48, 10.02, 77.52),
+                     (-1e-6, -1e-6, 1e-6, 1e-6), (-90, -180, 90, 180)):
+            expected = sorted(pk for pk, point in self.positions.items() if spatial.inside_bbox(*point, *bbox))
+            self.assertEqual(sorted(self.index.bbox(*bbox)), expected, bbox)
+        scope = set(range(0, len(self.positions), 3))
+        self.assertEqual(sorted(self.index.bbox(-1, 179.5, 1, -179.5, scope)),
+                         sorted(pk for pk in scope if spatial.inside_bbox(*self.positions[pk], -1, 179.5, 1, -179.5)))
+
+    def test_radius(self):
+        for latitude, longitude in self.queries:
+            for radius in (500, 20000, 100000):
+                expected = [d for d in self.distances(latitude, longitude) if d <= radius]
+                found = self.index.radius(latitude, longitude, radius)
+                self.assertEqual(len(found), len(expected), (latitude, longitude, radius))
+                for (_, distance), value in zip(found, expected):
+                    self.assertAlmostEqual(distance, value, places=6)
+
+    def test_nearest(self):
+        for latitude, longitude in self.queries:
+            for k in (1, 5, 40):
+                found = self.index.nearest(latitude, longitude, k)
+                expected = self.distances(latitude, longitude)[:k]
+                self.assertEqual(len(found), k)
+                for (_, distance), value in zip(found, expected):
+                    self.assertAlmostEqual(distance, value, places=6, msg=(latitude, longitude, k))
+        self.assertEqual(self.index.nearest(0, 0, 0), [])
+
+    def test_nearest_looks_past_the_neighbour_block_at_high_latitude(self):
+        lat_step, lon_step = 180 / 2 ** 15, 360 / 2 ** 15
+        row, col = spatial.cell_of(80.0, 20.0, 6)
+        latitude, longitude = (row + 0.5) * lat_step - 90, (col + 0.5) * lon_step - 180
+        index = spatial.SpatialIndex(precision=6)
+        index.update_many({
+            'north': mock.Mock(latitude=latitude + lat_step, longitude=longitude, timestamp=None),
+            'east': mock.Mock(latitude=latitude, longitude=longitude + 1.6 * lon_step, timestamp=None),
+        })
+        self.assertEqual([pk for pk, _ in index.nearest(latitude, longitude, 1)], ['east'])
+
+    def test_moves_and_removals(self):
+        self.index.update_many({0: mock.Mock(latitude=0.0, longitude=0.0, timestamp=None)})
+        self.index.remove(6)
+        self.assertEqual(self.index.nearest(0, 0, 1), [(0, 0.0)])
+        self.assertNotIn(6, self.index.bbox(9.98, 77.48, 10.02, 77.52))
+        self.assertNotIn(0, self.index.bbox(89.5, -180, 90, 180))
+
+
+class InBboxTests(IngestTestCase):
+    def test_prefix_filter_matches_bbox(self):
+        positions = [(10.0, 77.5), (10.0001, 77.5001), (0.5, 179.99), (0.5, -179.99), (-0.5, 179.0), (89.99, 0)]
+        for i, (latitude, longitude) in enumerate(positions):
+            device = Device.objects.create(user=self.user, device_id=f"bbox-{i}", device_password='secret')
+            save_latest_points({device.pk: mock.Mock(latitude=latitude, longitude=longitude, timestamp=self.at(i),
+                                                     altitude=0, speed=0, heading=0, charge=0, power_source='direct',
+                                                     odometer=0)})
+        for bbox in ((9.9999, 77.4999, 10.00005, 77.50005), (0, 179.5, 1, -179.5), (89, -180, 90, 180),
+                     (-1, 170, 1, -170)):
+            expected = sorted(f"bbox-{i}" for i, point in enumerate(positions) if spatial.inside_bbox(*point, *bbox))
+            self.assertEqual(sorted(spatial.in_bbox(Device.objects.all(), *bbox).values_list('device_id', flat=True)),
+                             expected, bbox)
+
+
+class BackfillOdometerTests(IngestTestCase):
+    def test_odometers_continue_across_chunks(self):
+        DeviceData.objects.bulk_create([
+            DeviceData(device=self.device, latitude=10 + i / 100, longitude=77.5 + i / 200, timestamp=self.at(i))
+            for i in range(7)
+        ])
+        call_command('backfill_odometer', chunk_size=3, stdout=io.StringIO())
+        expected, previous = [0], (10, 77.5)
+        for i in range(1, 7):
+            point = (10 + i / 100, 77.5 + i / 200)
+            expected.append(expected[-1] + haversine(*previous, *point))
+            previous = point
+        for odometer, value in zip(self.odometers(), expected):
+            self.assertAlmostEqual(odometer, value, places=3)
+        self.device.refresh_from_db()
+        self.assertAlmostEqual(self.device.odometer, expected[-1], places=3)
+
+
+class ArchivedHistoryTests(IngestTestCase):
+    """Late and redelivered readings for a device whose first day is archived."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(GPS_ARCHIVE_DIR=directory.name))
+        store_readings([reading(self.device, latitude, self.at(minutes)) for latitude, minutes in
+                        ((10.0, 0), (10.1, 10), (10.3, 1440), (10.4, 1450))])
+        self.assertEqual(archive.archive_day(self.device, self.start.date()), 2)
+
+    def history(self):
+        return [(point.timestamp, point.odometer) for point in reversed(archive.history(self.device))]
+
+    def test_readings_in_archived_days_are_rejected(self):
+        before = self.history()
+        self.assertEqual(store_readings([reading(self.device, 10.05, self.at(5))]), 0)
+        self.assertEqual(save_readings([reading(self.device, 10.0, self.at(0))]), 0)
+        results = ingest_items([{'device_id': 'tracker-1', 'location': {'latitude': 10.1, 'longitude': 77.5},
+                                 'charge': 50, 'timestamp': self.at(10).isoformat(), 'power_source': 'direct'}],
+                               self.user)
+        self.assertEqual(results[0]['status'], 'error')
+        self.assertEqual(self.history(), before)
+
+    def test_late_reading_after_archive_continues_from_last_archived_point(self):
+        self.assertEqual(store_readings([reading(self.device, 10.2, self.at(1430))]), 1)
+        odometers = [odometer for _, odometer in self.history()]
+        self.assertEqual(len(odometers), 5)
+        self.assertEqual(odometers, sorted(odometers))
+        self.assertAlmostEqual(odometers[2] - odometers[1], 11119.5, delta=5)
+        self.assertAlmostEqual(odometers[-1], 4 * 11119.5, delta=10)
+
+    def test_import_recompute_continues_from_archive(self):
+        path = os.path.join(settings.GPS_ARCHIVE_DIR, 'dump.csv')
+        with open(path, 'w') as handle:
+            handle.write('device_id,latitude,longitude,timestamp\n')
+            handle.write(f"tracker-1,10.05,77.5,{self.at(5).isoformat()}\n")
+            handle.write(f"tracker-1,10.35,77.6,{self.at(1445).isoformat()}\n")
+        store = LastKnownStateStore(cache=True)
+        store.warm_start()
+        with mock.patch('device.state._store', store), self.captureOnCommitCallbacks(execute=True):
+            call_command('import_tracks', path, stdout=io.StringIO())
+        track = [(10.0, 77.5), (10.1, 77.5), (10.3, 77.5), (10.35, 77.6), (10.4, 77.5)]
+        expected = archive.last_point(self.device).odometer + sum(
+            haversine(*start, *end) for start, end in zip(track[1:], track[2:]))
+        odometers = [odometer for _, odometer in self.history()]
+        self.assertEqual(len(odometers), 5)
+        self.assertEqual(odometers, sorted(odometers))
+        self.assertAlmostEqual(odometers[-1], expected, places=2)
+        self.device.refresh_from_db()
+        self.assertAlmostEqual(self.device.odometer, expected, places=2)
+        self.assertAlmostEqual(store.get(self.device.pk).odometer, expected, places=2)
+
+    def test_latest_point_migration_falls_back_to_archive(self):
+        self.assertEqual(archive.archive_day(self.device, (self.start + timedelta(days=1)).date()), 2)
+        self.assertFalse(DeviceData.objects.filter(device=self.device).exists())
+        Device.objects.filter(pk=self.device.pk).update(last_timestamp=None, last_latitude=None, last_longitude=None)
+        migration = importlib.import_module('device.migrations.0012_device_last_altitude_device_last_charge_and_more')
+        migration.copy_latest_points(django_apps, None)
+        self.device.refresh_from_db()
+        self.assertEqual((self.device.last_timestamp, self.device.last_latitude), (self.at(1450), 10.4))
+
+
+class ListenerTests(SimpleTestCase):
+    def test_out_of_range_timestamp_is_a_bad_frame(self):
+        for timestamp in ('1e20', '-1e20', 'nan'):
+            with self.assertRaises(ValueError):
+                listener.parse_reading(None, [timestamp, '10', '77', '0', '50', 'direct'])
+
+    def test_failed_batch_is_kept_and_holds_connections_back(self):
+        async def run():
+            batcher = listener.ReadingBatcher(batch_size=2, max_pending=1, retry_delay=0)
+            transport = mock.Mock(is_closing=mock.Mock(return_value=False))
+            for minutes in range(3):
+                batcher.add({'minutes': minutes})
+            batcher.pause(transport)
+            with mock.patch('device.listener.write_readings', side_effect=[True, False, True, True]) as write:
+                await batcher.flush()
+                self.assertEqual(batcher.failed, [{'minutes': 2}])
+                transport.resume_reading.assert_not_called()
+                batcher.add({'minutes': 3})
+                batcher.add({'minutes': 4})
+                self.assertTrue(batcher.full)
+                await batcher.flush()
+            self.assertEqual(batcher.failed, [])
+            transport.resume_reading.assert_called_once()
+            batches = [call.args[0] for call in write.call_args_list]
+            self.assertEqual(batches[2:], [[{'minutes': 2}, {'minutes': 3}], [{'minutes': 4}]])
+            batcher.close()
+
+        asyncio.run(run())
+
+
+class StreamConsumerTests(IngestTestCase):
+    """The gps-writers consumer group on a fakeredis server shared by the producer and the consumers."""
+
+    def setUp(self):
+        super().setUp()
+        if fakeredis is None:
+            self.skipTest('fakeredis is not installed')
+        server = fakeredis.FakeServer()
+        self.client = fakeredis.FakeRedis(server=server, decode_responses=True)
+        StreamProducer(self.client).publish([reading(self.device, 10 + i / 10, self.at(i)) for i in range(4)])
+
+    def consumer(self, name, **options):
+        consumer = StreamConsumer(self.client, consumer=name, batch_size=2, block=0.01, claim_idle=0.05, **options)
+        consumer.ensure_group()
+        return consumer
+
+    def pending(self):
+        return self.client.xpending_range(STREAM, GROUP, '-', '+', 100)
+
+    def test_group_splits_entries_and_acks_after_save(self):
+        first, second = self.consumer('a'), self.consumer('b')
+        batches = [first.read(), second.read()]
+        self.assertEqual(len(batches[0]), 2)
+        self.assertFalse({entry_id for entry_id, _ in batches[0]} & {entry_id for entry_id, _ in batches[1]})
+        self.assertEqual(len(self.pending()), 4)
+        for consumer, entries in zip((first, second), batches):
+            consumer.process(entries, save_readings)
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(len(self.odometers()), 4)
+
+    def test_abandoned_entries_are_reclaimed(self):
+        crashed, survivor = self.consumer('a'), self.consumer('b')
+        abandoned = crashed.read()
+        survivor.process(survivor.read(), save_readings)
+        self.assertEqual(survivor.read(), [])
+        time.sleep(0.1)
+        self.assertEqual(survivor.read(), abandoned)
+        survivor.process(abandoned, save_readings)
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(len(self.odometers()), 4)
+
+    def test_repeatedly_failing_entries_are_dead_lettered(self):
+        first, second = self.consumer('a', max_deliveries=1), self.consumer('b', max_deliveries=1)
+        failed = first.read()
+        time.sleep(0.1)
+        self.assertNotIn(failed[0], second.read())
+        dead = self.client.xrange(f"{STREAM}:dead")
+        self.assertEqual([fields['source_id'] for _, fields in dead], [entry_id for entry_id, _ in failed])
+
+    def test_held_entries_are_not_reclaimed_or_counted(self):
+        holder, other = self.consumer('a', max_deliveries=1), self.consumer('b', max_deliveries=1)
+        held = holder.read()
+        time.sleep(0.1)
+        holder.hold([entry_id for entry_id, _ in held])
+        self.assertNotIn(held[0], other.read())
+        self.assertEqual({row['consumer'] for row in self.pending() if row['message_id'] == held[0][0]}, {'a'})
+        self.assertEqual(max(row['times_delivered'] for row in self.pending()), 1)
+        self.assertEqual(self.client.xlen(f"{STREAM}:dead"), 0)
+
+
+class LateReadingTests(IngestTestCase):
+    def chain(self):
+        points = list(DeviceData.objects.filter(device=self.device).order_by('timestamp'))
+        return sum(haversine(a.latitude, a.longitude, b.latitude, b.longitude) for a, b in zip(points, points[1:]))
+
+    def test_reported_speed_and_heading_of_successor_are_kept(self):
+        store_readings([reading(self.device, 10.0, self.at(0)), reading(self.device, 10.2, self.at(10), speed=33, heading=5),
+                        reading(self.device, 10.4, self.at(20))])
+        store_readings([reading(self.device, 10.1, self.at(5), longitude=77.6),
+                        reading(self.device, 10.3, self.at(15), longitude=77.6)])
+        points = {point.timestamp: point for point in DeviceData.objects.filter(device=self.device)}
+        self.assertEqual((points[self.at(10)].speed, points[self.at(10)].heading), (33, 5))
+        self.assertAlmostEqual(points[self.at(20)].speed, calculate_speed(points[self.at(20)], points[self.at(15)]))
+        self.assertAlmostEqual(points[self.at(20)].heading, calculate_heading(points[self.at(20)], points[self.at(15)]))
+        self.assertAlmostEqual(self.odometers()[-1], self.chain(), places=3)
+
+    def test_backlog_costs_the_same_queries_however_long(self):
+        queries = []
+        for length in (5, 50):
+            self.device = Device.objects.create(user=self.user, device_id=f"backlog-{length}", device_password='secret')
+            store_readings([reading(self.device, 10.0, self.at(0)), reading(self.device, 11.0, self.at(1000))])
+            backlog = [reading(self.device, 10 + i / 100, self.at(i * 10), longitude=77.5 + i % 2 / 100)
+                       for i in range(length, 0, -1)]
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(store_readings(backlog), length)
+            queries.append(len(captured))
+            odometers = self.odometers()
+            self.assertEqual(odometers, sorted(odometers))
+            self.assertAlmostEqual(odometers[-1], self.chain(), places=3)
+            self.device.refresh_from_db()
+            self.assertAlmostEqual(self.device.odometer, odometers[-1], places=3)
+        self.assertEqual(queries[0], queries[1])
+
+
+class RollupTests(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        # Two days of points, moving and parked, delivered in several batches
+        self.track = [reading(self.device, 10 + step / 500, self.at(step * 7), speed=30 * (step % 5 != 0), charge=90 - step // 10)
+                      for step in range(420)]
+        for start in range(0, len(self.track), 50):
+            store_readings(self.track[start:start + 50])
+
+    def rows(self):
+        return sorted((row.granularity, row.bucket, row.point_count, round(row.distance, 6), round(row.speed_sum, 6),
+                       row.moving_seconds, row.min_charge, row.max_charge, row.status_changes)
+                      for row in DeviceRollup.objects.filter(device=self.device))
+
+    def test_covering_buckets_tile_the_window(self):
+        start, end = self.at(-37), self.at(2 * 1440 + 95)
+        ranges = rollups.covering_buckets(start, end)
+        self.assertIn('day', [granularity for granularity, first, last in ranges if first < last])
+        minutes = set()
+        for granularity, first, last in ranges:
+            self.assertEqual(rollups.bucket_start(first, granularity), first)
+            step = timedelta(seconds=rollups.GRANULARITIES[granularity])
+            while first < last:
+                covered = {first + timedelta(minutes=i) for i in range(int(step.total_seconds() // 60))}
+                self.assertFalse(covered & minutes)
+                minutes |= covered
+                first += step
+        self.assertEqual(minutes, {start + timedelta(minutes=i) for i in range(int((end - start).total_seconds() // 60))})
+
+    def test_window_stats_match_the_points(self):
+        for since, until in ((self.at(13), self.at(1500)), (self.at(63), self.at(64)), (None, None)):
+            points = DeviceData.objects.filter(device=self.device).order_by('timestamp')
+            if since:
+                points = points.filter(timestamp__gte=since, timestamp__lt=until + timedelta(minutes=1))
+            points = list(points)
+            stats = rollups.window_stats(self.device, since, until)
+            self.assertEqual(stats['point_count'], len(points))
+            self.assertEqual(stats['max_speed'], max(point.speed for point in points))
+            self.assertEqual((stats['min_charge'], stats['max_charge']),
+                             (min(point.charge for point in points), max(point.charge for point in points)))
+            self.assertAlmostEqual(stats['speed_sum'], sum(point.speed for point in points))
+
+    def test_incremental_rows_match_rebuild(self):
+        ingested = self.rows()
+        self.assertEqual(rollups.rebuild(self.device), len(self.track))
+        self.assertEqual(self.rows(), ingested)
+
+    def test_stop_counts_after_stationary_minutes(self):
+        moving = mock.Mock(speed=10, timestamp=self.at(0), status='on')
+        self.assertEqual(rollups.point_status(mock.Mock(speed=0, timestamp=self.at(5)), moving), ('on', 0))
+        self.assertEqual(rollups.point_status(mock.Mock(speed=0, timestamp=self.at(10)), moving), ('off', 1))
+        self.assertEqual(rollups.point_status(mock.Mock(speed=5, timestamp=self.at(1)), mock.Mock(speed=0, status='off')),
+                         ('on', 1))
+
+
+class CompressionTests(IngestTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device.compression_tolerance = 20
+        self.device.save()
+        parked = [reading(self.device, 10.0, self.at(i / 2)) for i in range(10)]
+        driving = [reading(self.device, 10.0 + i * 0.002, self.at(5 + i / 2)) for i in range(1, 11)]
+        for start in range(0, 20, 7):
+            store_readings((parked + driving)[start:start + 7])
+
+    def rollup_rows(self):
+        return sorted((row.granularity, row.bucket, row.point_count, round(row.distance, 3), row.moving_seconds,
+                       row.status_changes) for row in DeviceRollup.objects.filter(device=self.device))
+
+    def test_rollups_count_what_rebuild_reads(self):
+        stored = DeviceData.objects.filter(device=self.device).count()
+        self.assertLess(stored, 20)
+        ingested = self.rollup_rows()
+        self.assertEqual(sum(row[2] for row in ingested if row[0] == 'day'), stored)
+        rollups.rebuild(self.device)
+        self.assertEqual(self.rollup_rows(), ingested)
+
+    def test_non_finite_tolerance_is_rejected(self):
+        self.client.force_login(self.user)
+        for tolerance in ('nan', 'inf', '-1'):
+            response = self.client.post(reverse('edit_device', args=['tracker-1']), {
+                'device_id': 'tracker-1', 'update_interval': 60, 'compression_tolerance': tolerance})
+            self.assertEqual(response.status_code, 200)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.compression_tolerance, 20)
+
+    def test_history_exposes_dwell(self):
+        self.client.force_login(self.user)
+        url = reverse('device_history_data', args=['tracker-1'])
+        points = self.client.get(url, {'time_threshold': self.at(-1).isoformat()}).json()['data_points']
+        self.assertEqual(points[-1]['dwell'], 270)
+        compact = self.client.get(url, {'time_threshold': self.at(-1).isoformat(), 'format': 'compact'}).json()
+        self.assertEqual(decode_deltas(compact['dwell']), [point['dwell'] for point in points])
+
+
+class AlertEpisodeTests(IngestTestCase):
+    def state(self, rule):
+        return AlertState.objects.get(device=self.device, rule=rule)
+
+    def speeding_alerts(self):
+        return list(SpeedAlert.objects.filter(device=self.device, message='Speed exceeded 50 km/h')
+                    .order_by('timestamp').values_list('timestamp', flat=True))
+
+    def test_episode_opens_once_resolves_and_respects_cooldown(self):
+        for minutes, speed in ((0, 60), (1, 70), (2, 60), (3, 10), (4, 60), (5, 10), (20, 60)):
+            store_readings([reading(self.device, 10 + minutes / 100, self.at(minutes), speed=speed)])
+            if minutes == 2:
+                self.assertEqual(self.state('speeding').status, 'ongoing')
+            if minutes == 3:
+                self.assertEqual((self.state('speeding').status, self.state('speeding').resolved_at),
+                                 ('resolved', self.at(3)))
+        self.assertEqual(self.speeding_alerts(), [self.at(0), self.at(20)])
+        state = self.state('speeding')
+        self.assertEqual((state.status, state.opened_at, state.fired_at, state.suppressed),
+                         ('open', self.at(20), self.at(20), 1))
+
+    @override_settings(GPS_ALERT_REPEATS={'speeding': 300})
+    def test_ongoing_episode_repeats_after_interval(self):
+        fired = []
+        for minutes in (0, 2, 4, 5, 7, 10):
+            tracker = alerts.AlertTracker([self.device.pk])
+            if tracker.update(self.device.pk, 'speeding', True, self.at(minutes)):
+                fired.append(minutes)
+            tracker.save()
+        self.assertEqual(fired, [0, 5, 10])
+        self.assertEqual(self.state('speeding').status, 'ongoing')
+
+    def test_undecided_readings_leave_the_episode_alone(self):
+        tracker = alerts.AlertTracker([self.device.pk])
+        self.assertTrue(tracker.update(self.device.pk, 'harsh_braking', True, self.at(0)))
+        self.assertFalse(tracker.update(self.device.pk, 'harsh_braking', None, self.at(1)))
+        self.assertFalse(tracker.update(self.device.pk, 'stationary', False, self.at(1)))
+        tracker.save()
+        self.assertEqual(self.state('harsh_braking').status, 'open')
+        self.assertFalse(AlertState.objects.filter(rule='stationary').exists())
+
+
+class GeofenceFormTests(IngestTestCase):
+    def post(self, **values):
+        self.client.force_login(self.user)
+        data = {'name': 'yard', 'kind': 'polygon', 'vertices': '10,77\n10.1,77\n10.1,77.1', 'devices': ['tracker-1'],
+                **values}
+        response = self.client.post(reverse('manage_geofences'), data)
+        self.assertEqual(response.status_code, 302)
+        return Geofence.objects.filter(user=self.user).count()
+
+    def test_infinite_dwell_is_rejected(self):
+        self.assertEqual(self.post(dwell_minutes='inf'), 0)
+        self.assertEqual(self.post(dwell_minutes='1e308'), 0)
+
+    def test_dwell_is_capped(self):
+        self.assertEqual(self.post(dwell_minutes='1e9'), 0)
+        self.assertEqual(self.post(dwell_minutes=str(366 * 24 * 60)), 0)
+
+    def test_polygon_across_antimeridian_is_rejected(self):
+        self.assertEqual(self.post(vertices='10,179.9\n10.1,-179.9\n10.2,179.9'), 0)
+        self.assertEqual(self.post(dwell_minutes='5'), 1)
+
+
+class GeofenceIngestPathTests(IngestTestCase):
+    """Every path that moves a device's latest point also runs it through the geofences."""
+
+    def setUp(self):
+        super().setUp()
+        fence = Geofence.objects.create(user=self.user, name='yard', kind='circle', latitude=10.0, longitude=77.5,
+                                        radius=1000)
+        fence.devices.add(self.device)
+        self.enterContext(mock.patch('device.geofences._index', None))
+
+    def entered(self):
+        return Notification.objects.filter(device=self.device, message='Entered geofence yard').count()
+
+    def test_write_behind_batch(self):
+        fetch_gps_redis.Command(stdout=io.StringIO()).write_batch([
+            {'device': self.device.pk, 'latitude': 10.0, 'longitude': 77.5, 'altitude': 0, 'speed': 0, 'heading': 0,
+             'charge': 50, 'timestamp': self.at(0).isoformat(), 'odometer': 0, 'rollup': None}])
+        self.assertEqual(self.entered(), 1)
+
+    def test_import_tracks(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as handle:
+            handle.write(f"device_id,latitude,longitude,timestamp\ntracker-1,10.0,77.5,{self.at(0).isoformat()}\n")
+        self.addCleanup(os.unlink, handle.name)
+        call_command('import_tracks', handle.name, stdout=io.StringIO())
+        self.assertEqual(self.entered(), 1)
@@ -5,9 +5,11 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('devices/', views.device_list, name='device_list'),
     path('devices/add/', views.add_device, name='add_device'),
+    path('devices/nearby/', views.nearby_devices, name='nearby_devices'),
     path('devices/<str:device_id>/login/', views.device_login, name='device_login'),
     path('devices/<str:device_id>/dashboard/', views.dashboard, name='dashboard'),
     path('devices/<str:device_id>/data/', views.save_device_data, name='save_device_data'),
+    path('api/ingest/', views.bulk_ingest, name='bulk_ingest'),
     path('devices/<str:device_id>/history/', views.device_history, name='device_history'),
     path('devices/<str:device_id>/history-data/', views.device_history_data, name='device_history_data'),
     path('devices/<str:device_id>/device-data/', views.device_data, name='device_data'),
@@ -18,5 +20,6 @@ urlpatterns = [
     path('notifications/<int:notification_id>/mark-read/', views.mark_notification_read, name='mark_notification_read'),
     path('settings/', views.user_settings, name='user_settings'),
     path('devices/shares/manage/', views.manage_all_shares, name='manage_all_shares'),
+    path('geofences/', views.manage_geofences, name='manage_geofences'),
     path('subscriptions/<str:device_id>/', views.subscriptions, name='subscriptions'),
 ]
\ No newline at end of file
@@ -1,7 +1,14 @@
+import logging
+import time
 from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Value, When
 from django.utils import timezone
-from device.models import DeviceData, SpeedAlert, Notification, MaintenanceRecord
-from math import radians, sin, cos, sqrt, atan2, degrees
+from device.models import Device, DeviceData, SpeedAlert, Notification, MaintenanceRecord
+from device import alerts, archive, compression, geodesy, geofences, rollups, spatial
+from device.metrics import READING_PROCESS_SECONDS, observe_batch
+
+logger = logging.getLogger(__name__)
 
 def parse_timestamp(timestamp_str):
     try:
@@ -9,26 +16,20 @@ def parse_timestamp(timestamp_str):
     except (ValueError, TypeError):
         return None
 
+def latest_data_for_devices(device_ids=None):
+    """Return {device pk: latest DeviceData} for many devices in a single query."""
+    devices = Device.objects.all() if device_ids is None else Device.objects.filter(pk__in=device_ids)
+    newest = DeviceData.objects.filter(device=OuterRef('pk')).order_by('-timestamp').values('pk')[:1]
+    latest_ids = devices.annotate(latest_id=Subquery(newest)).filter(latest_id__isnull=False).values('latest_id')
+    return {data.device_id: data for data in DeviceData.objects.filter(pk__in=latest_ids)}
+
 def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371  # Earth's radius in km
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    return R * c
+    return geodesy.haversine(lat1, lon1, lat2, lon2) / 1000  # in km
 
 def calculate_total_distance(data_points):
-    if not data_points or data_points.count() < 2:
-        return 0
-    total = 0
-    points = list(data_points)
-    for i in range(len(points) - 1):
-        total += haversine_distance(
-            points[i].latitude, points[i].longitude,
-            points[i+1].latitude, points[i+1].longitude
-        )
-    return total * 1000  # Convert to meters
+    # Only coordinates are fetched and the distance is summed in one vectorised pass.
+    latitude, longitude, _ = geodesy.track_arrays(data_points)
+    return float(geodesy.segment_distances(latitude, longitude).sum())  # in meters
 
 def calculate_speed(current_data, previous_data):
     if not previous_data:
@@ -43,91 +44,473 @@ def calculate_speed(current_data, previous_data):
 def calculate_heading(current_data, previous_data):
     if not previous_data:
         return 0
-    lat1, lon1 = radians(previous_data.latitude), radians(previous_data.longitude)
-    lat2, lon2 = radians(current_data.latitude), radians(current_data.longitude)
-    dlon = lon2 - lon1
-    y = sin(dlon) * cos(lat2)
-    x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon)
-    heading = atan2(y, x)
-    heading = (degrees(heading) + 360) % 360
-    return heading
+    return geodesy.bearing(previous_data.latitude, previous_data.longitude, current_data.latitude, current_data.longitude)
+
+def latest_maintenance_for_devices(device_ids):
+    """Return {device pk: timestamp of its latest MaintenanceRecord} in a single query."""
+    newest = MaintenanceRecord.objects.filter(device=OuterRef('pk')).order_by('-timestamp').values('timestamp')[:1]
+    rows = Device.objects.filter(pk__in=device_ids).annotate(last_maintenance=Subquery(newest))
+    return {pk: timestamp for pk, timestamp in rows.values_list('pk', 'last_maintenance') if timestamp}
+
+def next_odometer(previous_data, latitude, longitude):
+    """Odometer reading in metres for a new point that follows previous_data."""
+    if not previous_data:
+        return 0
+    return previous_data.odometer + haversine_distance(previous_data.latitude, previous_data.longitude, latitude, longitude) * 1000
+
+def save_device_odometers(odometers):
+    """Copy {device pk: odometer in metres} onto Device rows with a single UPDATE."""
+    if odometers:
+        Device.objects.bulk_update([Device(pk=pk, odometer=odometer) for pk, odometer in odometers.items()], ['odometer'])
+
+LATEST_COLUMNS = {
+    'last_timestamp': 'timestamp',
+    'last_latitude': 'latitude',
+    'last_longitude': 'longitude',
+    'last_altitude': 'altitude',
+    'last_speed': 'speed',
+    'last_heading': 'heading',
+    'last_charge': 'charge',
+    'last_power_source': 'power_source',
+    'odometer': 'odometer',
+}
+
+def save_latest_points(points):
+    """
+    Copy {device pk: newest DeviceData or DeviceState} onto the Device rows'
+    last_* columns, geohash and odometer with a single UPDATE, and into this
+    process's spatial index once the transaction commits. A row that already
+    holds a newer reading (another writer got there first) is left as it is.
+    """
+    if not points:
+        return
+    newer = {
+        pk: Q(pk=pk) & (Q(last_timestamp__isnull=True) | Q(last_timestamp__lt=point.timestamp))
+        for pk, point in points.items()
+    }
+    Device.objects.filter(pk__in=list(points)).update(**{
+        column: Case(
+            *[When(newer[pk], then=Value(getattr(point, attribute, 0), output_field=Device._meta.get_field(column)))
+              for pk, point in points.items()],
+            default=F(column),
+        )
+        for column, attribute in LATEST_COLUMNS.items()
+    }, last_geohash=Case(
+        *[When(newer[pk], then=Value(spatial.encode(point.latitude, point.longitude))) for pk, point in points.items()],
+        default=F('last_geohash'),
+    ))
+    transaction.on_commit(lambda: spatial.index_points(points))
+
+def odometer_distance(device, since=None, until=None):
+    """
+    Metres travelled between the first and last points in [since, until],
+    from the per-point odometer: two index lookups instead of a history scan,
+    plus the archive manifest when the window reaches into archived days.
+    """
+    points = DeviceData.objects.filter(device=device)
+    if since:
+        points = points.filter(timestamp__gte=since)
+    if until:
+        points = points.filter(timestamp__lte=until)
+    edges = [edge for edge in (
+        points.order_by('timestamp').values_list('timestamp', 'odometer').first(),
+        points.order_by('-timestamp').values_list('timestamp', 'odometer').first(),
+    ) if edge]
+    edges += archive.odometer_bounds(device, since, until) or []
+    if not edges:
+        return 0
+    return max(max(edges)[1] - min(edges)[1], 0)
 
 def process_device_data(device, latitude, longitude, altitude, charge, timestamp, power_source, speed=0, heading=0):
-    latest_data = DeviceData.objects.filter(device=device).order_by('-timestamp').first()
-    
-    current_point = type('Data', (), {'latitude': latitude, 'longitude': longitude, 'timestamp': timestamp})()
-    speed = calculate_speed(current_point, latest_data) if latest_data and speed == 0 else speed
-    heading = calculate_heading(current_point, latest_data) if latest_data and heading == 0 else heading
-
-    if latest_data and latest_data.timestamp == timestamp:
-        timestamp += timedelta(microseconds=1)
-    device_data = DeviceData(
-        device=device,
-        latitude=latitude,
-        longitude=longitude,
-        altitude=altitude,
-        speed=speed,
-        heading=heading,
-        charge=charge,
-        timestamp=timestamp,
-        power_source=power_source
-    )
-    device_data.save()
+    stored = process_device_data_batch([{
+        'device': device,
+        'latitude': latitude,
+        'longitude': longitude,
+        'altitude': altitude,
+        'charge': charge,
+        'timestamp': timestamp,
+        'power_source': power_source,
+        'speed': speed,
+        'heading': heading,
+    }])
+    return stored[0] if stored else None
 
-    if latest_data:
-        distance = haversine_distance(latest_data.latitude, latest_data.longitude, latitude, longitude)
-        if distance > 0.5:
-            Notification.objects.create(
-                device=device,
-                user=device.user,
-                message=f"Device moved significantly: Primary ({latest_data.latitude}, {latest_data.longitude}) to Secondary ({latitude}, {longitude})",
-                timestamp=timezone.now()
-            )
+def process_device_data_batch(readings, state_store=None, ignore_conflicts=False):
+    """
+    Store many readings, for any mix of devices, in a constant number of queries.
+
+    Each reading is a dict of process_device_data keyword arguments. Readings
+    are applied in order, so a device's second reading in the batch is compared
+    with its first exactly as if process_device_data had been called once per
+    reading. Previous points come from the last-known-state store rather than
+    DeviceData, read under a lock on the devices' rows (see device.state), and
+    the whole batch is written in that transaction. Readings older than their
+    device's latest point go through insert_late_readings instead.
+
+    With ignore_conflicts the insert is idempotent (ON CONFLICT DO NOTHING):
+    a reading with the same timestamp as the device's latest point is skipped
+    instead of being shifted by a microsecond, so retries and replays are free.
 
-    if speed > 50:
-        SpeedAlert.objects.create(
+    Devices with a compression_tolerance only store the readings that
+    device.compression keeps; the rest still run through the rules and the
+    geofences. Returns the stored points.
+    """
+    from device.state import get_state_store
+
+    readings = list(readings)
+    if not readings:
+        return []
+    state_store = state_store or get_state_store()
+    device_ids = {reading['device'].pk for reading in readings}
+    with transaction.atomic():
+        # Locks the devices' rows (unless the store is a cache) until the batch is written
+        latest = state_store.get_many(device_ids)
+        return _process_batch(readings, device_ids, latest, state_store, ignore_conflicts)
+
+def _process_batch(readings, device_ids, latest, state_store, ignore_conflicts):
+    from device.state import DeviceState
+
+    last_maintenance = latest_maintenance_for_devices(device_ids)
+    alert_states = alerts.AlertTracker(device_ids)
+    odometers = {}
+
+    new_data, notifications, speed_alerts, maintenance_records, rollup_entries = [], [], [], [], []
+    fence_points, late = [], []
+    dwells = {}
+    started = time.perf_counter()
+    for reading in readings:
+        device = reading['device']
+        latitude, longitude = reading['latitude'], reading['longitude']
+        timestamp, power_source = reading['timestamp'], reading['power_source']
+        speed, heading = reading.get('speed', 0), reading.get('heading', 0)
+        latest_data = latest.get(device.pk)
+        if latest_data and timestamp < latest_data.timestamp:
+            # Older than what another writer (or this batch) already stored: slot it into the history
+            late.append(reading)
+            continue
+
+        current_point = type('Data', (), {'latitude': latitude, 'longitude': longitude, 'timestamp': timestamp})()
+        speed = calculate_speed(current_point, latest_data) if latest_data and speed == 0 else speed
+        heading = calculate_heading(current_point, latest_data) if latest_data and heading == 0 else heading
+
+        if latest_data and latest_data.timestamp == timestamp:
+            if ignore_conflicts:
+                continue
+            timestamp += timedelta(microseconds=1)
+        device_data = DeviceData(
             device=device,
-            message="Speed exceeded 50 km/h",
+            latitude=latitude,
+            longitude=longitude,
+            altitude=reading.get('altitude', 0),
             speed=speed,
-            timestamp=timestamp
+            heading=heading,
+            charge=reading['charge'],
+            timestamp=timestamp,
+            power_source=power_source,
+            odometer=next_odometer(latest_data, latitude, longitude)
         )
-    if latest_data and latest_data.speed > 0:
-        speed_diff = speed - latest_data.speed
-        time_diff = (timestamp - latest_data.timestamp).total_seconds() / 3600
-        if time_diff > 0:
-            accel = speed_diff / time_diff
-            if accel > 100 or accel < -100:
-                SpeedAlert.objects.create(
+        fence_points.append((device, device_data))
+        anchor = compression.anchor_of(latest_data) if latest_data and device.compression_tolerance else None
+        if anchor is None or compression.keep(anchor, device_data, device.compression_tolerance):
+            # Rollups count stored points against the previous stored one, as rebuild_rollups does
+            rollup_entries.append(rollups.point_entry(device.pk, device_data, anchor or latest_data))
+            new_data.append(device_data)
+            current = device_data
+        else:
+            # Dropped: the state remembers the anchor, whose dwell grows while the device stays put
+            if not isinstance(anchor, DeviceState):
+                anchor = DeviceState.from_data(anchor)
+            if compression.is_stationary(anchor):
+                anchor.dwell = (timestamp - anchor.timestamp).total_seconds()
+                dwells[device.pk] = (anchor.timestamp, anchor.dwell)
+            current = DeviceState.from_data(device_data)
+            current.anchor = anchor
+        if not latest_data or timestamp > latest_data.timestamp:
+            latest[device.pk] = current
+            device.odometer = odometers[device.pk] = device_data.odometer
+
+        moved = stationary_time = accel = None
+        if latest_data:
+            distance = haversine_distance(latest_data.latitude, latest_data.longitude, latitude, longitude)
+            moved = distance > 0.5
+            if speed == 0:
+                stationary_time = (timestamp - latest_data.timestamp).total_seconds() / 60
+            if latest_data.speed > 0:
+                time_diff = (timestamp - latest_data.timestamp).total_seconds() / 3600
+                if time_diff > 0:
+                    accel = (speed - latest_data.speed) / time_diff
+
+        if alert_states.update(device.pk, 'moving', moved, timestamp):
+            notifications.append(Notification(
+                device=device,
+                user_id=device.user_id,
+                message=f"Device moved significantly: Primary ({latest_data.latitude}, {latest_data.longitude}) to Secondary ({latitude}, {longitude})",
+                timestamp=timezone.now()
+            ))
+
+        if alert_states.update(device.pk, 'speeding', speed > 50, timestamp):
+            speed_alerts.append(SpeedAlert(
+                device=device,
+                message="Speed exceeded 50 km/h",
+                speed=speed,
+                timestamp=timestamp
+            ))
+        for rule, harsh in (('harsh_acceleration', accel is not None and accel > 100),
+                            ('harsh_braking', accel is not None and accel < -100)):
+            if alert_states.update(device.pk, rule, None if accel is None else harsh, timestamp):
+                speed_alerts.append(SpeedAlert(
                     device=device,
                     message=f"Abnormal speed {'increase' if accel > 0 else 'decrease'}",
                     speed=speed,
                     timestamp=timestamp
-                )
+                ))
 
-    if speed == 0 and latest_data:
-        stationary_time = (timestamp - latest_data.timestamp).total_seconds() / 60
-        if stationary_time >= 10:
+        # A stop lasts until the device moves again; short gaps between stationary readings do not end it
+        stopped = None
+        if speed > 0:
+            stopped = False
+        elif stationary_time is not None and stationary_time >= 10:
+            stopped = True
+        if alert_states.update(device.pk, 'stationary', stopped, timestamp):
             status = 'off' if power_source == 'battery' else 'sleep'
-            Notification.objects.create(
+            notifications.append(Notification(
                 device=device,
-                user=device.user,
+                user_id=device.user_id,
                 message=f"Device in {status} mode: Stationary for {stationary_time:.1f} minutes",
                 timestamp=timezone.now()
+            ))
+
+        maintained_at = last_maintenance.get(device.pk)
+        total_distance = latest[device.pk].odometer
+        due = not maintained_at or (timezone.now() - maintained_at).days > 30 or total_distance / 1000 > 1000
+        if alert_states.update(device.pk, 'maintenance', due, timestamp):
+            now = timezone.now()
+            last_maintenance[device.pk] = now
+            maintenance_records.append(MaintenanceRecord(
+                device=device,
+                status="Maintenance required",
+                timestamp=now
+            ))
+            notifications.append(Notification(
+                device=device,
+                user_id=device.user_id,
+                message="Device requires maintenance",
+                timestamp=now
+            ))
+
+    READING_PROCESS_SECONDS.observe((time.perf_counter() - started) / len(readings))
+    started = time.perf_counter()
+    DeviceData.objects.bulk_create(new_data, ignore_conflicts=ignore_conflicts)
+    save_latest_points({pk: latest[pk] for pk in odometers})
+    notifications += geofences.evaluate(fence_points)
+    Notification.objects.bulk_create(notifications)
+    SpeedAlert.objects.bulk_create(speed_alerts)
+    MaintenanceRecord.objects.bulk_create(maintenance_records)
+    alert_states.save()
+    rollups.record(rollup_entries)
+    for pk, (anchor_timestamp, dwell) in dwells.items():
+        DeviceData.objects.filter(device_id=pk, timestamp=anchor_timestamp).update(dwell=dwell)
+    state_store.put_on_commit({pk: latest[pk] for pk in device_ids if pk in latest})
+    observe_batch('ingest', [data.timestamp for data in new_data], time.perf_counter() - started)
+    if late:
+        new_data += insert_late_readings(late, state_store)
+    return new_data
+
+def drop_stored_readings(readings):
+    """
+    Readings whose (device, timestamp) is not already in DeviceData, not
+    repeated earlier in the list and newer than the device's archived days,
+    checked with two queries.
+    """
+    readings = list(readings)
+    if not readings:
+        return []
+    timestamps = [reading['timestamp'] for reading in readings]
+    device_ids = {reading['device'].pk for reading in readings}
+    seen = set(DeviceData.objects.filter(
+        device_id__in=device_ids, timestamp__gte=min(timestamps), timestamp__lte=max(timestamps),
+    ).values_list('device_id', 'timestamp'))
+    horizons = archive.horizons(device_ids)
+    fresh = []
+    for reading in readings:
+        key = (reading['device'].pk, reading['timestamp'])
+        horizon = horizons.get(key[0])
+        if key not in seen and not (horizon and key[1] <= horizon):
+            seen.add(key)
+            fresh.append(reading)
+    return fresh
+
+def insert_late_reading(reading, state_store=None):
+    """insert_late_readings for one reading; returns the new DeviceData or None."""
+    stored = insert_late_readings([reading], state_store)
+    return stored[0] if stored else None
+
+def insert_late_readings(readings, state_store=None):
+    """
+    Slot points that are older than their devices' latest points into the history.
+
+    Each point's speed, heading and odometer are derived from its real
+    predecessor, which may be another late point. A stored point that gets a
+    new predecessor has its speed and heading recomputed, unless the device
+    reported them, and later odometers shift by the detour the late points
+    add. A device's backlog costs a fixed number of queries however long it
+    is: one read of the stored points it spans plus its two neighbours, one
+    bulk update for the points in between and one UPDATE for everything after.
+    No alerts are raised for late points. Returns the new DeviceData; readings
+    that were already stored, are not newer than their device's archived days
+    (see device.archive) or are within their device's compression tolerance
+    are skipped.
+    """
+    from device.state import get_state_store
+
+    state_store = state_store or get_state_store()
+    by_device = {}
+    for reading in sorted(readings, key=lambda reading: reading['timestamp']):
+        by_device.setdefault(reading['device'].pk, {}).setdefault(reading['timestamp'], reading)
+    if not by_device:
+        return []
+    started = time.perf_counter()
+    stored = []
+    with transaction.atomic():
+        horizons = archive.horizons(list(by_device))
+        for pk, device_readings in by_device.items():
+            horizon = horizons.get(pk)
+            late = [reading for timestamp, reading in device_readings.items() if not (horizon and timestamp <= horizon)]
+            if late:
+                stored += _insert_late(late[0]['device'], late, horizon, state_store)
+    observe_batch('late', [point.timestamp for point in stored], time.perf_counter() - started)
+    return stored
+
+def _derived(point, previous):
+    """(speed, heading) of a stored point: whether each is what ingest derived from previous, not a device report."""
+    if previous is None:
+        return point.speed == 0, point.heading == 0
+    return (abs(point.speed - calculate_speed(point, previous)) < 1e-6,
+            abs(point.heading - calculate_heading(point, previous)) < 1e-6)
+
+def _insert_late(device, late, horizon, state_store):
+    """insert_late_readings for one device's readings, oldest first."""
+    history = DeviceData.objects.filter(device=device)
+    first, last = late[0]['timestamp'], late[-1]['timestamp']
+    window = list(history.filter(timestamp__gte=first, timestamp__lte=last).order_by('timestamp'))
+    previous = history.filter(timestamp__lt=first).order_by('-timestamp').first()
+    if horizon and (previous is None or previous.timestamp < horizon):
+        # The live history starts after the archived days: the predecessor is the last archived point
+        previous = archive.last_point(device)
+    following = history.filter(timestamp__gt=last).order_by('timestamp').first()
+
+    stored_timestamps = {row.timestamp for row in window}
+    timeline = sorted(window + [reading for reading in late if reading['timestamp'] not in stored_timestamps],
+                      key=lambda item: item['timestamp'] if isinstance(item, dict) else item.timestamp)
+    if following is not None:
+        timeline.append(following)
+    points, changed, entries, run = [], [], [], []
+    current = original_previous = previous
+    resequenced = None
+    shift = 0
+    for item in timeline:
+        if isinstance(item, dict):
+            point = DeviceData(
+                device=device,
+                latitude=item['latitude'],
+                longitude=item['longitude'],
+                altitude=item.get('altitude', 0),
+                speed=item.get('speed', 0),
+                heading=item.get('heading', 0),
+                charge=item['charge'],
+                timestamp=item['timestamp'],
+                power_source=item['power_source'],
+                odometer=next_odometer(current, item['latitude'], item['longitude'])
             )
+            if current and point.speed == 0:
+                point.speed = calculate_speed(point, current)
+            if current and point.heading == 0:
+                point.heading = calculate_heading(point, current)
+            if device.compression_tolerance and current and not compression.keep(current, point, device.compression_tolerance):
+                # Reconstructable from its predecessor: dropped now, or a redelivery of a reading dropped at ingest
+                continue
+            points.append(point)
+            run.append((point, current))
+            current = point
+            continue
+        if run:
+            # A stored point behind late ones: derived speed and heading follow its new predecessor
+            speed_derived, heading_derived = _derived(item, original_previous)
+            if speed_derived:
+                item.speed = calculate_speed(item, current)
+            if heading_derived:
+                item.heading = calculate_heading(item, current)
+            delta = next_odometer(current, item.latitude, item.longitude) - item.odometer
+            # The detour's extra distance is booked to the buckets of the last late point before it;
+            # no moving time or status change
+            entries += [(device.pk, point.timestamp, point.speed, point.charge, 0, 0, 0) for point, _ in run]
+            entries[-1] = entries[-1][:4] + (max(delta - shift, 0), 0, 0)
+            shift, run = delta, []
+            changed.append(item)
+            resequenced = item
+        elif shift:
+            changed.append(item)
+        if item is not following:
+            item.odometer += shift
+        original_previous = current = item
+    # Late points after every stored one count like points stored at ingest
+    entries += [rollups.point_entry(device.pk, point, predecessor) for point, predecessor in run]
 
-    total_distance = calculate_total_distance(DeviceData.objects.filter(device=device))
-    last_maintenance = MaintenanceRecord.objects.filter(device=device).order_by('-timestamp').first()
-    if not last_maintenance or (timezone.now() - last_maintenance.timestamp).days > 30 or total_distance / 1000 > 1000:
-        MaintenanceRecord.objects.create(
-            device=device,
-            status="Maintenance required",
-            timestamp=timezone.now()
-        )
-        Notification.objects.create(
-            device=device,
-            user=device.user,
-            message="Device requires maintenance",
-            timestamp=timezone.now()
-        )
+    DeviceData.objects.bulk_create(points, ignore_conflicts=True)
+    DeviceData.objects.bulk_update([row for row in changed if row is not following], ['odometer', 'speed', 'heading'])
+    if following is not None:
+        if resequenced is following:
+            following.save(update_fields=['speed', 'heading'])
+        if shift:
+            history.filter(timestamp__gte=following.timestamp).update(odometer=F('odometer') + shift)
+    if run:
+        newest = run[-1][0]
+        latest = state_store.get(device.pk)
+        if latest is None or latest.timestamp < newest.timestamp:
+            save_latest_points({device.pk: newest})
+            state_store.put_on_commit({device.pk: newest})
+            shift = 0
+    if shift:
+        Device.objects.filter(pk=device.pk).update(odometer=F('odometer') + shift)
+        transaction.on_commit(lambda: _shift_state_odometer(state_store, device.pk, shift))
+    rollups.record(entries)
+    return points
+
+def _shift_state_odometer(state_store, device_pk, delta):
+    state = state_store.get(device_pk)
+    if state:
+        state.odometer += delta
+        state_store.put(device_pk, state)
 
-    return device_data
\ No newline at end of file
+def store_readings(readings, state_store=None):
+    """
+    Idempotent ingest: readings newer than their device's latest point are
+    written as one ON CONFLICT DO NOTHING batch, older ones are slotted into
+    the history with insert_late_readings. Returns how many were new.
+    """
+    readings = sorted(readings, key=lambda reading: reading['timestamp'])
+    return len(process_device_data_batch(readings, state_store, ignore_conflicts=True))
+
+def save_readings(readings):
+    """
+    Store readings that may be redelivered (push listeners, stream consumers):
+    already-stored and repeated points are dropped and the rest go through
+    store_readings, one at a time if the batch fails. If the database itself
+    is unreachable the error is raised so the caller can retry later. Returns
+    how many readings were saved.
+    """
+    readings = drop_stored_readings(readings)
+    if not readings:
+        return 0
+    try:
+        return store_readings(readings)
+    except Exception as e:
+        logger.error(f"Batch save of {len(readings)} readings failed, retrying one by one: {str(e)}")
+    connection.ensure_connection()
+    saved = 0
+    for reading in readings:
+        try:
+            saved += store_readings([reading])
+        except Exception as e:
+            logger.error(f"Unexpected error saving data for {reading['device'].device_id}: {str(e)}")
+    return saved
@@ -1,16 +1,22 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from .models import Device, DeviceData, SpeedAlert, DeviceShare, Notification, MaintenanceRecord
+from .models import Device, DeviceData, SpeedAlert, DeviceShare, Notification, MaintenanceRecord, IngestToken, Geofence
 from django.contrib import messages
 from django.utils import timezone
 from datetime import timedelta
-from django.http import JsonResponse
-from django.db import IntegrityError
-from django.views.decorators.csrf import csrf_protect
+from django.http import JsonResponse, HttpResponse
+from django.db import IntegrityError, transaction
+from django.views.decorators.csrf import csrf_protect, csrf_exempt
+from django.conf import settings
 import json
-from .utils import parse_timestamp, calculate_total_distance, calculate_speed
-from django.db.models import Sum, Avg, Max, Min, Count
-from math import radians, sin, cos, sqrt, atan2
+from .utils import parse_timestamp, next_odometer, save_latest_points, odometer_distance, insert_late_reading
+from .state import DeviceState, get_state_store
+from . import archive, geofences, rollups, spatial
+from .ingest import TooManyItems, decode_items, ingest_items
+from .metrics import REGISTRY, CONTENT_TYPE
+from .compact import compact_history, compress_response
+from django.db.models import Sum, Count, Q
+from math import radians, sin, cos, sqrt, atan2, isfinite
 from django.contrib.auth.models import User
 from django.contrib.auth import update_session_auth_hash
 
@@ -19,17 +25,14 @@ from django.contrib.auth import update_session_auth_hash
 def home(request):
     # Devices linked and active
     devices = Device.objects.filter(user=request.user)
-    shared_devices = DeviceShare.objects.filter(shared_with=request.user)
+    shared_devices = DeviceShare.objects.filter(shared_with=request.user).select_related('device')
     total_devices = devices.count() + shared_devices.count()
     
     # Active devices: Devices with data in the last 10 minutes
     ten_minutes_ago = timezone.now() - timedelta(minutes=10)
-    active_devices = Device.objects.filter(
-        devicedata__timestamp__gte=ten_minutes_ago
-    ).filter(user=request.user).distinct().count() + DeviceShare.objects.filter(
-        shared_with=request.user,
-        device__devicedata__timestamp__gte=ten_minutes_ago
-    ).distinct().count()
+    active_devices = devices.filter(last_timestamp__gte=ten_minutes_ago).count() + shared_devices.filter(
+        device__last_timestamp__gte=ten_minutes_ago
+    ).count()
     
     # All notifications for the user (across all devices)
     notifications = Notification.objects.filter(user=request.user).order_by('-timestamp')[:10]
@@ -37,18 +40,16 @@ def home(request):
     # Combine owned and shared devices for display
     all_devices = []
     for device in devices:
-        latest_data = DeviceData.objects.filter(device=device).order_by('-timestamp').first()
         all_devices.append({
             'device': device,
             'is_shared': False,
-            'status': 'Active' if latest_data and (timezone.now() - latest_data.timestamp).total_seconds() / 60 < 10 else 'Inactive',
+            'status': 'Active' if device.last_timestamp and device.last_timestamp >= ten_minutes_ago else 'Inactive',
         })
     for share in shared_devices:
-        latest_data = DeviceData.objects.filter(device=share.device).order_by('-timestamp').first()
         all_devices.append({
             'device': share.device,
             'is_shared': True,
-            'status': 'Active' if latest_data and (timezone.now() - latest_data.timestamp).total_seconds() / 60 < 10 else 'Inactive',
+            'status': 'Active' if share.device.last_timestamp and share.device.last_timestamp >= ten_minutes_ago else 'Inactive',
         })
     
     return render(request, 'device/home.html', {
@@ -61,8 +62,8 @@ def home(request):
 
 @login_required
 def device_list(request):
-    devices = Device.objects.filter(user=request.user)
-    shared_devices = DeviceShare.objects.filter(shared_with=request.user)
+    devices = Device.objects.filter(user=request.user).prefetch_related('deviceshare_set')
+    shared_devices = DeviceShare.objects.filter(shared_with=request.user).select_related('device')
     # All notifications for the user (across all devices)
     notifications = Notification.objects.filter(user=request.user).order_by('-timestamp')[:10]
     return render(request, 'device/device_list.html', 
@@ -127,7 +128,7 @@ def dashboard(request, device_id):
         if device.user != request.user and not DeviceShare.objects.filter(device=device, shared_with=request.user).exists():
             messages.error(request, "You do not have access to this device.")
             return redirect('device_list')
-        latest_data = DeviceData.objects.filter(device=device).order_by('-timestamp').first()
+        latest_data = DeviceState.from_device(device) if device.last_timestamp else None
         notifications = Notification.objects.filter(device=device, user=request.user).order_by('-timestamp')[:10]
         data = {
             'deviceId': device.device_id,
@@ -160,8 +161,7 @@ def dashboard(request, device_id):
                 'is_on': latest_data.speed > 0 or (timezone.now() - latest_data.timestamp).total_seconds() / 60 < 10
             })
         time_threshold = timezone.now() - timedelta(hours=24)
-        data_points = DeviceData.objects.filter(device=device, timestamp__gte=time_threshold).order_by('timestamp')
-        data['total_distance'] = calculate_total_distance(data_points) / 1000
+        data['total_distance'] = odometer_distance(device, since=time_threshold) / 1000
         maintenance = MaintenanceRecord.objects.filter(device=device).order_by('-timestamp').first()
         data['maintenance_status'] = maintenance.status if maintenance else "No maintenance records"
         return render(request, 'device/dashboard.html', {'device': device, 'data': data, 'notifications': notifications})
@@ -194,28 +194,56 @@ def save_device_data(request, device_id):
             parsed_timestamp = parse_timestamp(data['timestamp'])
             if not parsed_timestamp:
                 return JsonResponse({"status": "error", "message": "Invalid timestamp format"}, status=400)
-            if power_source == 'battery' and not request.user.is_admin:
-                latest_data = DeviceData.objects.filter(device=device).order_by('-timestamp').first()
-                if latest_data:
-                    time_diff = (parsed_timestamp - latest_data.timestamp).total_seconds() / 60
-                    if time_diff < device.update_interval:
-                        return JsonResponse({"status": "error", "message": "Update interval not reached"}, status=429)
-            device_data = DeviceData.objects.create(
-                device=device,
-                latitude=latitude,
-                longitude=longitude,
-                altitude=altitude,
-                charge=charge,
-                timestamp=parsed_timestamp,
-                power_source=power_source,
-                speed=speed,
-                heading=heading
-            )
-            return JsonResponse({"status": "success"})
+            state_store = get_state_store()
+            # The device row stays locked until the point is written, so a concurrent writer
+            # cannot slip a newer point in between reading the predecessor and storing this one
+            with transaction.atomic():
+                latest_data = state_store.get(device.pk)
+                reading = {
+                    'device': device,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'altitude': altitude,
+                    'charge': charge,
+                    'timestamp': parsed_timestamp,
+                    'power_source': power_source,
+                    'speed': speed,
+                    'heading': heading,
+                }
+                if latest_data and parsed_timestamp < latest_data.timestamp:
+                    # Late point: slot it in after its real predecessor
+                    if insert_late_reading(reading, state_store) is None:
+                        return JsonResponse({"status": "success", "duplicate": True})
+                    return JsonResponse({"status": "success"})
+                if latest_data and parsed_timestamp == latest_data.timestamp:
+                    # A retried upload of the latest point is accepted as-is
+                    return JsonResponse({"status": "success", "duplicate": True})
+                if power_source == 'battery' and not request.user.is_admin:
+                    if latest_data:
+                        time_diff = (parsed_timestamp - latest_data.timestamp).total_seconds() / 60
+                        if time_diff < device.update_interval:
+                            return JsonResponse({"status": "error", "message": "Update interval not reached"}, status=429)
+                device_data = DeviceData.objects.create(
+                    device=device,
+                    latitude=latitude,
+                    longitude=longitude,
+                    altitude=altitude,
+                    charge=charge,
+                    timestamp=parsed_timestamp,
+                    power_source=power_source,
+                    speed=speed,
+                    heading=heading,
+                    odometer=next_odometer(latest_data, latitude, longitude)
+                )
+                save_latest_points({device.pk: device_data})
+                rollups.record([rollups.point_entry(device.pk, device_data, latest_data)])
+                Notification.objects.bulk_create(geofences.evaluate([(device, device_data)]))
+                state_store.put_on_commit({device.pk: device_data})
+                return JsonResponse({"status": "success"})
         except (ValueError, TypeError) as e:
             return JsonResponse({"status": "error", "message": f"Invalid data types: {str(e)}"}, status=400)
         except IntegrityError:
-            return JsonResponse({"status": "error", "message": "Duplicate timestamp for this device"}, status=400)
+            return JsonResponse({"status": "success", "duplicate": True})
     except Device.DoesNotExist:
         return JsonResponse({"status": "error", "message": "Device not found"}, status=404)
     except json.JSONDecodeError:
@@ -224,6 +252,43 @@ def save_device_data(request, device_id):
         print(f"save_device_data: Unexpected error: {str(e)}")
         return JsonResponse({"status": "error", "message": "Server error"}, status=500)
 
+def token_user(request):
+    auth = request.headers.get('Authorization', '')
+    scheme, _, key = auth.partition(' ')
+    if scheme.lower() not in ('token', 'bearer') or not key:
+        return None
+    token = IngestToken.objects.select_related('user').filter(key=key.strip()).first()
+    return token.user if token and token.user.is_active else None
+
+@csrf_exempt
+def bulk_ingest(request):
+    if request.method != 'POST':
+        return JsonResponse({"status": "error", "message": "Invalid request method"}, status=405)
+    user = token_user(request)
+    if user is None:
+        return JsonResponse({"status": "error", "message": "Invalid or missing token"}, status=401)
+    try:
+        results = ingest_items(decode_items(request), user, getattr(settings, 'GPS_INGEST_MAX_ITEMS', 50000))
+    except TooManyItems as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=413)
+    except ValueError as e:
+        # json.JSONDecodeError and msgpack decode errors are ValueErrors too
+        return JsonResponse({"status": "error", "message": f"Invalid body: {str(e)}"}, status=400)
+    accepted = sum(1 for result in results if result["status"] == "ok")
+    return JsonResponse({
+        "status": "success" if accepted == len(results) else "partial",
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "results": results,
+    })
+
+def metrics(request):
+    # Prometheus scrape endpoint; set GPS_METRICS_TOKEN to require "Authorization: Bearer <token>"
+    token = getattr(settings, 'GPS_METRICS_TOKEN', None)
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return HttpResponse(status=401)
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 @login_required
 def device_history(request, device_id):
     try:
@@ -242,42 +307,43 @@ def device_history_data(request, device_id):
         device = Device.objects.get(device_id=device_id)
         if device.user != request.user and not DeviceShare.objects.filter(device=device, shared_with=request.user).exists():
             return JsonResponse({"error": "Unauthorized"}, status=403)
-        query = DeviceData.objects.filter(device=device).order_by('-timestamp')
         time_threshold = request.GET.get('time_threshold')
         limit = request.GET.get('limit')
+        parsed_threshold = None
         if time_threshold:
             parsed_threshold = parse_timestamp(time_threshold)
             if not parsed_threshold:
                 return JsonResponse({"error": "Invalid time threshold format"}, status=400)
-            query = query.filter(timestamp__gte=parsed_threshold)
-        data_points = query.all()
         if limit:
             try:
-                data_points = data_points[:int(limit)]
+                limit = int(limit)
             except ValueError:
                 return JsonResponse({"error": "Invalid limit parameter"}, status=400)
+        # Live rows merged with any archived days the range reaches into
+        data_points = archive.history(device, since=parsed_threshold, limit=limit or None)
         if not data_points:
             return JsonResponse({"error": "No data points available for this time range"}, status=404)
-        points = [{
-            "latitude": point.latitude,
-            "longitude": point.longitude,
-            "timestamp": point.timestamp.isoformat(),
-            "speed": point.speed,
-            "heading": point.heading,
-            "altitude": point.altitude,
-            "charge": point.charge,
-            "power_source": point.power_source
-        } for point in data_points]
-        distance_query = DeviceData.objects.filter(
-            device=device,
-            timestamp__gte=(parse_timestamp(time_threshold) or timezone.now() - timedelta(hours=24))
-        ).order_by('timestamp')
-        total_distance = calculate_total_distance(distance_query) / 1000
-        return JsonResponse({
-            "data_points": points,
-            "count": len(points),
-            "total_distance": total_distance
-        })
+        total_distance = odometer_distance(
+            device,
+            since=(parsed_threshold or timezone.now() - timedelta(hours=24))
+        ) / 1000
+        if request.GET.get('format') == 'compact':
+            # Column strings instead of per-point objects; decoded by templates/device/track_codec.html
+            payload = compact_history(data_points)
+        else:
+            payload = {"data_points": [{
+                "latitude": point.latitude,
+                "longitude": point.longitude,
+                "timestamp": point.timestamp.isoformat(),
+                "speed": point.speed,
+                "heading": point.heading,
+                "altitude": point.altitude,
+                "charge": point.charge,
+                "power_source": point.power_source,
+                "dwell": point.dwell
+            } for point in data_points]}
+        payload.update({"count": len(data_points), "total_distance": total_distance})
+        return compress_response(request, JsonResponse(payload))
     except Device.DoesNotExist:
         return JsonResponse({"error": "Device not found"}, status=404)
 
@@ -288,7 +354,6 @@ def device_data(request, device_id):
         if device.user != request.user and not DeviceShare.objects.filter(device=device, shared_with=request.user).exists():
             messages.error(request, "You do not have access to this device.")
             return redirect('device_list')
-        data_points = DeviceData.objects.filter(device=device).order_by('timestamp')
         metrics = {
             'total_distance': 0,
             'average_speed': 0,
@@ -299,44 +364,65 @@ def device_data(request, device_id):
             'vehicle_status_changes': 0,
             'weekly_travel_speed': 0
         }
-        if data_points.exists():
-            metrics['total_distance'] = calculate_total_distance(data_points) / 1000
-            metrics['average_speed'] = data_points.aggregate(Avg('speed'))['speed__avg'] or 0
-            metrics['max_speed'] = data_points.aggregate(Max('speed'))['speed__max'] or 0
-            metrics['min_speed'] = data_points.aggregate(Min('speed'))['speed__min'] or 0
+        # Whole-history figures come from the day rollups, not a scan of every point
+        overall = rollups.window_stats(device)
+        if overall['point_count']:
+            metrics['total_distance'] = odometer_distance(device) / 1000
+            metrics['average_speed'] = overall['average_speed']
+            metrics['max_speed'] = overall['max_speed']
+            metrics['min_speed'] = overall['min_speed']
             one_week_ago = timezone.now() - timedelta(days=7)
-            weekly_data = DeviceData.objects.filter(device=device, timestamp__gte=one_week_ago)
             metrics['weekly_data'] = {
-                'total_distance': calculate_total_distance(weekly_data) / 1000,
-                'average_speed': weekly_data.aggregate(Avg('speed'))['speed__avg'] or 0
+                'total_distance': odometer_distance(device, since=one_week_ago) / 1000,
+                'average_speed': rollups.window_stats(device, since=one_week_ago)['average_speed']
             }
             metrics['weekly_travel_speed'] = metrics['weekly_data']['average_speed']
             rash_threshold = 80
             metrics['rash_driving_instances'] = SpeedAlert.objects.filter(device=device, speed__gt=rash_threshold).count()
-            status_changes = 0
-            last_status = None
-            last_timestamp = None
-            for point in data_points:
-                current_status = 'on' if point.speed > 0 else 'off'
-                if last_status is None:
-                    last_status = current_status
-                    last_timestamp = point.timestamp
-                elif current_status != last_status:
-                    if current_status == 'off':
-                        time_diff = (point.timestamp - last_timestamp).total_seconds() / 60
-                        if time_diff >= 10:
-                            status_changes += 1
-                            last_status = current_status
-                    else:
-                        status_changes += 1
-                        last_status = current_status
-                last_timestamp = point.timestamp
-            metrics['vehicle_status_changes'] = status_changes
+            metrics['vehicle_status_changes'] = overall['status_changes']
         return render(request, 'device/device_data.html', {'device': device, 'metrics': metrics})
     except Device.DoesNotExist:
         messages.error(request, "Device not found.")
         return redirect('device_list')
 
+@login_required
+def nearby_devices(request):
+    # ?bbox=south,west,north,east for a map viewport, or ?lat=&lon= with ?radius= (metres) or ?k= (nearest k)
+    try:
+        if 'bbox' in request.GET:
+            south, west, north, east = (float(value) for value in request.GET['bbox'].split(','))
+            if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+                raise ValueError
+        else:
+            latitude, longitude = float(request.GET['lat']), float(request.GET['lon'])
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise ValueError
+            radius = float(request.GET['radius']) if 'radius' in request.GET else None
+            k = min(int(request.GET.get('k', 10)), 1000)
+            if (radius is not None and radius < 0) or k < 1:
+                raise ValueError
+    except (KeyError, ValueError):
+        return JsonResponse({"error": "Pass bbox=south,west,north,east or lat, lon and radius or k"}, status=400)
+    # Only devices the user owns or has been shared
+    scope = spatial.visible_device_ids(request.user)
+    index = spatial.get_index()
+    if 'bbox' in request.GET:
+        matches = [(pk, None) for pk in index.bbox(south, west, north, east, device_ids=scope)]
+    elif radius is not None:
+        matches = index.radius(latitude, longitude, radius, device_ids=scope)
+    else:
+        matches = index.nearest(latitude, longitude, k, device_ids=scope)
+    devices = Device.objects.in_bulk([pk for pk, _ in matches])
+    return JsonResponse({"devices": [{
+        "device_id": devices[pk].device_id,
+        "alias": devices[pk].alias,
+        "latitude": devices[pk].last_latitude,
+        "longitude": devices[pk].last_longitude,
+        "timestamp": devices[pk].last_timestamp.isoformat(),
+        "speed": devices[pk].last_speed,
+        "distance": distance,
+    } for pk, distance in matches if pk in devices and devices[pk].last_timestamp]})
+
 @login_required
 def share_device(request, device_id):
     try:
@@ -383,6 +469,47 @@ def manage_all_shares(request):
 
     return render(request, 'device/manage_all_shares.html', {'devices': devices, 'shares': shares})
 
+@login_required
+def manage_geofences(request):
+    devices = Device.objects.filter(Q(user=request.user) | Q(deviceshare__shared_with=request.user)).distinct()
+    if request.method == 'POST':
+        if request.POST.get('action') == 'delete':
+            deleted, _ = Geofence.objects.filter(id=request.POST.get('geofence_id'), user=request.user).delete()
+            if deleted:
+                messages.success(request, "Geofence deleted.")
+            else:
+                messages.error(request, "Geofence not found.")
+            return redirect('manage_geofences')
+        kind = request.POST.get('kind', 'circle')
+        geofence = Geofence(user=request.user, name=request.POST.get('name', '').strip(), kind=kind)
+        try:
+            geofence.dwell_seconds = int(float(request.POST.get('dwell_minutes') or 0) * 60)
+            if kind == 'circle':
+                geofence.latitude = float(request.POST['latitude'])
+                geofence.longitude = float(request.POST['longitude'])
+                geofence.radius = float(request.POST['radius'])
+            else:
+                # One "latitude, longitude" vertex per line
+                geofence.vertices = [[float(value) for value in line.split(',')]
+                                     for line in request.POST.get('vertices', '').splitlines() if line.strip()]
+                if any(len(vertex) != 2 for vertex in geofence.vertices):
+                    raise ValueError
+        except (KeyError, ValueError, OverflowError):
+            messages.error(request, "Invalid geofence coordinates.")
+            return redirect('manage_geofences')
+        if not geofence.name or kind not in dict(Geofence.KIND_CHOICES) or not geofences.is_valid(geofence) \
+                or not 0 <= geofence.dwell_seconds <= geofences.MAX_DWELL_SECONDS:
+            messages.error(request, "A geofence needs a name, a valid circle or a polygon of at least 3 points "
+                                    "that does not cross the antimeridian, and a dwell time of at most a year.")
+            return redirect('manage_geofences')
+        with transaction.atomic():
+            geofence.save()
+            geofence.devices.set(devices.filter(device_id__in=request.POST.getlist('devices')))
+        messages.success(request, f"Geofence {geofence.name} added.")
+        return redirect('manage_geofences')
+    fences = Geofence.objects.filter(user=request.user).prefetch_related('devices').order_by('name')
+    return render(request, 'device/geofences.html', {'geofences': fences, 'devices': devices})
+
 @login_required
 def maintenance_status(request, device_id):
     try:
@@ -411,6 +538,7 @@ def edit_device(request, device_id):
             alias = request.POST.get('alias')
             device_password = request.POST.get('device_password')
             update_interval = request.POST.get('update_interval', device.update_interval)
+            compression_tolerance = request.POST.get('compression_tolerance', device.compression_tolerance)
             
             if not new_device_id:
                 messages.error(request, 'Device ID is required.')
@@ -428,11 +556,20 @@ def edit_device(request, device_id):
                 messages.error(request, 'Invalid update interval.')
                 return render(request, 'device/edit_device.html', {'device': device})
             
+            try:
+                compression_tolerance = float(compression_tolerance or 0)
+                if not isfinite(compression_tolerance) or compression_tolerance < 0:
+                    raise ValueError
+            except ValueError:
+                messages.error(request, 'Invalid compression tolerance.')
+                return render(request, 'device/edit_device.html', {'device': device})
+            
             device.device_id = new_device_id
             device.alias = alias if alias else None
             if device_password:
                 device.device_password = device_password
             device.update_interval = update_interval
+            device.compression_tolerance = compression_tolerance
             device.save()
             messages.success(request, f"Device '{device.alias or device.device_id}' updated successfully.")
             return redirect('device_list')
@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'device.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -157,4 +158,16 @@ LOGIN_URL = 'login'
 
 REDIS_HOST = 'localhost'  # Replace with your Redis host
 REDIS_PORT = 6379
-REDIS_DB = 0
\ No newline at end of file
+REDIS_DB = 0
+
+# Per-reading ingest output is logged at DEBUG; set the level to DEBUG to see it.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'device': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
\ No newline at end of file
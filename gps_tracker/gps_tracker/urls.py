@@ -16,9 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from device.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('user_auth.urls')),    # User authentication URLs
     path('devices/', include('device.urls')),
+    path('metrics/', metrics, name='metrics'),
 ]